@@ -0,0 +1,392 @@
+"""
+Load generator for the broker. Drives publishers and subscribers built on `pypsmb.client` against an in-process
+or subprocess broker, and reports throughput and end-to-end latency as JSON, so that runs on different
+commits can be compared.
+
+    pypsmb-bench --scenario fan-out --output fan-out.json
+"""
+import argparse
+import array
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple, Union
+
+from .client import PublishProtocol, SubscribeProtocol
+from .client.error import ProtocolError
+
+TIMESTAMP_DIGITS = 20  # every message starts with its sending time (perf_counter_ns) in decimal
+PUBLISH_BATCH = 64  # messages written at once, then the publisher waits for the buffer to drain
+SETTLE_SECONDS = 2  # the run ends when no message arrived for this long after publishing stopped
+# the broker acknowledges SUB before registering the subscriber, so give it a moment
+SUBSCRIBE_GRACE_SECONDS = 0.5
+CHURN_HOLD_SECONDS = 0.2  # a churning subscriber stays subscribed up to this long
+CLOSE_TIMEOUT_SECONDS = 10  # for the connections to be closed at the end of a run
+
+PATTERN_SHAPES = ('literal', 'prefix', 'regex', 'all')
+
+SCENARIOS: Dict[str, dict] = {
+    # one topic delivered to many subscribers
+    'fan-out': dict(publishers=1, subscribers=100, topics=1, pattern='literal', message_size=128),
+    # many publishers on their own topics, one subscriber for all of them
+    'fan-in': dict(publishers=100, subscribers=1, topics=100, pattern='prefix', message_size=128),
+    # little traffic among many connections which do nothing
+    'many-idle': dict(publishers=1, subscribers=1, topics=1, pattern='literal', message_size=128,
+                      idle=2000, rate=1000),
+    # publishing while hundreds of connections keep subscribing and unsubscribing, the steady subscribers
+    # must get every message
+    'churn': dict(publishers=8, subscribers=8, topics=8, pattern='prefix', message_size=128, churn=200),
+}
+
+DEFAULTS = dict(publishers=1, subscribers=1, topics=1, pattern='literal', message_size=128, idle=0, rate=0,
+                duration=10.0, batch=False, churn=0)
+
+
+def _topic(i: int) -> str:
+    return f'bench.{i}'
+
+
+def subscriber_pattern(shape: str, i: int, topics: int) -> str:
+    """
+    Pattern of subscriber `i`, exercising one path of the subscription index.
+    """
+    if shape == 'literal':
+        return re.escape(_topic(i % topics))
+    if shape == 'prefix':
+        return r'bench\..*'
+    if shape == 'regex':
+        # needs the regex fallback: every topic of the same parity as i
+        return r'bench\.\d*[' + ('02468' if i % 2 == 0 else '13579') + ']'
+    if shape == 'all':
+        return '.*'
+    raise ValueError(f'Unknown pattern shape `{shape}`, must be one of {", ".join(PATTERN_SHAPES)}')
+
+
+def percentile(samples: List[int], q: float) -> Optional[float]:
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class InProcessBroker:
+    """
+    Broker running in this process, on a thread of its own plus the handler threads of the threaded engine.
+    Shares the GIL with the clients, use `SubprocessBroker` for numbers closer to a real deployment.
+    """
+
+    def __init__(self, engine: str, max_threads: int, unix: bool = False):
+        from . import entry
+        import pypsmb.mb as mb
+        from .util import create_unix_server
+        from .util.wakeup import Wakeup
+        logging.getLogger().setLevel(logging.WARNING)
+        self.dispatcher = mb.MessageDispatcher()
+        sock = socket.create_server(('127.0.0.1', 0))
+        self.address = sock.getsockname()
+        self._dir = tempfile.mkdtemp() if unix else None
+        unix_sock = None
+        if unix:
+            self.unix_path = os.path.join(self._dir, 'pypsmb.sock')
+            unix_sock = create_unix_server(self.unix_path)
+            unix_sock.setblocking(False)
+        self._stop = None
+        if engine == 'asyncio':
+            # on a daemon thread, the event loop stops with the process
+            target = lambda: asyncio.run(entry._serve_asyncio(sock, self.dispatcher, unix_sock=unix_sock))
+        else:
+            self._stop = Wakeup()
+            target = lambda: entry._serve_threaded(sock, self.dispatcher, max_threads, True, unix_sock=unix_sock,
+                                                   stop=self._stop)
+        self._thread = threading.Thread(target=target, name='BenchBroker', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._stop is not None:
+            # the thread pool of the threaded engine is not daemonic, it returns once the connections are closed
+            self._stop.set()
+            self._thread.join(CLOSE_TIMEOUT_SECONDS)
+            self._stop.close()
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+
+
+class SubprocessBroker:
+    """
+    Broker started with `python -m pypsmb` and a generated configuration.
+    """
+
+    def __init__(self, engine: str, max_threads: int, workers: int = 1, unix: bool = False):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            self.address = probe.getsockname()
+        self._dir = tempfile.mkdtemp() if unix else None
+        unixconf = ''
+        if unix:
+            # listening before the TCP port, which is what is waited for
+            self.unix_path = os.path.join(self._dir, 'pypsmb.sock')
+            unixconf = f'  unix:\n    path: {self.unix_path}\n'
+        self._config = tempfile.NamedTemporaryFile('w', suffix='.yml', delete=False)
+        with self._config:
+            self._config.write(f'listen:\n  address: {self.address[0]}\n  port: {self.address[1]}\n{unixconf}'
+                               f'connection:\n  engine: {engine}\n  max_threads: {max_threads}\n'
+                               f'  workers: {workers}\n  keep_alive: -1\n')
+        self.process = subprocess.Popen([sys.executable, '-m', 'pypsmb', '-c', self._config.name],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(self.address, timeout=1).close()
+                break
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError('Broker did not start')
+                time.sleep(0.05)
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+        os.unlink(self._config.name)
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+
+
+class Subscriber:
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.received = 0
+        self.last_received = 0.0
+        self.latencies = array.array('q')  # ns
+
+    def on_message(self, data: memoryview):
+        now = time.perf_counter_ns()
+        self.received += 1
+        self.last_received = time.monotonic()
+        self.latencies.append(now - int(bytes(data[:TIMESTAMP_DIGITS])))
+
+
+async def _connect(loop: asyncio.AbstractEventLoop, address, make_protocol):
+    on_con_lost = loop.create_future()
+    exchange_ready = asyncio.Event()
+    if isinstance(address, str):  # path of a Unix domain socket
+        _, protocol = await loop.create_unix_connection(lambda: make_protocol(on_con_lost, exchange_ready), address)
+    else:
+        _, protocol = await loop.create_connection(lambda: make_protocol(on_con_lost, exchange_ready), *address)
+    await exchange_ready.wait()
+    return protocol
+
+
+async def _publish(protocol: PublishProtocol, message_size: int, rate: float, stop: asyncio.Event) -> int:
+    padding = 'x' * max(0, message_size - TIMESTAMP_DIGITS)
+    sent = 0
+    started = time.monotonic()
+    while not stop.is_set():
+        await protocol.send_msg(*(f'{time.perf_counter_ns():0{TIMESTAMP_DIGITS}d}{padding}'
+                                  for _ in range(PUBLISH_BATCH)))
+        sent += PUBLISH_BATCH
+        if rate > 0:
+            ahead = sent / rate - (time.monotonic() - started)
+            await asyncio.sleep(max(0, ahead))
+        else:
+            await asyncio.sleep(0)
+    return sent
+
+
+async def _churn(loop: asyncio.AbstractEventLoop, address, pattern: str, stop: asyncio.Event) -> Tuple[int, int]:
+    """
+    Subscribe, stay a moment and leave, over and over. Returns how many times it did, and how many attempts failed.
+    """
+    cycles = errors = 0
+    while not stop.is_set():
+        try:
+            protocol = await _connect(loop, address, lambda lost, ready: SubscribeProtocol(
+                pattern, lambda data: None, on_con_lost=lost, exchange_ready=ready))
+            await asyncio.sleep(random.uniform(0, CHURN_HOLD_SECONDS))
+            # the broker closes first, so that the TIME_WAIT sockets are on its side
+            protocol._transport.write(b'BYE')
+            await protocol.on_con_lost
+            cycles += 1
+        except (OSError, ProtocolError):
+            errors += 1
+    return cycles, errors
+
+
+async def run_load(address: Union[Tuple[str, int], str], publishers: int, subscribers: int, topics: int, pattern: str,
+                   message_size: int, idle: int, rate: float, duration: float, batch: bool = False,
+                   churn: int = 0) -> dict:
+    loop = asyncio.get_running_loop()
+    idle_protocols = []
+    for i in range(idle):
+        idle_protocols.append(await _connect(loop, address, lambda lost, ready: SubscribeProtocol(
+            'bench-idle', on_con_lost=lost, exchange_ready=ready)))
+    subs = [Subscriber(subscriber_pattern(pattern, i, topics)) for i in range(subscribers)]
+    sub_protocols = []
+    for sub in subs:
+        sub_protocols.append(await _connect(loop, address, lambda lost, ready, sub=sub: SubscribeProtocol(
+            sub.pattern, sub.on_message, on_con_lost=lost, exchange_ready=ready, batch=batch)))
+    pubs = []
+    for i in range(publishers):
+        topic = _topic(i % topics)
+        pubs.append((topic, await _connect(loop, address, lambda lost, ready, topic=topic: PublishProtocol(
+            topic, lost, ready, batch))))
+    await asyncio.sleep(SUBSCRIBE_GRACE_SECONDS)
+    # the total rate is shared by the publishers
+    rate_per_publisher = rate / publishers if rate > 0 else 0
+
+    stop = asyncio.Event()
+    churners = [asyncio.ensure_future(_churn(loop, address, subscriber_pattern(pattern, i, topics), stop))
+                for i in range(churn)]
+    started = time.monotonic()
+    tasks = [asyncio.ensure_future(_publish(protocol, message_size, rate_per_publisher, stop))
+             for _, protocol in pubs]
+    await asyncio.sleep(duration)
+    stop.set()
+    sent_counts = await asyncio.gather(*tasks)
+    publish_seconds = time.monotonic() - started
+    churned = await asyncio.gather(*churners)
+
+    published: Dict[str, int] = {}
+    for (topic, _), sent in zip(pubs, sent_counts):
+        published[topic] = published.get(topic, 0) + sent
+    expected = sum(count for sub in subs for topic, count in published.items()
+                   if re.fullmatch(sub.pattern, topic))
+    while True:
+        received = sum(sub.received for sub in subs)
+        last = max((sub.last_received for sub in subs), default=0)
+        if received >= expected or time.monotonic() - max(last, started + publish_seconds) > SETTLE_SECONDS:
+            break
+        await asyncio.sleep(0.05)
+    deliver_seconds = max(last, started + publish_seconds) - started
+
+    # the handlers of an in-process broker return once their connection is closed, after `BYE` as in _churn
+    protocols = idle_protocols + sub_protocols + [protocol for _, protocol in pubs]
+    for protocol in protocols:
+        protocol._transport.write(b'BYE')
+        protocol._transport.close()
+    await asyncio.wait_for(asyncio.gather(*(protocol.on_con_lost for protocol in protocols)), CLOSE_TIMEOUT_SECONDS)
+
+    latencies = sorted(latency for sub in subs for latency in sub.latencies)
+    total_published = sum(sent_counts)
+    return dict(
+        published=total_published,
+        expected_deliveries=expected,
+        delivered=received,
+        publish_seconds=publish_seconds,
+        deliver_seconds=deliver_seconds,
+        publish_rate=total_published / publish_seconds,
+        deliver_rate=received / deliver_seconds if deliver_seconds > 0 else 0,
+        deliver_mib_per_second=received * message_size / deliver_seconds / 2 ** 20 if deliver_seconds > 0 else 0,
+        latency_ms={name: (value / 1e6 if value is not None else None) for name, value in (
+            ('p50', percentile(latencies, 0.5)),
+            ('p99', percentile(latencies, 0.99)),
+            ('p999', percentile(latencies, 0.999)),
+            ('max', latencies[-1] if latencies else None),
+        )},
+        churn_cycles=sum(cycles for cycles, _ in churned),
+        churn_errors=sum(errors for _, errors in churned),
+    )
+
+
+def _raise_file_limit(connections: int):
+    try:
+        import resource
+    except ImportError:
+        return  # not POSIX
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    # each connection takes one descriptor here and up to three in an in-process broker
+    wanted = connections * 4 + 256
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted if hard == resource.RLIM_INFINITY else min(wanted, hard),
+                                                    hard))
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure throughput and latency of a PSMB broker.')
+    parser.add_argument('-s', '--scenario', choices=sorted(SCENARIOS),
+                        help='Preset workload, the other options override its settings')
+    parser.add_argument('--publishers', type=int)
+    parser.add_argument('--subscribers', type=int)
+    parser.add_argument('--topics', type=int)
+    parser.add_argument('--pattern', choices=PATTERN_SHAPES, help='Shape of the subscription patterns')
+    parser.add_argument('--message-size', type=int, help=f'Bytes per message, at least {TIMESTAMP_DIGITS}')
+    parser.add_argument('--idle', type=int, help='Extra connections which subscribe to nothing that is published')
+    parser.add_argument('--rate', type=float, help='Total messages per second, 0 means as fast as possible')
+    parser.add_argument('--duration', type=float, help='Seconds to publish')
+    parser.add_argument('--batch', action='store_const', const=True, help='Negotiate `BAT` frames')
+    parser.add_argument('--churn', type=int, help='Extra connections which keep subscribing and unsubscribing')
+    parser.add_argument('--broker', default='subprocess',
+                        help='`subprocess`, `in-process`, or host:port or Unix socket path of a running broker')
+    parser.add_argument('--unix', action='store_true', help='Connect to a started broker on a Unix domain socket')
+    parser.add_argument('--engine', default='threaded', help='Engine of a started broker')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes of a subprocess broker')
+    parser.add_argument('-o', '--output', help='Write the JSON result to this file instead of stdout')
+    args = parser.parse_args()
+
+    settings = dict(DEFAULTS, **SCENARIOS.get(args.scenario, {}))
+    for name in DEFAULTS:
+        if getattr(args, name) is not None:
+            settings[name] = getattr(args, name)
+    if settings['message_size'] < TIMESTAMP_DIGITS:
+        parser.error(f'--message-size must be at least {TIMESTAMP_DIGITS}')
+
+    connections = settings['publishers'] + settings['subscribers'] + settings['idle'] + settings['churn']
+    _raise_file_limit(connections)
+    max_threads = connections + 16
+    if args.broker == 'subprocess':
+        broker = SubprocessBroker(args.engine, max_threads, args.workers, args.unix)
+        address = broker.unix_path if args.unix else broker.address
+    elif args.broker == 'in-process':
+        broker = InProcessBroker(args.engine, max_threads, args.unix)
+        address = broker.unix_path if args.unix else broker.address
+    elif '/' in args.broker:
+        broker = None
+        address = args.broker
+    else:
+        broker = None
+        host, _, port = args.broker.rpartition(':')
+        address = (host, int(port))
+    try:
+        result = asyncio.run(run_load(address, **settings))
+    finally:
+        if broker is not None:
+            broker.close()
+
+    report = dict(
+        scenario=args.scenario,
+        settings=settings,
+        broker=dict(kind=args.broker, engine=args.engine, workers=args.workers,
+                    transport='unix' if isinstance(address, str) else 'tcp'),
+        result=result,
+        commit=_git_commit(),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        time=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    )
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,23 @@
+import abc
 import asyncio
+import logging
 import socket
+import ssl
 import struct
-from typing import Callable
+from typing import Callable, List, Optional, Union
 import asyncio.transports as transports
 import enum
 
+from .error import ProtocolError, UnsupportedProtocolError
+from ..util.compression import Codec
+from ..util.framing import OPTION_BATCH, OPTION_FLOW_CONTROL, OPTION_RETAIN, RETAIN_COMMAND, WINDOW_COMMAND, \
+    FrameDecoder, decode_batch, encode_batch
+
+COMMAND_LENGTH = 3
+MSG_HEADER_LENGTH = 11  # "MSG" + uint64 message length
+WIN_LENGTH = 11  # "WIN" + uint64 window
+RECONNECT_DELAYS = (0.5, 1, 2, 5, 10)
+
 
 class ClientState(enum.Enum):
     HANDSHAKING = 1
@@ -17,41 +30,169 @@ class SubscriberOptions(enum.Enum):
     ALLOW_HISTORY = 1
 
 
-class PSMBHandshakeProtocol(asyncio.Protocol):
+class PSMBHandshakeProtocol(asyncio.Protocol, abc.ABC):
+    """
+    Base of client connections. The handshake and the mode selection are sent together without waiting
+    for the reply in between, then bytes received after the mode is accepted go to `_exchange_data`.
+    Writes are flow controlled: `drain` waits while the transport buffer is over its high-water mark.
+    With `batch`, the `BAT` frame is requested in the handshake, with `compression` that codec,
+    with `flow_control` the `WIN` frames of paused publishers and with `retain` the `RET` frames of publishers;
+    `options` tells what the broker accepted.
+    """
     _protocol_version = 1
 
-    def __init__(self, on_con_lost: asyncio.Future, exchange_ready):
+    def __init__(self, on_con_lost: asyncio.Future, exchange_ready, batch: bool = False,
+                 compression: Optional[Codec] = None, flow_control: bool = False, retain: bool = False):
         self.on_con_lost = on_con_lost
         self.exchange_ready = exchange_ready
         self.state = ClientState.HANDSHAKING
+        self.requested_options = (OPTION_BATCH if batch else 0) | (compression.option if compression else 0) | \
+            (OPTION_FLOW_CONTROL if flow_control else 0) | (OPTION_RETAIN if retain else 0)
+        self.options = 0  # accepted by the broker
+        self._compression = compression
+        self.codec: Optional[Codec] = None  # compression of this connection, once accepted
+        self.error: Optional[ProtocolError] = None  # why the connection was refused or dropped, if it was
+        self._decoder = FrameDecoder()  # replies before MSG_EXCHANGING
+        self._can_write = asyncio.Event()
+        self._can_write.set()
+
+    @abc.abstractmethod
+    def _mode_request(self) -> bytes:
+        """
+        The mode selection sent after the handshake.
+        """
+
+    @abc.abstractmethod
+    def _exchange_data(self, data: bytes):
+        """
+        Bytes received once the mode is accepted.
+        """
 
     def connection_made(self, transport: transports.Transport) -> None:
         self._transport = transport
         if self.state == ClientState.HANDSHAKING:
-            transport.write(b'PSMB')
-            transport.write(struct.pack(
-                'I', socket.htonl(self._protocol_version)))
-            transport.write(b'\x00\x00\x00\x00')
+            transport.write(b'PSMB' + struct.pack('I', socket.htonl(self._protocol_version))
+                            + self.requested_options.to_bytes(4, 'big') + self._mode_request())
         return super().connection_made(transport)
 
+    def _refuse(self, error: ProtocolError):
+        self.error = error
+        self._transport.close()
+
     def data_received(self, data: bytes) -> None:
+        if self.state == ClientState.MSG_EXCHANGING:
+            self._exchange_data(data)
+            return
+        self._decoder.feed(data)
         if self.state == ClientState.HANDSHAKING:
-            if data[:2] != b'OK':
-                raise NotImplementedError('')
-            else:
-                # 切换状态到模式选择
-                self.state = ClientState.MODE_CHOOSING_START
-        return super().data_received(data)
+            reply = self._decoder.take_cstring()
+            if reply is None:
+                return
+            if reply != b'OK':
+                self._refuse(UnsupportedProtocolError(reply.decode('ascii', 'replace')))
+                return
+            # 切换状态到模式选择
+            self.state = ClientState.MODE_CHOOSING_START
+        if self.state == ClientState.MODE_CHOOSING_START:
+            options = self._decoder.take(4)
+            if options is None:
+                return
+            self.options = int.from_bytes(options, 'big')
+            if self.options & ~self.requested_options:
+                self._refuse(ProtocolError(f'Broker accepted options which were not requested: '
+                                           f'{self.options & ~self.requested_options:#x}'))
+                return
+            if self._compression is not None and self.options & self._compression.option:
+                self.codec = self._compression
+            self.state = ClientState.MODE_CHOOSING_PENDING  # 切换到等待服务器结果状态
+        if self.state == ClientState.MODE_CHOOSING_PENDING:
+            reply = self._decoder.take_cstring()
+            if reply is None:
+                return
+            if reply != b'OK':
+                self._refuse(ProtocolError(f'Mode is refused: {reply.decode("ascii", "replace")}'))
+                return
+            self.state = ClientState.MSG_EXCHANGING
+            self.exchange_ready.set()
+            rest = self._decoder.take(len(self._decoder))
+            self._decoder = None
+            if rest:
+                self._exchange_data(rest)
+
+    def pause_writing(self) -> None:
+        self._can_write.clear()
+
+    def resume_writing(self) -> None:
+        self._can_write.set()
+
+    async def drain(self):
+        """
+        Wait until the transport buffer is below its low-water mark.
+        Raises `ConnectionResetError` if the connection is lost.
+        """
+        if self._transport.is_closing():
+            raise ConnectionResetError('Connection lost')
+        await self._can_write.wait()
+        if self._transport.is_closing():
+            raise ConnectionResetError('Connection lost')
 
     def connection_lost(self, exc: Exception | None) -> None:
-        self.on_con_lost.set_result(True)
+        self._can_write.set()  # wake up drain, which will raise
+        if not self.on_con_lost.done():
+            self.on_con_lost.set_result(True)
         return super().connection_lost(exc)
 
 
+def encode_messages(*msg_list: Union[str, bytes, memoryview], batch: bool = False,
+                    codec: Optional[Codec] = None) -> bytes:
+    """
+    Encode messages into frames joined to be written at once. Strings are encoded with UTF-8.
+    Messages worth compressing with `codec` become `CMP` frames, with `batch` runs of the others become
+    one `BAT` frame, and the rest are `MSG` frames.
+    """
+    parts = []
+    plain = []
+
+    def flush():
+        if batch and len(plain) > 1:
+            parts.append(encode_batch(plain))
+        else:
+            for data in plain:
+                parts.append(b'MSG')
+                parts.append(len(data).to_bytes(8, 'big'))
+                parts.append(data)
+        plain.clear()
+
+    for msg in msg_list:
+        data = msg.encode(encoding='UTF-8') if isinstance(msg, str) else msg
+        compressed = codec.encode(data) if codec is not None else None
+        if compressed is None:
+            plain.append(data)
+        else:
+            flush()
+            parts.append(compressed)
+    flush()
+    return b''.join(parts)
+
+
 class PublishProtocol(PSMBHandshakeProtocol):
-    def __init__(self, topic, on_con_lost: asyncio.Future, exchange_ready: asyncio.Event):
-        super().__init__(on_con_lost, exchange_ready)
+    """
+    With flow control, `drain` also waits while the broker has paused reading (its window is 0).
+    """
+
+    def __init__(self, topic, on_con_lost: asyncio.Future, exchange_ready: asyncio.Event, batch: bool = False,
+                 compression: Optional[Codec] = None, flow_control: bool = False, retain: bool = False):
+        super().__init__(on_con_lost, exchange_ready, batch, compression, flow_control, retain)
         self.topic = topic
+        self.nop_task = None
+        self.window: Optional[int] = None  # as last sent by the broker, None until it pauses
+        self._window_open = asyncio.Event()
+        self._window_open.set()
+        self._commands = bytearray()
+
+    def _mode_request(self) -> bytes:
+        # 选择广播模式
+        return b'PUB' + self.topic.encode(encoding='ascii') + b'\0'
 
     async def _nop(self):
         while True:
@@ -60,44 +201,101 @@ class PublishProtocol(PSMBHandshakeProtocol):
 
     def data_received(self, data: bytes) -> None:
         super().data_received(data)
-        if self.state == ClientState.MODE_CHOOSING_START:
-            # 开始选择模式，这里需要选广播
-            self._transport.write(b'PUB')
-            self._transport.write(self.topic.encode(encoding='ascii'))
-            self._transport.write(b'\0')
-            self.state = ClientState.MODE_CHOOSING_PENDING  # 切换到等待服务器结果状态
-        elif self.state == ClientState.MODE_CHOOSING_PENDING:
-            if data[:2] != b'OK':
-                raise NotImplementedError('')
-            else:
-                self.state = ClientState.MSG_EXCHANGING
-                self.exchange_ready.set()
-                loop = asyncio.get_event_loop()
-                self.nop_task = loop.create_task(self._nop())
+        if self.state == ClientState.MSG_EXCHANGING and self.nop_task is None:
+            loop = asyncio.get_event_loop()
+            self.nop_task = loop.create_task(self._nop())
+
+    def _exchange_data(self, data: bytes):
+        # the broker only answers NOP with NIL, sends NOP to publishers of protocol 2,
+        # and WIN if flow control is enabled
+        self._commands += data
+        pos = 0
+        while len(self._commands) - pos >= COMMAND_LENGTH:
+            command = self._commands[pos:pos + COMMAND_LENGTH]
+            if command == WINDOW_COMMAND:
+                if len(self._commands) - pos < WIN_LENGTH:
+                    break
+                self.window = int.from_bytes(self._commands[pos + COMMAND_LENGTH:pos + WIN_LENGTH], 'big')
+                if self.window:
+                    self._window_open.set()
+                else:
+                    self._window_open.clear()
+                pos += WIN_LENGTH
+                continue
+            if command == b'NOP':
+                self._transport.write(b'NIL')
+            elif command != b'NIL':
+                # the stream cannot be followed any further
+                self._refuse(ProtocolError(f'Unexpected command from broker: {bytes(command)!r}'))
+                return
+            pos += COMMAND_LENGTH
+        del self._commands[:pos]
+
+    async def drain(self):
+        await self._window_open.wait()
+        await super().drain()
 
     def connection_lost(self, exc: Exception | None) -> None:
+        self._window_open.set()  # wake up drain, which will raise
         super().connection_lost(exc)
-        self.nop_task.cancel()
+        if self.nop_task is not None:
+            self.nop_task.cancel()
+
+    def write_msg(self, *msg_list: Union[str, bytes, memoryview]):
+        """
+        Write messages in a single transport write, without waiting for the buffer to drain.
+        They are batched and compressed as accepted by the broker.
+        """
+        assert self.state == ClientState.MSG_EXCHANGING
+        self._transport.write(encode_messages(*msg_list, batch=bool(self.options & OPTION_BATCH), codec=self.codec))
+
+    async def send_msg(self, *msg_list: Union[str, bytes, memoryview]):
+        self.write_msg(*msg_list)
+        await self.drain()
 
-    async def send_msg(self, *msg_list: str):
+    def write_retained(self, msg: Union[str, bytes, memoryview]):
+        """
+        Write a message which the broker also keeps as the retained message of the topic, sent to subscribers
+        as soon as they subscribe. An empty message clears it. Requires `retain` to be accepted by the broker.
+        """
         assert self.state == ClientState.MSG_EXCHANGING
-        for msg in msg_list:
-            self._transport.write(b'MSG')
-            data = msg.encode(encoding='UTF-8')
-            self._transport.write(len(data).to_bytes(8, 'big'))
-            self._transport.write(data)
+        if not self.options & OPTION_RETAIN:
+            raise ProtocolError('Retained messages are not enabled on the broker')
+        data = msg.encode(encoding='UTF-8') if isinstance(msg, str) else msg
+        self._transport.write(RETAIN_COMMAND + len(data).to_bytes(8, 'big') + data)
+
+    async def send_retained(self, msg: Union[str, bytes, memoryview]):
+        self.write_retained(msg)
+        await self.drain()
 
     async def send_nop(self) -> None:
         self._transport.write(b"NOP")
 
 
 class SubscribeProtocol(PSMBHandshakeProtocol):
-    def __init__(self, id_pattern: str, *handlers: Callable[[bytes], None], subscriber_id: int | None = None, on_con_lost: asyncio.Future, exchange_ready: asyncio.Event):
-        super().__init__(on_con_lost, exchange_ready)
+    """
+    Handlers are called with a read-only memoryview of each message. It is valid after the call,
+    but keeps the received chunk alive, so copy it with `bytes()` to store small parts of large chunks.
+    """
+
+    def __init__(self, id_pattern: str, *handlers: Callable[[memoryview], None], subscriber_id: int | None = None, on_con_lost: asyncio.Future, exchange_ready: asyncio.Event, batch: bool = False, compression: Optional[Codec] = None):
+        super().__init__(on_con_lost, exchange_ready, batch, compression)
         self.id_pattern = id_pattern
         self.handlers = handlers
-        self._command_buffer = bytearray()
         self.subscriber_id = subscriber_id
+        # a frame split over chunks: its chunks so far, their total size and the size needed to go on decoding
+        self._partial: List[bytes] = []
+        self._partial_size = 0
+        self._partial_needed = 0
+
+    def _mode_request(self) -> bytes:
+        # 选择订阅模式
+        option = (
+            SubscriberOptions.ALLOW_HISTORY.value) if self.subscriber_id is not None else 0
+        request = b'SUB' + option.to_bytes(4, 'big') + self.id_pattern.encode('UTF-8') + b'\0'
+        if self.subscriber_id is not None:
+            request += self.subscriber_id.to_bytes(8, 'big')
+        return request
 
     def on_nop(self):
         self._transport.write(b'NIL')
@@ -105,48 +303,221 @@ class SubscribeProtocol(PSMBHandshakeProtocol):
     def on_bye(self):
         self._transport.close()
 
-    def data_received(self, data: bytes) -> None:
-        super().data_received(data)
-        if self.state == ClientState.MODE_CHOOSING_START:
-            # 开始选择模式，这里需要选订阅
-            self._transport.write(b'SUB')
-            option = (
-                SubscriberOptions.ALLOW_HISTORY.value) if self.subscriber_id is not None else 0
-            self._transport.write(option.to_bytes(4, 'big'))
-            self._transport.write(self.id_pattern.encode('UTF-8'))
-            self._transport.write(b'\0')
-            if self.subscriber_id is not None:
-                self._transport.write(self.subscriber_id.to_bytes(8, 'big'))
-            self.state = ClientState.MODE_CHOOSING_PENDING
-        elif self.state == ClientState.MODE_CHOOSING_PENDING:
-            if data[:2] != b'OK':
-                raise NotImplementedError('')
-            else:
-                self.state = ClientState.MSG_EXCHANGING
-                self.exchange_ready.set()
-        elif self.state == ClientState.MSG_EXCHANGING:
-            self._exchange_data(data)
-
     def _exchange_data(self, data: bytes):
-        command_len = 3
-        number_len = 8
-        self._command_buffer.extend(data)
-        if len(self._command_buffer) >= 3:
-            c = self._command_buffer[:3]
-            if c == b'NOP':
+        if self._partial:
+            self._partial.append(data)
+            self._partial_size += len(data)
+            if self._partial_size < self._partial_needed:
+                return  # joining only once the frame is complete keeps large messages linear
+            data = b''.join(self._partial)
+            self._partial.clear()
+            self._partial_size = 0
+        view = memoryview(data)
+        end = len(data)
+        pos = 0
+        # a chunk may hold several commands, or only a part of one
+        while end - pos >= COMMAND_LENGTH:
+            command = data[pos:pos + COMMAND_LENGTH]
+            if command == b'MSG' or command == b'BAT' or command == b'CMP':
+                header_end = pos + MSG_HEADER_LENGTH
+                if header_end > end:
+                    self._partial_needed = MSG_HEADER_LENGTH
+                    break
+                msg_end = header_end + int.from_bytes(data[pos + COMMAND_LENGTH:header_end], 'big')
+                if msg_end > end:
+                    self._partial_needed = msg_end - pos
+                    break
+                if command == b'MSG':
+                    messages = (view[header_end:msg_end].toreadonly(),)
+                elif command == b'CMP':
+                    if self.codec is None:
+                        self._refuse(ProtocolError('Compressed message from broker without a negotiated codec'))
+                        return
+                    messages = (memoryview(self.codec.decompress(view[header_end:msg_end])).toreadonly(),)
+                else:
+                    messages = decode_batch(view[header_end:msg_end].toreadonly())
+                for message in messages:
+                    for handler in self.handlers:
+                        handler(message)
+                pos = msg_end
+                continue
+            if command == b'NOP':
                 self.on_nop()
-                self._command_buffer = self._command_buffer[command_len:]
-            elif c == b'BYE':
+            elif command == b'BYE':
                 self.on_bye()
-                self._command_buffer = self._command_buffer[command_len:]
-            elif c == b'MSG':
-                # Try to decode message pack
-                offset = command_len + number_len
-                if len(self._command_buffer) >= offset:
-                    msg_len = int.from_bytes(
-                        self._command_buffer[command_len: offset], 'big')
-                    n = offset + msg_len
-                    if len(self._command_buffer) >= n:
-                        for handler in self.handlers:
-                            handler(self._command_buffer[offset:])
-                        self._command_buffer = self._command_buffer[n:]
+            elif command != b'NIL':
+                # the stream cannot be followed any further
+                self._refuse(ProtocolError(f'Unexpected command from broker: {command!r}'))
+                return
+            pos += COMMAND_LENGTH
+        else:
+            self._partial_needed = COMMAND_LENGTH
+        if pos < end:
+            self._partial.append(data[pos:])
+            self._partial_size = end - pos
+
+
+class _ReconnectingClient(abc.ABC):
+    """
+    Keeps a connection to the broker, reconnecting with backoff whenever it is lost.
+    If `port` is None, `host` is the path of the Unix domain socket of a broker on the same machine.
+    """
+
+    def __init__(self, host: str, port: Optional[int], ssl_context: Optional[ssl.SSLContext] = None,
+                 reconnect_delays=RECONNECT_DELAYS, batch: bool = False, compression: Optional[Codec] = None,
+                 flow_control: bool = False, retain: bool = False):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.batch = batch  # request `BAT` frames
+        self.compression = compression  # request this codec
+        self.flow_control = flow_control  # request `WIN` frames, publishers only
+        self.retain = retain  # request `RET` frames, publishers only
+        self.reconnect_delays = reconnect_delays
+        self.protocol: Optional[PSMBHandshakeProtocol] = None  # the current connection, once it is ready
+        self.logger = logging.getLogger(f'{type(self).__name__},{host}' + (f':{port}' if port is not None else ''))
+        self._connected = asyncio.Event()
+        self._closed = False
+        self._task: Optional[asyncio.Task] = None
+
+    @abc.abstractmethod
+    def _make_protocol(self, on_con_lost: asyncio.Future, exchange_ready: asyncio.Event) -> PSMBHandshakeProtocol:
+        """
+        A new connection of this client.
+        """
+
+    async def start(self):
+        """
+        Connect in the background, returns once connected for the first time.
+        """
+        self._task = asyncio.ensure_future(self._run())
+        await self.wait_connected()
+
+    async def wait_connected(self):
+        if self._connected.is_set():
+            return
+        connected = asyncio.ensure_future(self._connected.wait())
+        await asyncio.wait([connected, self._task], return_when=asyncio.FIRST_COMPLETED)
+        if not connected.done():
+            connected.cancel()
+            self._task.result()  # the client is closed, or crashed
+            raise ConnectionError('Client is closed')
+
+    async def _connect_once(self):
+        loop = asyncio.get_running_loop()
+        on_con_lost = loop.create_future()
+        exchange_ready = asyncio.Event()
+
+        def factory():
+            return self._make_protocol(on_con_lost, exchange_ready)
+
+        if self.port is None:
+            transport, protocol = await loop.create_unix_connection(factory, self.host, ssl=self.ssl_context)
+        else:
+            transport, protocol = await loop.create_connection(factory, self.host, self.port, ssl=self.ssl_context)
+        ready = asyncio.ensure_future(exchange_ready.wait())
+        try:
+            await asyncio.wait([ready, on_con_lost], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            ready.cancel()
+        if not exchange_ready.is_set():
+            if protocol.error is not None:
+                raise protocol.error
+            raise ConnectionResetError('Connection lost during handshake')
+        self.logger.info('Connected.')
+        self.protocol = protocol
+        self._connected.set()
+        try:
+            await on_con_lost
+        finally:
+            self._connected.clear()
+            self.protocol = None
+            transport.close()
+        if protocol.error is not None:
+            raise protocol.error
+
+    async def _run(self):
+        attempt = 0
+        while not self._closed:
+            try:
+                await self._connect_once()
+                attempt = 0
+            except (OSError, ProtocolError):
+                self.logger.warning('Cannot connect to the broker.', exc_info=True)
+            if self._closed:
+                break
+            delay = self.reconnect_delays[min(attempt, len(self.reconnect_delays) - 1)]
+            self.logger.info(f'Connection is lost, reconnect in {delay}s.')
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def close(self):
+        self._closed = True
+        if self.protocol is not None:
+            self.protocol._transport.close()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+class PublishClient(_ReconnectingClient):
+    """
+    Publisher which reconnects transparently. Messages written to a connection which breaks
+    before the broker reads them are lost, as with any PSMB publisher.
+    """
+
+    def __init__(self, host: str, port: Optional[int], topic: str, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.topic = topic
+
+    def _make_protocol(self, on_con_lost, exchange_ready):
+        return PublishProtocol(self.topic, on_con_lost, exchange_ready, self.batch, self.compression,
+                               self.flow_control, self.retain)
+
+    async def publish(self, *msg_list: Union[str, bytes, memoryview]):
+        """
+        Send messages in one write, waiting for a connection if there is none and for the buffer to drain
+        (and with flow control, for the broker to resume reading).
+        """
+        await self.wait_connected()
+        protocol = self.protocol
+        protocol.write_msg(*msg_list)
+        try:
+            await protocol.drain()
+        except ConnectionError:
+            pass  # reconnecting already
+
+    async def publish_retained(self, msg: Union[str, bytes, memoryview]):
+        """
+        Send a message which the broker keeps as the retained message of the topic, see
+        `PublishProtocol.write_retained`. The client must be created with `retain=True`.
+        """
+        await self.wait_connected()
+        protocol = self.protocol
+        protocol.write_retained(msg)
+        try:
+            await protocol.drain()
+        except ConnectionError:
+            pass  # reconnecting already
+
+
+class SubscribeClient(_ReconnectingClient):
+    """
+    Subscriber which reconnects transparently and subscribes again. With a `subscriber_id`,
+    a broker with history enabled delivers what was missed while disconnected.
+    """
+
+    def __init__(self, host: str, port: Optional[int], id_pattern: str, *handlers: Callable[[memoryview], None],
+                 subscriber_id: Optional[int] = None, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.id_pattern = id_pattern
+        self.handlers = handlers
+        self.subscriber_id = subscriber_id
+
+    def _make_protocol(self, on_con_lost, exchange_ready):
+        return SubscribeProtocol(self.id_pattern, *self.handlers, subscriber_id=self.subscriber_id,
+                                 on_con_lost=on_con_lost, exchange_ready=exchange_ready, batch=self.batch,
+                                 compression=self.compression)
@@ -1,58 +1,371 @@
+import asyncio
+import atexit
 import logging
+import os
 import socket
+import sys
 import yaml
 from concurrent.futures import ThreadPoolExecutor
 import pypsmb.mb as mb
+from pypsmb.mb.frame import Frame
+from pypsmb.util import Selector, create_unix_server, peer_address, set_nodelay
+from pypsmb.util.wakeup import Wakeup
+from pypsmb.util.compression import CODECS, DEFAULT_MIN_BYTES
+from pypsmb.util.framing import DEFAULT_MAX_CSTRING, DEFAULT_MAX_MESSAGE
 import argparse
+import selectors
 import ssl
+from typing import Dict, List, Optional, Sequence, Tuple
 
 LOG_FORMAT = '[%(asctime)-15s][%(levelname)s][%(name)s] %(message)s'
 logging.basicConfig(format=LOG_FORMAT, level='INFO')
 
+ENGINES = ('threaded', 'asyncio')
+
+
+def _handle_threaded(client: socket.socket, addr, dispatcher: mb.MessageDispatcher,
+                     context: Optional[ssl.SSLContext], handshake_timeout: float, **options):
+    if context is not None:
+        # handshake on the worker thread, so that a slow client does not hold up the accept loop
+        client = mb.handshake(client, addr, context, handshake_timeout, dispatcher.metrics)
+        if client is None:
+            return
+    mb.handle_client(sock=client, addr=addr, dispatcher=dispatcher, **options)
+
+
+def _serve_threaded(sock: socket.socket, dispatcher: mb.MessageDispatcher, max_threads: int,
+                    tcp_nodelay: bool, context: Optional[ssl.SSLContext] = None,
+                    handshake_timeout: float = mb.DEFAULT_HANDSHAKE_TIMEOUT,
+                    fanout: Optional[mb.WorkerFanout] = None, keepalive: Optional[mb.KeepAlive] = None,
+                    handover: Optional[mb.Handover] = None, resumed: Sequence[mb.ConnectionState] = (),
+                    unix_sock: Optional[socket.socket] = None, stop: Optional[Wakeup] = None, **options):
+    """
+    Accept connections and serve each on a thread of a pool. Returns once `stop` is set, if given,
+    after the connections being served are closed.
+    """
+    executor = ThreadPoolExecutor(max_workers=max_threads)
+    if fanout is not None:
+        fanout.start_threads()
+    if keepalive is not None:
+        keepalive.start_thread()
+    if resumed:
+        mb.resume_clients(executor, resumed, dispatcher,
+                          handover.timeout if handover else mb.DEFAULT_HANDOVER_TIMEOUT,
+                          keepalive=keepalive, handover=handover, **options)
+    listeners = [sock] if unix_sock is None else [sock, unix_sock]
+    selector = None
+    if handover is not None or unix_sock is not None or stop is not None:
+        selector = Selector()
+        for listener in listeners:
+            selector.register(listener, selectors.EVENT_READ)
+    if stop is not None:
+        selector.register(stop, selectors.EVENT_READ)
+    if handover is not None:
+        handover.listen_signal()
+        selector.register(handover.signalled, selectors.EVENT_READ)
+    while True:
+        ready = [key.fileobj for key, _ in selector.select()] if selector is not None else listeners
+        if stop is not None and stop in ready:
+            selector.close()
+            executor.shutdown()
+            return
+        if handover is not None and handover.signalled in ready:
+            # exits unless the new process cannot be started
+            handover.run(listeners, dispatcher)
+            continue
+        if sock in ready:
+            client, addr = sock.accept()
+            set_nodelay(client, tcp_nodelay)
+            executor.submit(_handle_threaded, client, addr, dispatcher, context, handshake_timeout,
+                            keepalive=keepalive, handover=handover, **options)
+        if unix_sock in ready:
+            try:
+                # non-blocking, as workers share it and another one may have accepted the connection
+                client, _ = unix_sock.accept()
+            except BlockingIOError:
+                continue
+            client.setblocking(True)
+            # local clients do not need TLS
+            executor.submit(_handle_threaded, client, peer_address(client), dispatcher, None, handshake_timeout,
+                            keepalive=keepalive, handover=handover, **options)
+
+
+async def _serve_asyncio(sock: socket.socket, dispatcher: mb.MessageDispatcher,
+                         context: ssl.SSLContext = None, handshake_timeout: float = mb.DEFAULT_HANDSHAKE_TIMEOUT,
+                         fanout: Optional[mb.WorkerFanout] = None, keepalive: Optional[mb.KeepAlive] = None,
+                         handover: Optional[mb.Handover] = None, resumed: Sequence[mb.ConnectionState] = (),
+                         unix_sock: Optional[socket.socket] = None, **options):
+    if fanout is not None:
+        await fanout.start_async()
+        # publishers wait for the other workers, see WorkerFanout.drain
+        options = dict(options, fanout=fanout)
+    if keepalive is not None:
+        keepalive.start_async()
+    if resumed:
+        await mb.resume_clients_async(resumed, dispatcher,
+                                      handover.timeout if handover else mb.DEFAULT_HANDOVER_TIMEOUT,
+                                      keepalive=keepalive, handover=handover, **options)
+    # StreamWriter.start_tls is new in Python 3.11, before that the server does the handshake, without metrics
+    server_ssl = context if not hasattr(asyncio.StreamWriter, 'start_tls') else None
+
+    async def on_client(reader, writer):
+        if context is not None and server_ssl is None:
+            # must come first, before the stream reads anything
+            if not await mb.handshake_async(writer, context, handshake_timeout, dispatcher.metrics):
+                return
+        await mb.handle_client_async(reader, writer, dispatcher, keepalive=keepalive, handover=handover, **options)
+
+    async def on_local_client(reader, writer):
+        # local clients do not need TLS
+        await mb.handle_client_async(reader, writer, dispatcher, keepalive=keepalive, handover=handover, **options)
+
+    listeners = [sock]
+    servers = [await asyncio.start_server(on_client, sock=sock, ssl=server_ssl,
+                                          ssl_handshake_timeout=handshake_timeout if server_ssl else None)]
+    if unix_sock is not None:
+        listeners.append(unix_sock)
+        # from Python 3.13 the socket file is removed when the server closes, also when handing over
+        cleanup = dict(cleanup_socket=False) if sys.version_info >= (3, 13) else {}
+        servers.append(await asyncio.start_unix_server(on_local_client, sock=unix_sock, **cleanup))
+    if handover is not None:
+        asyncio.get_running_loop().add_signal_handler(mb.HANDOVER_SIGNAL, handover.start_async,
+                                                      servers, listeners, dispatcher)
+    try:
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+    except asyncio.CancelledError:
+        if handover is None or not handover.requested:
+            raise
+        # the process exits when the handover is done
+        await handover.task
+    finally:
+        for server in servers:
+            server.close()
+
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', help='Path to or name of the configuaration file',
                         required=False, default='config.yaml')
+    parser.add_argument('--handover-fd', type=int, help=argparse.SUPPRESS)  # passed by the broker handing over
     args = parser.parse_args()
     config_filename = args.config
     with open(config_filename, 'r', encoding='utf-8') as f:
         config = yaml.load(f, Loader=yaml.FullLoader)
     listen = config.get('listen') or {}
     connection = config.get('connection') or {}
+    inboxconf = config.get('inbox') or {}
+    historyconf = config.get('history') or None
+    federationconf = config.get('federation') or None
+    metricsconf = config.get('metrics') or None
+    compressionconf = config.get('compression') or None
+    flowconf = config.get('flow_control') or []
+    retainconf = config.get('retain') or None
     sslconf = config.get('ssl') or None
+    handoverconf = config.get('handover') or None
+    unixconf = listen.get('unix') or None
     host = listen.get('address') or '0.0.0.0'
     port = listen.get('port') or 3880
+    engine = connection.get('engine') or 'threaded'
     max_threads = connection.get('max_threads') or 32
     keep_alive = connection.get('keep_alive') or -1
+    workers = connection.get('workers') or 1
     if 0 <= keep_alive <= 3:
         raise RuntimeError(
             f'Keep-alive interval is too small ({keep_alive} sec)')
+    if engine not in ENGINES:
+        raise RuntimeError(f'Unknown engine `{engine}`, must be one of {", ".join(ENGINES)}')
+    if workers > 1 and historyconf is not None:
+        # the workers would write the same log files
+        raise RuntimeError('History cannot be enabled with multiple workers')
+    if workers > 1 and (handoverconf is not None or args.handover_fd is not None):
+        raise RuntimeError('Handover is not supported with multiple workers')
 
-    executor = ThreadPoolExecutor(max_workers=max_threads)
-    dispatcher = mb.MessageDispatcher()
+    codecs = []
+    if compressionconf is not None:
+        for name in compressionconf.get('codecs') or ['zlib']:
+            if name not in CODECS:
+                raise RuntimeError(f'Unknown compression codec `{name}`, must be one of {", ".join(CODECS)}')
+            codecs.append(CODECS[name](min_bytes=compressionconf.get('min_bytes') or DEFAULT_MIN_BYTES,
+                                       level=compressionconf.get('level')))
 
-    listen_addr = (host, port)
-    sock = socket.create_server(listen_addr)
+    flow_rules = [mb.FlowRule(rule['pattern'], rule['high_water'], rule.get('low_water', -1)) for rule in flowconf]
 
+    context = None
+    handshake_timeout = mb.DEFAULT_HANDSHAKE_TIMEOUT
     if sslconf is not None:
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        context.load_cert_chain(sslconf.get('certchain'), sslconf.get('privatekey'))
-        sock = context.wrap_socket(sock, server_side=True)
+        context = mb.server_context(sslconf.get('certchain'), sslconf.get('privatekey'),
+                                    sslconf.get('session_tickets', mb.DEFAULT_SESSION_TICKETS))
+        handshake_timeout = sslconf.get('handshake_timeout') or mb.DEFAULT_HANDSHAKE_TIMEOUT
+
+    options = dict(
+        batch_messages=connection.get('batch_messages') or mb.DEFAULT_BATCH_MESSAGES,
+        batch_bytes=connection.get('batch_bytes') or mb.DEFAULT_BATCH_BYTES,
+        max_cstring=connection.get('max_string_bytes') or DEFAULT_MAX_CSTRING,
+        max_message=connection.get('max_message_bytes') or DEFAULT_MAX_MESSAGE,
+        codecs=codecs,
+    )
+    listen_addr = (host, port)
+
+    handover = None
+    if handoverconf is not None:
+        handover = mb.Handover(config_filename, handoverconf.get('timeout') or mb.DEFAULT_HANDOVER_TIMEOUT)
+    inherited = None
+    if args.handover_fd is not None:
+        # started by a broker handing over to this process, which is given its listening sockets
+        inherited = mb.receive_handover(args.handover_fd)
+        print(f'Took over {len(inherited[1])} connection(s) on {host}:{port} ({engine} engine)...')
+
+    unix_sock = None
+    for listener in inherited[0][1:] if inherited is not None else ():
+        if unixconf is not None and listener.getsockname() == unixconf['path']:
+            unix_sock = listener
+        else:
+            # the Unix socket is no longer configured, or at another path
+            listener.close()
+    if unixconf is not None:
+        if unix_sock is None:
+            # octal, `'660'` or `0660` in YAML
+            mode = unixconf.get('mode')
+            unix_sock = create_unix_server(unixconf['path'], int(mode, 8) if isinstance(mode, str) else mode,
+                                           unixconf.get('group'))
+        # not removed when the process exits for a handover, which skips atexit
+        atexit.register(_unlink_unix_socket, unixconf['path'])
+        print(f'Listening on {unixconf["path"]}...')
+
+    if workers > 1:
+        # bind in the parent first, so that a bad address fails early
+        socket.create_server(listen_addr, reuse_port=True).close()
+        print(f'Listening on {host}:{port} ({engine} engine, {workers} workers)...')
+        # unlike the TCP port, the Unix socket is one, shared by the workers
+        mb.run_workers(workers, lambda worker_id, peers: _serve(
+            listen_addr, engine, context, handshake_timeout, historyconf, inboxconf, flow_rules, federationconf,
+            metricsconf, connection, max_threads, options, worker_id, peers, retainconf=retainconf,
+            unix_sock=unix_sock))
+    else:
+        if inherited is None:
+            print(f'Listening on {host}:{port} ({engine} engine)...')
+        _serve(listen_addr, engine, context, handshake_timeout, historyconf, inboxconf, flow_rules, federationconf,
+               metricsconf, connection, max_threads, options, handover=handover, inherited=inherited,
+               retainconf=retainconf, unix_sock=unix_sock)
+
+
+def _unlink_unix_socket(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _serve(listen_addr, engine: str, context: Optional[ssl.SSLContext], handshake_timeout: float,
+           historyconf: Optional[dict], inboxconf: dict, flow_rules: List[mb.FlowRule],
+           federationconf: Optional[dict], metricsconf: Optional[dict], connection: dict,
+           max_threads: int, options: dict,
+           worker_id: Optional[int] = None, peers: Optional[Dict[int, socket.socket]] = None,
+           handover: Optional[mb.Handover] = None,
+           inherited: Optional[Tuple[List[socket.socket], List[mb.ConnectionState], List[Frame],
+                                     Optional[socket.socket]]] = None,
+           retainconf: Optional[dict] = None, unix_sock: Optional[socket.socket] = None):
+    keep_alive = connection.get('keep_alive') or -1
+    log = None
+    if historyconf is not None:
+        log = mb.MessageLog(
+            historyconf.get('directory') or 'history',
+            segment_bytes=historyconf.get('segment_bytes') or 64 * 1024 * 1024,
+            retention_seconds=historyconf.get('retention_seconds') or -1,
+            retention_bytes=historyconf.get('retention_bytes') or -1,
+            commit_interval=historyconf.get('commit_interval') or 0.05,
+            fsync=historyconf.get('fsync', True),
+        )
+        atexit.register(log.close)
+
+    retained = None
+    if retainconf is not None:
+        retained = mb.RetainedStore(
+            max_topics=retainconf.get('max_topics') or -1,
+            max_bytes=retainconf.get('max_bytes') or -1,
+            max_age=retainconf.get('max_age_seconds') or -1,
+        )
+
+    dispatcher = mb.MessageDispatcher(
+        max_inbox_messages=inboxconf.get('max_messages') or -1,
+        max_inbox_bytes=inboxconf.get('max_bytes') or -1,
+        overflow_policy=mb.OverflowPolicy(inboxconf.get('overflow') or 'drop-oldest'),
+        memory_budget=inboxconf.get('memory_budget') or -1,
+        log=log,
+        flow_rules=flow_rules,
+        retained=retained,
+    )
+
+    if federationconf is not None:
+        federation = mb.Federation(
+            dispatcher, federationconf.get('broker_id') or socket.gethostname(),
+            max_hops=federationconf.get('max_hops') or mb.DEFAULT_MAX_HOPS,
+            keep_alive=keep_alive,
+        )
+        for peer in federationconf.get('peers') or []:
+            federation.add_peer(peer['address'], peer.get('port') or 3880, peer.get('topics') or '.*',
+                                use_ssl=peer.get('ssl', False),
+                                queue_size=peer.get('queue_size') or mb.DEFAULT_QUEUE_SIZE)
+        federation.start()
+        options = dict(options, federation=federation)
+
+    if keep_alive > 0:
+        # one timer wheel for the keepalive of all connections
+        options = dict(options, keepalive=mb.KeepAlive(keep_alive, metrics=dispatcher.metrics))
+
+    metrics_sock = inherited[3] if inherited is not None else None
+    if metricsconf is not None:
+        # every worker has its own metrics, worker N serves them on the configured port + N
+        metrics_port = (metricsconf.get('port') or 9880) + (worker_id or 0)
+        if metrics_sock is not None and metrics_sock.getsockname()[1] != metrics_port:
+            # the port is no longer the same, the address is not compared as it may be a host name
+            metrics_sock.close()
+            metrics_sock = None
+        metrics_server = mb.MetricsServer((metricsconf.get('address') or 'localhost', metrics_port), dispatcher,
+                                          metrics_sock)
+        metrics_server.start()
+        if handover is not None:
+            handover.metrics_server = metrics_server
+    elif metrics_sock is not None:
+        metrics_sock.close()
+
+    if handover is not None:
+        options = dict(options, handover=handover)
+
+    fanout = None
+    resumed = []
+    if inherited is not None:
+        listeners, resumed, retained_frames, _ = inherited
+        sock = listeners[0]
+        if retained is not None:
+            for frame in retained_frames:
+                retained.retain(frame)
+        # blocking or not is shared with the previous process, which may have run the other engine
+        sock.setblocking(engine != 'asyncio')
+    elif peers is not None:
+        # every worker listens on the same port, the kernel balances connections between them
+        sock = socket.create_server(listen_addr, reuse_port=True)
+        fanout = mb.WorkerFanout(dispatcher, worker_id, peers)
+    else:
+        sock = socket.create_server(listen_addr)
     # if socket.has_dualstack_ipv6():
     #     sock = socket.create_server(listen_addr, family=socket.AF_INET6, dualstack_ipv6=True)
     # else:
     #     sock = socket.create_server(listen_addr)
 
-    with sock:
-        print(f'Listening on {host}:{port}...')
-        while True:
-            try:
-                client, addr = sock.accept()
-                executor.submit(mb.handle_client,
-                                sock=client, addr=addr, dispatcher=dispatcher, keep_alive=keep_alive)
-            except ssl.SSLEOFError:
-                pass
+    if unix_sock is not None:
+        # accepted from by either engine without blocking, see _serve_threaded
+        unix_sock.setblocking(False)
+
+    if engine == 'asyncio':
+        # asyncio enables TCP_NODELAY itself and coalesces writes in the transport
+        asyncio.run(_serve_asyncio(sock, dispatcher, context, handshake_timeout, fanout, resumed=resumed,
+                                   unix_sock=unix_sock, **options))
+    else:
+        # accepted sockets are wrapped in TLS by the worker threads
+        _serve_threaded(sock, dispatcher, max_threads, connection.get('tcp_nodelay', True), context,
+                        handshake_timeout, fanout, cork=connection.get('tcp_cork', False), resumed=resumed,
+                        unix_sock=unix_sock, **options)
 
 
 if __name__ == '__main__':
@@ -1,2 +1,14 @@
-from .client_handler import handle_client
+from .client_handler import handle_client, resume_client, resume_clients
+from .async_client_handler import handle_client_async, resume_client_async, resume_clients_async
 from .message_dispatcher import MessageDispatcher
+from .inbox import OverflowPolicy
+from .message_log import MessageLog
+from .retained import RetainedStore
+from .delivery import DEFAULT_BATCH_BYTES, DEFAULT_BATCH_MESSAGES
+from .workers import WorkerFanout, run_workers
+from .metrics import Metrics, MetricsServer
+from .federation import DEFAULT_MAX_HOPS, DEFAULT_QUEUE_SIZE, Federation
+from .flow_control import FlowControl, FlowRule
+from .tls import DEFAULT_HANDSHAKE_TIMEOUT, DEFAULT_SESSION_TICKETS, handshake, handshake_async, server_context
+from .keepalive import KeepAlive, TimerWheel
+from .handover import DEFAULT_HANDOVER_TIMEOUT, HANDOVER_SIGNAL, ConnectionState, Handover, receive_handover
@@ -0,0 +1,433 @@
+import asyncio
+import logging
+import socket
+import struct
+import uuid
+from asyncio import IncompleteReadError
+from typing import Callable, Optional, Sequence, Set
+
+from .client_handler import InvalidMessageError, NETWORK_BYTEORDER, negotiate_options, validate_pattern
+from .delivery import DEFAULT_BATCH_BYTES, DEFAULT_BATCH_MESSAGES, frame_batches, frame_buffers
+from .federation import Federation
+from .frame import Frame
+from .handover import DEFAULT_HANDOVER_TIMEOUT, ConnectionState, Handover
+from .inbox import InboxOverflowError
+from .keepalive import KeepAlive
+from .message_dispatcher import MessageDispatcher, SubscriberAlreadyExistsError
+from .workers import WorkerFanout
+from ..util import hung_up, peer_address
+from ..util.compression import Codec
+from ..util.framing import AsyncStreamReader, DEFAULT_MAX_CSTRING, DEFAULT_MAX_MESSAGE, OPTION_BATCH, \
+    OPTION_FLOW_CONTROL, OPTION_RETAIN, WINDOW_COMMAND, FrameDecoder, FrameTooLargeError, MalformedFrameError, decode_batch
+
+HANGUP_POLL_INTERVAL = 1.0  # seconds between checks of a paused publisher
+
+# tasks of resumed connections, the event loop only keeps weak references to tasks
+_resumed_tasks: Set[asyncio.Task] = set()
+
+
+async def _publish(reader: AsyncStreamReader, writer: asyncio.StreamWriter, addr,
+                   dispatcher: MessageDispatcher, topic_id: str, keepalive: Optional[KeepAlive] = None,
+                   protocol: int = 1, federation: Optional[Federation] = None,
+                   peer_id: Optional[str] = None, batch: bool = False, codec: Optional[Codec] = None,
+                   window: bool = False, handover: Optional[Handover] = None, paused: bool = False,
+                   retain: bool = False, fanout: Optional[WorkerFanout] = None):
+    logger = logging.getLogger('publish,%s:%d' % addr)
+    # stopped for the handover by cancelling the task, see Handover.run_async
+    if handover is not None and not handover.enter(asyncio.current_task()):
+        logger.info('The broker is handing over its connections. Disconnecting.')
+        return
+    entry = None
+    # protocol v1 does not support NOP sent from passive peer
+    if keepalive is not None and protocol == 2:
+        entry = keepalive.register(lambda: writer.write(b'NOP'), writer.transport.abort, logger)
+    flow_control = dispatcher.flow_control
+    rule = flow_control.rule(topic_id) if topic_id is not None else None
+    detached = None
+    try:
+        if paused and window and not (rule is not None and flow_control.over_high_water(topic_id, rule)):
+            # see client_handler._publish
+            size = flow_control.window(topic_id, rule) if rule is not None else (1 << 64) - 1
+            writer.write(WINDOW_COMMAND + size.to_bytes(8, NETWORK_BYTEORDER))
+        paused = False
+        while True:
+            if rule is not None and flow_control.over_high_water(topic_id, rule):
+                # see client_handler._publish
+                logger.info(f'Subscribers of {topic_id} are behind. Pause reading.')
+                dispatcher.metrics.publisher_pauses.inc(topic_id)
+                if window:
+                    writer.write(WINDOW_COMMAND + (0).to_bytes(8, NETWORK_BYTEORDER))
+                # subscribers run on the same event loop, so the event can be set directly
+                resumed = asyncio.Event()
+                resume = resumed.set
+                flow_control.pause(topic_id, rule, resume)
+                paused = window
+                waiting = asyncio.ensure_future(resumed.wait())
+                sock = writer.get_extra_info('socket')
+                if entry is not None:
+                    # its replies to NOP are not read meanwhile
+                    keepalive.suspend(entry)
+                try:
+                    # the transport does not read meanwhile, so it does not see a client which is gone,
+                    # which is polled for instead, as is a kicked one
+                    while not (waiting.done() or writer.is_closing() or hung_up(sock)):
+                        await asyncio.wait([waiting], timeout=HANGUP_POLL_INTERVAL)
+                finally:
+                    waiting.cancel()
+                    flow_control.cancel(resume)
+                    if entry is not None:
+                        keepalive.suspend(entry, False)
+                if not resumed.is_set():
+                    logger.info('Client is gone while paused. Disconnecting.')
+                    break
+                paused = False
+                logger.info('Resume reading.')
+                if window:
+                    writer.write(WINDOW_COMMAND + flow_control.window(topic_id, rule).to_bytes(8, NETWORK_BYTEORDER))
+            logger.info('Waiting client for commands...')
+            command, message = await reader.read_command()
+            if entry is not None:
+                entry.touch()
+            if command == b'NOP':
+                logger.info('Client NOP.')
+                writer.write(b'NIL')
+                await writer.drain()
+                logger.info('Responded with NIL.')
+            elif command == b'NIL':
+                logger.info('Client NIL. Client is OK.')
+            elif command == b'BYE':
+                logger.info('Client BYE. Disconnecting.')
+                break
+            elif command == b'MSG' and topic_id is not None:
+                logger.info(f'Message length: {len(message)} byte(s).')
+                logger.info(f'Topic: {topic_id}, Message: {message}.')
+                dispatcher.publish(message, topic_id)
+            elif command == b'BAT' and topic_id is not None and batch:
+                messages = decode_batch(message)
+                logger.info(f'Batch of {len(messages)} message(s). Topic: {topic_id}.')
+                dispatcher.publish_batch(messages, topic_id)
+            elif command == b'CMP' and topic_id is not None and codec is not None:
+                dispatcher.publish(codec.decompress(message, reader.decoder.max_message), topic_id)
+            elif command == b'RET' and topic_id is not None and retain:
+                logger.info(f'Retained message length: {len(message)} byte(s). Topic: {topic_id}.')
+                dispatcher.publish(message, topic_id, retain=True)
+            elif command == b'FWD' and federation is not None:
+                federation.receive(message, peer_id)
+            else:
+                raise InvalidMessageError(f'Invalid command from client: {command!r}')
+            if fanout is not None:
+                # forwarding to the other workers does not block, wait for them before reading more
+                await fanout.drain()
+    except asyncio.CancelledError:
+        if handover is None or not handover.requested:
+            raise
+        logger.info('Stop for the handover.')
+        state = ConnectionState('FED' if federation is not None else 'PUB', addr, protocol, batch, window,
+                                codec.name if codec is not None else None, topic=topic_id, peer_id=peer_id,
+                                paused=paused, retain=retain)
+        state.writer = writer
+        detached = handover.detach(state, writer.get_extra_info('socket').fileno(), reader.take_buffered())
+    finally:
+        if entry is not None:
+            keepalive.unregister(entry)
+        if handover is not None:
+            handover.leave(asyncio.current_task(), detached)
+
+
+async def _subscribe(reader: AsyncStreamReader, writer: asyncio.StreamWriter, addr,
+                     dispatcher: MessageDispatcher, subscriber_id: Optional[int], pattern: str,
+                     keepalive: Optional[KeepAlive] = None,
+                     batch_messages: int = DEFAULT_BATCH_MESSAGES, batch_bytes: int = DEFAULT_BATCH_BYTES,
+                     batch: bool = False, codec: Optional[Codec] = None, handover: Optional[Handover] = None,
+                     pending: Sequence[Frame] = (), subscribed: Optional[Callable[[], None]] = None):
+    logger = logging.getLogger('subscribe,%s:%d' % addr)
+    if keepalive is not None:
+        logger.info(f'Keepalive is enabled. Interval is {keepalive.interval}s.')
+
+    # see client_handler._subscribe for the reason of using bytes ids
+    if subscriber_id is not None:
+        bytes_id = str(subscriber_id).encode('ascii')
+    else:
+        bytes_id = uuid.uuid1().hex.encode()
+
+    if handover is not None and not handover.enter(asyncio.current_task(), subscriber=True):
+        logger.info('The broker is handing over its connections. Disconnecting.')
+        return
+    # publishers run on the same event loop, so the inbox event can be set directly
+    inbox_ready = asyncio.Event()
+    try:
+        dispatcher.subscribe(bytes_id, pattern, notify=inbox_ready.set, history=subscriber_id is not None,
+                             codec=codec)
+    except SubscriberAlreadyExistsError:
+        if handover is not None:
+            handover.leave(asyncio.current_task())
+        raise
+    if pending:
+        dispatcher.restore(bytes_id, pending)
+    if subscribed is not None:
+        subscribed()
+    dispatcher.metrics.subscribers.inc()
+    entry = None
+    if keepalive is not None:
+        entry = keepalive.register(lambda: writer.write(b'NOP'), writer.transport.abort, logger)
+
+    async def read_commands():
+        while True:
+            command, _ = await reader.read_command()
+            if entry is not None:
+                entry.touch()
+            if command == b'NIL':
+                logger.info('Client NIL. Client is OK.')
+            elif command == b'NOP':
+                logger.info('Client NOP.')
+                writer.write(b'NIL')
+                logger.info('Responded with NIL.')
+            elif command == b'BYE':
+                logger.info('Client BYE. Disconnecting.')
+                return
+            else:
+                raise InvalidMessageError(f'Invalid command from client: {command!r}')
+
+    async def deliver():
+        while True:
+            await inbox_ready.wait()
+            inbox_ready.clear()
+            dispatcher.metrics.wakeups.inc()
+            for frames, buffers, size in frame_batches(dispatcher.read_inbox(bytes_id), batch_messages, batch_bytes):
+                logger.info(f'Send {len(frames)} message(s), {size} byte(s).')
+                if batch or codec is not None:
+                    buffers = frame_buffers(frames, batch, codec)
+                writer.writelines(buffers)
+                await writer.drain()
+                dispatcher.delivered(bytes_id, frames)
+                dispatcher.flow_control.released()
+
+    tasks = [asyncio.ensure_future(read_commands()), asyncio.ensure_future(deliver())]
+    detached = None
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    except asyncio.CancelledError:
+        if handover is None or not handover.requested:
+            raise
+        # see client_handler._subscribe, what deliver() wrote already is flushed before the handover
+        logger.info('Stop for the handover.')
+        state = ConnectionState('SUB', addr, batch=batch, codec=codec.name if codec is not None else None,
+                                pattern=pattern, subscriber_id=subscriber_id)
+        state.frames = dispatcher.pending(bytes_id)
+        state.writer = writer
+        detached = handover.detach(state, writer.get_extra_info('socket').fileno(), reader.take_buffered())
+    except InboxOverflowError:
+        logger.error('Inbox overflowed (the client is too slow). Disconnecting.')
+        writer.write(b'BYE')
+    except Exception:
+        logger.exception('An exception occurred. Disconnecting.')
+    finally:
+        for task in tasks:
+            task.cancel()
+        if entry is not None:
+            keepalive.unregister(entry)
+        dispatcher.unsubscribe(bytes_id)
+        dispatcher.metrics.subscribers.dec()
+        logger.info(f'Removed subscriber {bytes_id!r}.')
+        if handover is not None:
+            handover.leave(asyncio.current_task(), detached)
+
+
+async def handle_client_async(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                              dispatcher: MessageDispatcher, keepalive: Optional[KeepAlive] = None,
+                              batch_messages: int = DEFAULT_BATCH_MESSAGES, batch_bytes: int = DEFAULT_BATCH_BYTES,
+                              max_cstring: int = DEFAULT_MAX_CSTRING, max_message: int = DEFAULT_MAX_MESSAGE,
+                              federation: Optional[Federation] = None, codecs: Sequence[Codec] = (),
+                              handover: Optional[Handover] = None, fanout: Optional[WorkerFanout] = None):
+    """
+    Event loop counterpart of `handle_client`, serving one connection on asyncio streams.
+    """
+    addr = peer_address(writer.get_extra_info('socket'))
+    frames = AsyncStreamReader(reader, FrameDecoder(max_cstring, max_message))
+    logger = logging.getLogger('handle_client,%s:%d' % addr)
+    if writer.get_extra_info('ssl_object') is not None:
+        # see handle_client
+        handover = None
+    try:
+        logger.info('Accept inbound connection from %s:%d.' % addr)
+
+        if await frames.read_exactly(4) != b'PSMB':
+            logger.info('Bad protocol magic.')
+            return
+
+        protocol = socket.ntohl(struct.unpack('I', await frames.read_exactly(4))[0])
+        logger.info(f'Protocol version: {protocol}')
+        if protocol not in {1, 2}:
+            logger.info(f'Unsupported protocol: {protocol}')
+            writer.write(b'UNSUPPORTED PROTOCOL\0')
+            await writer.drain()
+            return
+
+        options, codec = negotiate_options(
+            int.from_bytes(await frames.read_exactly(4), NETWORK_BYTEORDER, signed=False), codecs,
+            retain=dispatcher.retained is not None)
+        batch = bool(options & OPTION_BATCH)
+        window = bool(options & OPTION_FLOW_CONTROL)
+        retain = bool(options & OPTION_RETAIN)
+        logger.info(f'Options: {options:#x}')
+
+        writer.write(b'OK\0' + options.to_bytes(4, NETWORK_BYTEORDER, signed=False))
+        await writer.drain()
+        logger.info('Complete handshaking.')
+
+        while True:
+            mode = await frames.read_exactly(3)
+            if mode == b'PUB':
+                try:
+                    topic_id = (await frames.read_cstring()).decode('ascii')
+                except UnicodeDecodeError:
+                    writer.write(b'FAILED\0' + b'Cannot decode topic id string with ASCII.\0')
+                    continue
+                writer.write(b'OK\0')
+                await writer.drain()
+                logger.info(f'Switch to PUBLISH mode. Topic is {topic_id}.')
+                dispatcher.metrics.publishers.inc()
+                try:
+                    await _publish(frames, writer, addr, dispatcher, topic_id, keepalive, protocol=protocol,
+                                   batch=batch, codec=codec, window=window, handover=handover, retain=retain,
+                                   fanout=fanout)
+                finally:
+                    dispatcher.metrics.publishers.dec()
+                break
+            elif mode == b'SUB':
+                subscribe_options = int.from_bytes(await frames.read_exactly(4), NETWORK_BYTEORDER, signed=False)
+                id_pattern_bytes = await frames.read_cstring()
+
+                # read optional subscriber_id
+                if subscribe_options & 1:
+                    subscriber_id = int.from_bytes(await frames.read_exactly(8), NETWORK_BYTEORDER, signed=False)
+                else:
+                    subscriber_id = None
+
+                try:
+                    id_pattern = id_pattern_bytes.decode('ascii')
+                except UnicodeDecodeError:
+                    writer.write(b'FAILED\0' + b'Cannot decode pattern string with ASCII.\0')
+                    continue
+                if not validate_pattern(id_pattern):
+                    writer.write(b'FAILED\0' + b'Invalid pattern string.\0')
+                    continue
+                writer.write(b'OK\0')
+                await writer.drain()
+                logger.info('Switch to SUBSCRIBE mode.')
+                if subscriber_id is not None:
+                    logger.info(f'ID is {subscriber_id}.')
+                else:
+                    logger.info('ID is not specified. Message replay is not available.')
+                await _subscribe(frames, writer, addr, dispatcher, subscriber_id, id_pattern, keepalive,
+                                 batch_messages=batch_messages, batch_bytes=batch_bytes, batch=batch,
+                                 codec=codec, handover=handover)
+                break
+            elif mode == b'FED' and federation is not None:
+                # link from another broker, see federation.FederationLink
+                peer_id = (await frames.read_cstring()).decode('ascii')
+                writer.write(b'OK\0' + federation.broker_id.encode('ascii') + b'\0')
+                await writer.drain()
+                logger.info(f'Switch to FEDERATION mode. Peer is {peer_id}.')
+                await _publish(frames, writer, addr, dispatcher, None, keepalive, protocol=protocol,
+                               federation=federation, peer_id=peer_id, handover=handover, fanout=fanout)
+                break
+            else:
+                writer.write(b'BAD COMMAND\0')
+                break
+    except SubscriberAlreadyExistsError:
+        logger.exception('Invalid client.')
+    except (ConnectionError, IOError, IncompleteReadError):
+        logger.exception('I/O error.')
+    except (FrameTooLargeError, MalformedFrameError):
+        logger.exception('Bad frame from client.')
+    except Exception:
+        logger.exception('Unexpected exception.')
+    finally:
+        writer.close()
+        logger.info('Connection is closed.')
+
+
+async def resume_client_async(state: ConnectionState, dispatcher: MessageDispatcher,
+                              keepalive: Optional[KeepAlive] = None,
+                              batch_messages: int = DEFAULT_BATCH_MESSAGES, batch_bytes: int = DEFAULT_BATCH_BYTES,
+                              max_cstring: int = DEFAULT_MAX_CSTRING, max_message: int = DEFAULT_MAX_MESSAGE,
+                              federation: Optional[Federation] = None, codecs: Sequence[Codec] = (),
+                              handover: Optional[Handover] = None, subscribed: Optional[Callable[[], None]] = None,
+                              fanout: Optional[WorkerFanout] = None):
+    """
+    Event loop counterpart of `resume_client`.
+    """
+    addr = state.addr
+    logger = logging.getLogger('resume_client,%s:%d' % addr)
+    reader, writer = await asyncio.open_connection(sock=socket.socket(fileno=state.fd))
+    frames = AsyncStreamReader(reader, FrameDecoder(max_cstring, max_message))
+    frames.decoder.feed(state.buffered)
+    codec = next((codec for codec in codecs if codec.name == state.codec), None)
+    try:
+        logger.info(f'Resume connection in {state.mode} mode.')
+        if state.codec is not None and codec is None:
+            logger.error(f'Codec {state.codec} is not offered any more. Disconnecting.')
+        elif state.mode == 'PUB':
+            dispatcher.metrics.publishers.inc()
+            try:
+                await _publish(frames, writer, addr, dispatcher, state.topic, keepalive, protocol=state.protocol,
+                               batch=state.batch, codec=codec, window=state.window, handover=handover,
+                               paused=state.paused, retain=state.retain and dispatcher.retained is not None,
+                               fanout=fanout)
+            finally:
+                dispatcher.metrics.publishers.dec()
+        elif state.mode == 'SUB':
+            await _subscribe(frames, writer, addr, dispatcher, state.subscriber_id, state.pattern, keepalive,
+                             batch_messages=batch_messages, batch_bytes=batch_bytes, batch=state.batch,
+                             codec=codec, handover=handover, pending=state.frames, subscribed=subscribed)
+        elif state.mode == 'FED' and federation is not None:
+            await _publish(frames, writer, addr, dispatcher, None, keepalive, protocol=state.protocol,
+                           federation=federation, peer_id=state.peer_id, handover=handover, fanout=fanout)
+        else:
+            logger.error(f'Cannot resume {state.mode} mode. Disconnecting.')
+    except (ConnectionError, IOError, IncompleteReadError):
+        logger.exception('I/O error.')
+    except (FrameTooLargeError, MalformedFrameError):
+        logger.exception('Bad frame from client.')
+    except Exception:
+        logger.exception('Unexpected exception.')
+    finally:
+        writer.close()
+        logger.info('Connection is closed.')
+
+
+async def resume_clients_async(states: Sequence[ConnectionState], dispatcher: MessageDispatcher,
+                               timeout: float = DEFAULT_HANDOVER_TIMEOUT, **options):
+    """
+    Event loop counterpart of `resume_clients`, resuming the connections as tasks.
+    """
+    subscribers = [state for state in states if state.mode == 'SUB']
+    subscribed = asyncio.Semaphore(0)
+    for state in subscribers:
+        _keep(asyncio.ensure_future(resume_client_async(state, dispatcher, subscribed=subscribed.release, **options)))
+
+    async def all_subscribed():
+        for _ in subscribers:
+            await subscribed.acquire()
+
+    try:
+        await asyncio.wait_for(all_subscribed(), timeout)
+    except asyncio.TimeoutError:
+        logging.getLogger('resume_clients').warning('Subscribers are not resumed in time.')
+    for state in states:
+        if state.mode != 'SUB':
+            _keep(asyncio.ensure_future(resume_client_async(state, dispatcher, **options)))
+
+
+def _keep(task: asyncio.Task):
+    _resumed_tasks.add(task)
+    task.add_done_callback(_forget)
+
+
+def _forget(task: asyncio.Task):
+    _resumed_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.getLogger('resume_clients').error('Resumed connection failed.', exc_info=task.exception())
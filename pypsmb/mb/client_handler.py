@@ -2,13 +2,26 @@ import logging
 import re
 import socket
 import struct
-import select
+import selectors
+import ssl
+import threading
+import time
 import uuid
 from asyncio import IncompleteReadError
-from typing import Literal, Optional
+from concurrent.futures import Executor
+from typing import Callable, Literal, Optional, Sequence, Tuple, Union
 
+from .delivery import DEFAULT_BATCH_BYTES, DEFAULT_BATCH_MESSAGES, frame_batches, frame_buffers
+from .federation import Federation
+from .frame import Frame
+from .handover import DEFAULT_HANDOVER_TIMEOUT, ConnectionState, Handover
+from .inbox import InboxOverflowError
+from .keepalive import KeepAlive
 from .message_dispatcher import MessageDispatcher, SubscriberAlreadyExistsError
-from ..util import read_exactly, read_cstring
+from ..util import Selector, Wakeup, send_buffers, wait_hangup, writable
+from ..util.compression import Codec, negotiate_codec
+from ..util.framing import DEFAULT_MAX_CSTRING, DEFAULT_MAX_MESSAGE, OPTION_BATCH, OPTION_FLOW_CONTROL, \
+    OPTION_RETAIN, WINDOW_COMMAND, FrameDecoder, FrameTooLargeError, MalformedFrameError, SocketReader, decode_batch
 
 NETWORK_BYTEORDER: Literal['big'] = 'big'
 
@@ -26,59 +39,181 @@ def validate_pattern(s: str):
     return True
 
 
-def _publish(sock: socket.socket, addr, dispatcher: MessageDispatcher,
-             topic_id: str, keep_alive: float, max_pending_keepalive: int = 3,
-             protocol: int = 1):
+def negotiate_options(requested: int, codecs: Sequence[Codec], retain: bool = False) -> Tuple[int, Optional[Codec]]:
+    """
+    Returns the handshake options accepted from those requested by the client, and the compression codec.
+    Unknown bits are left out of the reply, so the client knows they are not enabled, as is `RETAIN`
+    unless `retain` is set.
+    """
+    codec = negotiate_codec(requested, codecs)
+    options = requested & (OPTION_BATCH | OPTION_FLOW_CONTROL | (OPTION_RETAIN if retain else 0))
+    if codec is not None:
+        options |= codec.option
+    return options, codec
+
+
+class _Connection:
+    """
+    Sending side of a client socket, shared by its handler thread and the keepalive thread.
+    """
+
+    def __init__(self, sock: socket.socket, cork: bool = False):
+        self.sock = sock
+        self.cork = cork
+        self.lock = threading.Lock()
+        self.nop_due = False
+
+    def send(self, *buffers: Union[bytes, memoryview]):
+        with self.lock:
+            send_buffers(self.sock, list(buffers), self.cork)
+            if self.nop_due:
+                self.nop_due = False
+                self.sock.sendall(b'NOP')
+
+    def send_nop(self):
+        """
+        Called by the keepalive thread, which must not wait. If the handler thread is sending, it sends the NOP
+        after that; if the send buffer is full, the client is not reading and will miss the keepalive anyway.
+        """
+        self.nop_due = True
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            if self.nop_due and writable(self.sock):
+                self.nop_due = False
+                self.sock.sendall(b'NOP')
+        finally:
+            self.lock.release()
+
+    def kick(self):
+        # wakes up the handler thread blocked on the socket, which then closes it
+        try:
+            socket.socket.shutdown(self.sock, socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def _publish(sock: socket.socket, reader: SocketReader, addr, dispatcher: MessageDispatcher,
+             topic_id: str, keepalive: Optional[KeepAlive] = None,
+             protocol: int = 1, federation: Optional[Federation] = None,
+             peer_id: Optional[str] = None, batch: bool = False, codec: Optional[Codec] = None,
+             window: bool = False, handover: Optional[Handover] = None, paused: bool = False,
+             retain: bool = False):
     logger = logging.getLogger('publish,%s:%d' % addr)
-    pending_keepalive_count = 0  # how many continuous NOP did we sent, which is not responded by the client
-    while True:
-        logger.info('Waiting client for commands...')
-        rlist, _, _ = select.select([sock], [], [], keep_alive if (keep_alive > 0) else None)
-        if not rlist:
-            if protocol != 2:
-                # protocol v1 does not support NOP sent from passive peer
-                continue
-            # timeout, send keepalive
-            if pending_keepalive_count == max_pending_keepalive:
-                # the client is not sensible
-                # kick it
-                logger.error('Insensible client (too many pending keepalive responses). Kick it.')
+    selector = None
+    if handover is not None:
+        if not handover.enter(threading.current_thread()):
+            logger.info('The broker is handing over its connections. Disconnecting.')
+            return
+        # wait for the client or the handover, whichever comes first
+        selector = Selector()
+        selector.register(sock, selectors.EVENT_READ)
+        selector.register(handover.stop_publishers, selectors.EVENT_READ)
+    connection = _Connection(sock)
+    entry = None
+    # protocol v1 does not support NOP sent from passive peer
+    if keepalive is not None and protocol == 2:
+        entry = keepalive.register(connection.send_nop, connection.kick, logger)
+    flow_control = dispatcher.flow_control
+    rule = flow_control.rule(topic_id) if topic_id is not None else None
+    detached = None
+
+    def detach(paused: bool) -> ConnectionState:
+        logger.info('Stop for the handover.')
+        state = ConnectionState('FED' if federation is not None else 'PUB', addr, protocol, batch, window,
+                                codec.name if codec is not None else None, topic=topic_id, peer_id=peer_id,
+                                paused=paused, retain=retain)
+        return handover.detach(state, sock.fileno(), reader.take_buffered())
+
+    try:
+        if paused and window and not (rule is not None and flow_control.over_high_water(topic_id, rule)):
+            # paused by the broker process this connection was handed over from, with no rule any more if
+            # the config changed
+            size = flow_control.window(topic_id, rule) if rule is not None else (1 << 64) - 1
+            connection.send(WINDOW_COMMAND + size.to_bytes(8, NETWORK_BYTEORDER))
+        while True:
+            if handover is not None and handover.requested:
+                detached = detach(paused=False)
                 break
-            logger.info('Send NOP. (keepalive)')
-            sock.sendall(b'NOP')
-            logger.info('NOP is sent.')
-            pending_keepalive_count += 1
-            continue
-        command = read_exactly(sock, 3)
-        if command == b'NOP':
-            logger.info('Client NOP.')
-            sock.sendall(b'NIL')
-            logger.info('Responded with NIL.')
-        elif command == b'NIL':
-            logger.info('Client NIL. Client is OK.')
-            pending_keepalive_count = 0
-            pass
-        elif command == b'BYE':
-            logger.info('Client BYE. Disconnecting.')
-            break
-        elif command == b'MSG':
-            logger.info('Receiving new message from client...')
-            message_length = int.from_bytes(read_exactly(sock, 8), NETWORK_BYTEORDER, signed=False)
-            logger.info(f'Message length: {message_length} byte(s).')
-            message = read_exactly(sock, message_length)
-            logger.info(f'Topic: {topic_id}, Message: {message}.')
-            dispatcher.publish(message, topic_id)
-        else:
-            raise InvalidMessageError(f'Invalid command from client: {command!r}')
+            if rule is not None and flow_control.over_high_water(topic_id, rule):
+                # stop reading until the subscribers catch up, TCP pushes back on the client meanwhile
+                logger.info(f'Subscribers of {topic_id} are behind. Pause reading.')
+                dispatcher.metrics.publisher_pauses.inc(topic_id)
+                if window:
+                    connection.send(WINDOW_COMMAND + (0).to_bytes(8, NETWORK_BYTEORDER))
+                resumed = Wakeup()
+                resume = resumed.set
+                flow_control.pause(topic_id, rule, resume)
+                if entry is not None:
+                    # its replies to NOP are not read meanwhile
+                    keepalive.suspend(entry)
+                try:
+                    # wakes up if the client is gone meanwhile, or kicked
+                    gone = wait_hangup(sock, resumed.fileno())
+                finally:
+                    flow_control.cancel(resume)
+                    resumed.close()
+                    if entry is not None:
+                        keepalive.suspend(entry, False)
+                if gone:
+                    logger.info('Client is gone while paused. Disconnecting.')
+                    break
+                if handover is not None and handover.requested:
+                    detached = detach(paused=window)
+                    break
+                logger.info('Resume reading.')
+                if window:
+                    connection.send(WINDOW_COMMAND + flow_control.window(topic_id, rule).to_bytes(8, NETWORK_BYTEORDER))
+            logger.info('Waiting client for commands...')
+            if selector is not None and not reader.buffered:
+                selector.select()
+                if handover.requested:
+                    continue
+            command, message = reader.read_command()
+            if entry is not None:
+                entry.touch()
+            if command == b'NOP':
+                logger.info('Client NOP.')
+                connection.send(b'NIL')
+                logger.info('Responded with NIL.')
+            elif command == b'NIL':
+                logger.info('Client NIL. Client is OK.')
+            elif command == b'BYE':
+                logger.info('Client BYE. Disconnecting.')
+                break
+            elif command == b'MSG' and topic_id is not None:
+                logger.info(f'Message length: {len(message)} byte(s).')
+                logger.info(f'Topic: {topic_id}, Message: {message}.')
+                dispatcher.publish(message, topic_id)
+            elif command == b'BAT' and topic_id is not None and batch:
+                messages = decode_batch(message)
+                logger.info(f'Batch of {len(messages)} message(s). Topic: {topic_id}.')
+                dispatcher.publish_batch(messages, topic_id)
+            elif command == b'CMP' and topic_id is not None and codec is not None:
+                dispatcher.publish(codec.decompress(message, reader.decoder.max_message), topic_id)
+            elif command == b'RET' and topic_id is not None and retain:
+                logger.info(f'Retained message length: {len(message)} byte(s). Topic: {topic_id}.')
+                dispatcher.publish(message, topic_id, retain=True)
+            elif command == b'FWD' and federation is not None:
+                federation.receive(message, peer_id)
+            else:
+                raise InvalidMessageError(f'Invalid command from client: {command!r}')
+    finally:
+        if entry is not None:
+            keepalive.unregister(entry)
+        if handover is not None:
+            selector.close()
+            handover.leave(threading.current_thread(), detached)
 
 
-def _subscribe(sock: socket.socket, addr, dispatcher: MessageDispatcher, subscriber_id: Optional[int], pattern: str,
-               keep_alive: float, max_pending_keepalive: int = 3):
+def _subscribe(sock: socket.socket, reader: SocketReader, addr, dispatcher: MessageDispatcher, subscriber_id: Optional[int], pattern: str,
+               keepalive: Optional[KeepAlive] = None, batch_messages: int = DEFAULT_BATCH_MESSAGES,
+               batch_bytes: int = DEFAULT_BATCH_BYTES, cork: bool = False, batch: bool = False,
+               codec: Optional[Codec] = None, handover: Optional[Handover] = None, pending: Sequence[Frame] = (),
+               subscribed: Optional[Callable[[], None]] = None):
     logger = logging.getLogger('subscribe,%s:%d' % addr)
-    if keep_alive > 0:
-        # sock.settimeout(keep_alive)
-        logger.info(
-            f'Keepalive is enabled. Set socket timeout to {keep_alive}s.')
+    if keepalive is not None:
+        logger.info(f'Keepalive is enabled. Interval is {keepalive.interval}s.')
 
     # instead of the original int64 id, we use arbitrary bytes to distinguish different clients in the internal
     # thus we can generate unique UUIDs for subscribers with id unspecified, simplifying our implementation
@@ -88,100 +223,148 @@ def _subscribe(sock: socket.socket, addr, dispatcher: MessageDispatcher, subscri
         # generate a unique id for subscribers who do not have id
         bytes_id = uuid.uuid1().hex.encode()
 
-    rsock = dispatcher.subscribe(bytes_id, pattern)
-    pending_keepalive_count = 0  # how many continuous NOP did we sent, which is not responded by the client
+    if handover is not None and not handover.enter(threading.current_thread(), subscriber=True):
+        logger.info('The broker is handing over its connections. Disconnecting.')
+        return
+    try:
+        wakeup = dispatcher.subscribe(bytes_id, pattern, history=subscriber_id is not None, codec=codec)
+    except SubscriberAlreadyExistsError:
+        if handover is not None:
+            handover.leave(threading.current_thread())
+        raise
+    if pending:
+        dispatcher.restore(bytes_id, pending)
+    if subscribed is not None:
+        subscribed()
+    dispatcher.metrics.subscribers.inc()
+    connection = _Connection(sock, cork)
+    entry = keepalive.register(connection.send_nop, connection.kick, logger) if keepalive is not None else None
+    selector = Selector()
+    selector.register(sock, selectors.EVENT_READ)
+    selector.register(wakeup, selectors.EVENT_READ)
+    if handover is not None:
+        selector.register(handover.stop_subscribers, selectors.EVENT_READ)
+    detached = None
     try:
         while True:
-            rlist, _, _ = select.select([sock, rsock], [], [], keep_alive if (keep_alive > 0) else None)
-            if not rlist:
-                # timeout
-                # send keep-alive
-                if pending_keepalive_count == max_pending_keepalive:
-                    # the client is not sensible
-                    # kick it
-                    logger.error('Insensible client (too many pending keepalive responses). Kick it.')
-                    break
-                logger.info('Send NOP. (keepalive)')
-                sock.sendall(b'NOP')
-                logger.info('NOP is sent.')
-                pending_keepalive_count += 1
-                continue
+            if not reader.buffered:
+                rlist = [key.fileobj for key, _ in selector.select()]
+            else:
+                rlist = [sock]
             for ready_sock in rlist:
                 if ready_sock is sock:
                     # the client is ready
-                    command = read_exactly(sock, 3)
+                    command, _ = reader.read_command()
+                    if entry is not None:
+                        entry.touch()
                     if command == b'NIL':
                         logger.info('Client NIL. Client is OK.')
-                        pending_keepalive_count = 0
                     elif command == b'NOP':
                         logger.info('Client NOP.')
-                        sock.sendall(b'NIL')
+                        connection.send(b'NIL')
                         logger.info('Responded with NIL.')
                     elif command == b'BYE':
                         logger.info('Client BYE. Disconnecting.')
                         return
                     else:
                         raise InvalidMessageError(f'Invalid command from client: {command!r}')
+                elif ready_sock is not wakeup:
+                    # publishers are stopped already, so the pending messages are complete
+                    logger.info('Stop for the handover.')
+                    state = ConnectionState('SUB', addr, batch=batch, codec=codec.name if codec is not None else None,
+                                            pattern=pattern, subscriber_id=subscriber_id)
+                    state.frames = dispatcher.pending(bytes_id)
+                    detached = handover.detach(state, sock.fileno(), reader.take_buffered())
+                    return
                 else:
-                    # messages are ready
-                    rsock.recv(1)  # read out the mark, this should complete immediately
-                    for message, topic in dispatcher.read_inbox(bytes_id):
-                        logger.info(
-                            f'Message size: {len(message)}, topic: {topic}')
-                        sock.sendall(b'MSG')
-                        sock.sendall(len(message).to_bytes(8, NETWORK_BYTEORDER, signed=False))
-                        sock.sendall(message)
+                    # messages are ready, clear before draining so that a message put meanwhile sets it again
+                    wakeup.clear()
+                    dispatcher.metrics.wakeups.inc()
+                    for frames, buffers, size in frame_batches(dispatcher.read_inbox(bytes_id),
+                                                               batch_messages, batch_bytes):
+                        logger.info(f'Send {len(frames)} message(s), {size} byte(s).')
+                        if batch or codec is not None:
+                            buffers = frame_buffers(frames, batch, codec)
+                        connection.send(*buffers)
+                        dispatcher.delivered(bytes_id, frames)
+                        dispatcher.flow_control.released()
+    except InboxOverflowError:
+        logger.error('Inbox overflowed (the client is too slow). Disconnecting.')
+        connection.send(b'BYE')
     except Exception:
         logger.exception('An exception occurred. Disconnecting.')
     finally:
+        if entry is not None:
+            keepalive.unregister(entry)
+        selector.close()
         dispatcher.unsubscribe(bytes_id)
-        rsock.close()
+        dispatcher.metrics.subscribers.dec()
         logger.info(f'Removed subscriber {bytes_id!r}.')
+        if handover is not None:
+            # last, the cursor of the subscriber is saved by now
+            handover.leave(threading.current_thread(), detached)
 
 
-def handle_client(sock: socket.socket, addr, dispatcher: MessageDispatcher, keep_alive: float):
+def handle_client(sock: socket.socket, addr, dispatcher: MessageDispatcher, keepalive: Optional[KeepAlive] = None,
+                  batch_messages: int = DEFAULT_BATCH_MESSAGES, batch_bytes: int = DEFAULT_BATCH_BYTES,
+                  cork: bool = False, max_cstring: int = DEFAULT_MAX_CSTRING,
+                  max_message: int = DEFAULT_MAX_MESSAGE,
+                  federation: Optional[Federation] = None, codecs: Sequence[Codec] = (),
+                  handover: Optional[Handover] = None):
     logger = logging.getLogger('handle_client,%s:%d' % addr)
+    reader = SocketReader(sock, FrameDecoder(max_cstring, max_message))
+    if isinstance(sock, ssl.SSLSocket):
+        # the TLS state cannot be handed over, the client reconnects instead
+        handover = None
     try:
         logger.info('Accept inbound connection from %s:%d.' % addr)
 
-        if read_exactly(sock, 4) != b'PSMB':
+        if reader.read_exactly(4) != b'PSMB':
             logger.info('Bad protocol magic.')
             return
 
-        protocol = socket.ntohl(struct.unpack('I', read_exactly(sock, 4))[0])
+        protocol = socket.ntohl(struct.unpack('I', reader.read_exactly(4))[0])
         logger.info(f'Protocol version: {protocol}')
         if protocol not in {1, 2}:
             logger.info(f'Unsupported protocol: {protocol}')
             sock.sendall(b'UNSUPPORTED PROTOCOL\0')
             return
 
-        options = read_exactly(sock, 4)
-        if options != b'\x00\x00\x00\x00':
-            logger.info(f'Bad options: {options!r}')
-            return
+        options, codec = negotiate_options(
+            int.from_bytes(reader.read_exactly(4), NETWORK_BYTEORDER, signed=False), codecs,
+            retain=dispatcher.retained is not None)
+        batch = bool(options & OPTION_BATCH)
+        window = bool(options & OPTION_FLOW_CONTROL)
+        retain = bool(options & OPTION_RETAIN)
+        logger.info(f'Options: {options:#x}')
 
-        sock.sendall(b'OK\0\x00\x00\x00\x00')
+        sock.sendall(b'OK\0' + options.to_bytes(4, NETWORK_BYTEORDER, signed=False))
         logger.info('Complete handshaking.')
 
         while True:
-            mode = read_exactly(sock, 3)
+            mode = reader.read_exactly(3)
             if mode == b'PUB':
                 try:
-                    topic_id = read_cstring(sock).decode('ascii')
+                    topic_id = reader.read_cstring().decode('ascii')
                 except UnicodeDecodeError:
                     sock.sendall(b'FAILED\0' + b'Cannot decode topic id string with ASCII.\0')
                     continue
                 sock.sendall(b'OK\0')
                 logger.info(f'Switch to PUBLISH mode. Topic is {topic_id}.')
-                _publish(sock, addr, dispatcher, topic_id, keep_alive, protocol=protocol)
+                dispatcher.metrics.publishers.inc()
+                try:
+                    _publish(sock, reader, addr, dispatcher, topic_id, keepalive, protocol=protocol, batch=batch,
+                             codec=codec, window=window, handover=handover, retain=retain)
+                finally:
+                    dispatcher.metrics.publishers.dec()
                 break
             elif mode == b'SUB':
-                subscribe_options = int.from_bytes(read_exactly(sock, 4), NETWORK_BYTEORDER, signed=False)
-                id_pattern_bytes = read_cstring(sock)
+                subscribe_options = int.from_bytes(reader.read_exactly(4), NETWORK_BYTEORDER, signed=False)
+                id_pattern_bytes = reader.read_cstring()
 
                 # read optional subscriber_id
                 if subscribe_options & 1:
-                    subscriber_id = int.from_bytes(read_exactly(sock, 8), NETWORK_BYTEORDER, signed=False)
+                    subscriber_id = int.from_bytes(reader.read_exactly(8), NETWORK_BYTEORDER, signed=False)
                 else:
                     subscriber_id = None
 
@@ -194,22 +377,102 @@ def handle_client(sock: socket.socket, addr, dispatcher: MessageDispatcher, keep
                     sock.sendall(b'FAILED\0' + b'Invalid pattern string.\0')
                     continue
                 sock.sendall(b'OK\0')
-                logger.info(f'Switch to SUBSCRIBE mode.')
+                logger.info('Switch to SUBSCRIBE mode.')
                 if subscriber_id is not None:
                     logger.info(f'ID is {subscriber_id}.')
                 else:
                     logger.info('ID is not specified. Message replay is not available.')
-                _subscribe(sock, addr, dispatcher, subscriber_id, id_pattern, keep_alive)
+                _subscribe(sock, reader, addr, dispatcher, subscriber_id, id_pattern, keepalive,
+                           batch_messages=batch_messages, batch_bytes=batch_bytes, cork=cork, batch=batch,
+                           codec=codec, handover=handover)
+                break
+            elif mode == b'FED' and federation is not None:
+                # link from another broker, see federation.FederationLink
+                peer_id = reader.read_cstring().decode('ascii')
+                sock.sendall(b'OK\0' + federation.broker_id.encode('ascii') + b'\0')
+                logger.info(f'Switch to FEDERATION mode. Peer is {peer_id}.')
+                _publish(sock, reader, addr, dispatcher, None, keepalive, protocol=protocol,
+                         federation=federation, peer_id=peer_id, handover=handover)
                 break
             else:
                 sock.sendall(b'BAD COMMAND\0')
                 break
     except SubscriberAlreadyExistsError:
-        logger.exception(f'Invalid client.')
+        logger.exception('Invalid client.')
     except (ConnectionError, IOError, IncompleteReadError):
         logger.exception('I/O error.')
+    except (FrameTooLargeError, MalformedFrameError):
+        logger.exception('Bad frame from client.')
     except Exception:
         logger.exception('Unexpected exception.')
     finally:
         sock.close()
         logger.info('Connection is closed.')
+
+
+def resume_client(state: ConnectionState, dispatcher: MessageDispatcher, keepalive: Optional[KeepAlive] = None,
+                  batch_messages: int = DEFAULT_BATCH_MESSAGES, batch_bytes: int = DEFAULT_BATCH_BYTES,
+                  cork: bool = False, max_cstring: int = DEFAULT_MAX_CSTRING,
+                  max_message: int = DEFAULT_MAX_MESSAGE,
+                  federation: Optional[Federation] = None, codecs: Sequence[Codec] = (),
+                  handover: Optional[Handover] = None, subscribed: Optional[Callable[[], None]] = None):
+    """
+    Serve a connection handed over by the previous broker process, carrying on in the mode it was in.
+    """
+    addr = state.addr
+    logger = logging.getLogger('resume_client,%s:%d' % addr)
+    sock = socket.socket(fileno=state.fd)
+    sock.setblocking(True)
+    reader = SocketReader(sock, FrameDecoder(max_cstring, max_message))
+    reader.decoder.feed(state.buffered)
+    codec = next((codec for codec in codecs if codec.name == state.codec), None)
+    try:
+        logger.info(f'Resume connection in {state.mode} mode.')
+        if state.codec is not None and codec is None:
+            logger.error(f'Codec {state.codec} is not offered any more. Disconnecting.')
+        elif state.mode == 'PUB':
+            dispatcher.metrics.publishers.inc()
+            try:
+                _publish(sock, reader, addr, dispatcher, state.topic, keepalive, protocol=state.protocol,
+                         batch=state.batch, codec=codec, window=state.window, handover=handover,
+                         paused=state.paused, retain=state.retain and dispatcher.retained is not None)
+            finally:
+                dispatcher.metrics.publishers.dec()
+        elif state.mode == 'SUB':
+            _subscribe(sock, reader, addr, dispatcher, state.subscriber_id, state.pattern, keepalive,
+                       batch_messages=batch_messages, batch_bytes=batch_bytes, cork=cork, batch=state.batch,
+                       codec=codec, handover=handover, pending=state.frames, subscribed=subscribed)
+        elif state.mode == 'FED' and federation is not None:
+            _publish(sock, reader, addr, dispatcher, None, keepalive, protocol=state.protocol,
+                     federation=federation, peer_id=state.peer_id, handover=handover)
+        else:
+            logger.error(f'Cannot resume {state.mode} mode. Disconnecting.')
+    except (ConnectionError, IOError, IncompleteReadError):
+        logger.exception('I/O error.')
+    except (FrameTooLargeError, MalformedFrameError):
+        logger.exception('Bad frame from client.')
+    except Exception:
+        logger.exception('Unexpected exception.')
+    finally:
+        sock.close()
+        logger.info('Connection is closed.')
+
+
+def resume_clients(executor: Executor, states: Sequence[ConnectionState], dispatcher: MessageDispatcher,
+                   timeout: float = DEFAULT_HANDOVER_TIMEOUT, **options):
+    """
+    Resume the connections handed over by the previous broker process on an executor. Publishers are resumed
+    once the subscribers are subscribed again (or `timeout` seconds passed), so that they miss nothing.
+    """
+    subscribed = threading.Semaphore(0)
+    subscribers = [state for state in states if state.mode == 'SUB']
+    for state in subscribers:
+        executor.submit(resume_client, state, dispatcher, subscribed=subscribed.release, **options)
+    deadline = time.monotonic() + timeout
+    for _ in subscribers:
+        if not subscribed.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            logging.getLogger('resume_clients').warning('Subscribers are not resumed in time.')
+            break
+    for state in states:
+        if state.mode != 'SUB':
+            executor.submit(resume_client, state, dispatcher, **options)
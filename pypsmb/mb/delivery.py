@@ -0,0 +1,61 @@
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+from .frame import Frame
+from ..util.compression import Codec
+from ..util.framing import encode_batch
+
+DEFAULT_BATCH_MESSAGES = 256
+DEFAULT_BATCH_BYTES = 256 * 1024
+
+
+def frame_batches(frames: Iterable[Frame], max_messages: int = DEFAULT_BATCH_MESSAGES,
+                  max_bytes: int = DEFAULT_BATCH_BYTES) -> Iterator[Tuple[List[Frame], List[bytes], int]]:
+    """
+    Group frames into batches, each to be written with a single flush.
+    Yields (frames, buffers, byte count) of each batch. Frames are not copied.
+    """
+    batch = []
+    buffers = []
+    size = 0
+    for frame in frames:
+        batch.append(frame)
+        buffers.append(frame.data)
+        size += len(frame.data)
+        if len(batch) >= max_messages or size >= max_bytes:
+            yield batch, buffers, size
+            batch = []
+            buffers = []
+            size = 0
+    if batch:
+        yield batch, buffers, size
+
+
+def frame_buffers(frames: List[Frame], batch: bool = False,
+                  codec: Optional[Codec] = None) -> List[Union[bytes, memoryview]]:
+    """
+    Wire buffers of frames for a subscriber which negotiated `BAT` frames and/or compression.
+    Compressed frames are sent as `CMP`, runs of other frames as one `BAT` if enabled, keeping the order.
+    """
+    if codec is None:
+        if batch and len(frames) > 1:
+            return [encode_batch(frame.payload for frame in frames)]
+        return [frame.data for frame in frames]
+    buffers = []
+    plain = []
+
+    def flush():
+        if batch and len(plain) > 1:
+            buffers.append(encode_batch(frame.payload for frame in plain))
+        else:
+            buffers.extend(frame.data for frame in plain)
+        plain.clear()
+
+    for frame in frames:
+        compressed = frame.compress(codec)
+        if compressed is None:
+            plain.append(frame)
+        else:
+            flush()
+            buffers.append(compressed)
+    flush()
+    return buffers
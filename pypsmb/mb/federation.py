@@ -0,0 +1,229 @@
+import collections
+import logging
+import queue
+import re
+import select
+import socket
+import ssl
+import struct
+import threading
+import time
+import uuid
+from typing import Any, List, Optional, Tuple
+
+from .frame import Frame, NETWORK_BYTEORDER
+from .message_dispatcher import MessageDispatcher
+from .workers import ORIGIN_WORKER
+from ..util import send_buffers
+from ..util.framing import SocketReader
+
+FORWARD_COMMAND = b'FWD'
+# after "FWD" and the uint64 length: topic cstring, origin cstring, uint64 sequence number, uint8 hops, payload
+_SEQ_HOPS = struct.Struct('>QB')
+
+# 1 suits a full mesh. More hops let messages cross brokers which are not linked directly, but when a message
+# can take several paths, copies are dropped by deduplication and the order from one publisher is not kept
+DEFAULT_MAX_HOPS = 1
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_DEDUP_SIZE = 65536
+RECONNECT_DELAYS = (1, 2, 5, 10, 30)
+CONNECT_TIMEOUT = 10  # seconds to connect and handshake, so that an unreachable peer does not stall the link
+
+
+class FederationError(Exception):
+    pass
+
+
+class FederatedOrigin:
+    """
+    Origin of a message received from another broker.
+    """
+    __slots__ = ('origin', 'seq', 'hops', 'via')
+
+    def __init__(self, origin: str, seq: int, hops: int, via: str):
+        self.origin = origin  # `broker_id/incarnation` of the broker the message was published on
+        self.seq = seq  # sequence number of the message on the origin broker
+        self.hops = hops  # how many links the message has passed
+        self.via = via  # id of the broker it was received from
+
+    @property
+    def broker_id(self) -> str:
+        return self.origin.split('/', 1)[0]
+
+
+def decode_forward(body: bytes, via: str):
+    """
+    Returns (topic, FederatedOrigin, payload) of the body of a `FWD` frame.
+    """
+    topic_end = body.index(b'\0')
+    origin_end = body.index(b'\0', topic_end + 1)
+    seq, hops = _SEQ_HOPS.unpack_from(body, origin_end + 1)
+    payload = body[origin_end + 1 + _SEQ_HOPS.size:]
+    return body[:topic_end].decode('ascii'), \
+        FederatedOrigin(body[topic_end + 1:origin_end].decode('ascii'), seq, hops, via), payload
+
+
+class FederationLink(threading.Thread):
+    """
+    Persistent outbound link to a peer broker, forwarding the frames queued for it.
+    Reconnects with backoff when the link breaks; frames queued meanwhile are kept up to the queue size.
+    """
+
+    def __init__(self, federation: 'Federation', address: str, port: int, topics: str = '.*',
+                 use_ssl: bool = False, queue_size: int = DEFAULT_QUEUE_SIZE):
+        super().__init__(name=f'FederationLink-{address}:{port}', daemon=True)
+        self.federation = federation
+        self.address = address
+        self.port = port
+        self.topics = re.compile(topics)
+        self.use_ssl = use_ssl
+        self.peer_id: Optional[str] = None  # known after the first handshake
+        self.queue: 'queue.Queue[List[bytes]]' = queue.Queue(queue_size)
+        self.dropped = 0
+        self.logger = logging.getLogger(f'federation,{address}:{port}')
+
+    def offer(self, buffers: List[bytes]):
+        try:
+            self.queue.put_nowait(buffers)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped & (self.dropped - 1) == 0:
+                self.logger.warning(f'Peer is too slow, {self.dropped} message(s) dropped so far.')
+
+    def _connect(self) -> Tuple[socket.socket, SocketReader]:
+        sock = socket.create_connection((self.address, self.port), timeout=CONNECT_TIMEOUT)
+        try:
+            if self.use_ssl:
+                sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.address)
+            reader = self._handshake(sock)
+        except BaseException:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return sock, reader
+
+    def _handshake(self, sock: socket.socket) -> SocketReader:
+        reader = SocketReader(sock)
+        sock.sendall(b'PSMB' + (2).to_bytes(4, NETWORK_BYTEORDER) + b'\0\0\0\0')
+        if reader.read_cstring() != b'OK':
+            raise FederationError('Peer refused the handshake')
+        reader.read_exactly(4)  # options
+        sock.sendall(b'FED' + self.federation.broker_id.encode('ascii') + b'\0')
+        if reader.read_cstring() != b'OK':
+            raise FederationError('Peer does not accept federation links')
+        self.peer_id = reader.read_cstring().decode('ascii')
+        return reader
+
+    def run(self):
+        attempt = 0
+        while True:
+            try:
+                sock, reader = self._connect()
+            except (OSError, FederationError, EOFError):
+                delay = RECONNECT_DELAYS[min(attempt, len(RECONNECT_DELAYS) - 1)]
+                self.logger.warning(f'Cannot connect to peer, retry in {delay}s.', exc_info=True)
+                attempt += 1
+                time.sleep(delay)
+                continue
+            attempt = 0
+            self.logger.info(f'Linked to broker {self.peer_id}.')
+            try:
+                with sock:
+                    self._pump(sock, reader)
+            except (OSError, EOFError):
+                self.logger.exception('Link is broken.')
+
+    def _pump(self, sock: socket.socket, reader: SocketReader):
+        keep_alive = self.federation.keep_alive
+        while True:
+            try:
+                buffers = self.queue.get(timeout=keep_alive if keep_alive > 0 else None)
+            except queue.Empty:
+                sock.sendall(b'NOP')
+                buffers = None
+            # answer keepalive of the peer, the link never receives anything else
+            while reader.buffered or select.select([sock], [], [], 0)[0]:
+                command, _ = reader.read_command()
+                if command == b'NOP':
+                    sock.sendall(b'NIL')
+            if buffers is not None:
+                send_buffers(sock, buffers)
+
+
+class Federation:
+    """
+    Forwards messages between brokers. Each peer gets the locally published messages whose topic matches
+    the pattern configured for it, and messages received from other brokers unless they have passed
+    `max_hops` links. Every message carries the id of its origin broker and a sequence number, so that
+    copies arriving over different paths, or coming back to the origin, are dropped.
+    """
+
+    def __init__(self, dispatcher: MessageDispatcher, broker_id: str, max_hops: int = DEFAULT_MAX_HOPS,
+                 keep_alive: float = -1, dedup_size: int = DEFAULT_DEDUP_SIZE):
+        self.dispatcher = dispatcher
+        self.broker_id = broker_id
+        # a restarted broker starts over its sequence numbers, so it must not look like the old one
+        self.origin = f'{broker_id}/{uuid.uuid4().hex[:8]}'
+        self.max_hops = max_hops
+        self.keep_alive = keep_alive
+        self.links: List[FederationLink] = []
+        self._seq = 0
+        self._seen = collections.OrderedDict()
+        self._dedup_size = dedup_size
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(type(self).__name__)
+        dispatcher.forwarders.append(self.forward)
+
+    def add_peer(self, address: str, port: int, topics: str = '.*', use_ssl: bool = False,
+                 queue_size: int = DEFAULT_QUEUE_SIZE):
+        self.links.append(FederationLink(self, address, port, topics, use_ssl, queue_size))
+
+    def start(self):
+        for link in self.links:
+            link.start()
+
+    def _remember(self, origin: str, seq: int) -> bool:
+        """
+        Returns False if the message was seen before.
+        """
+        key = origin, seq
+        with self._lock:
+            if key in self._seen:
+                return False
+            self._seen[key] = None
+            if len(self._seen) > self._dedup_size:
+                self._seen.popitem(last=False)
+            return True
+
+    def forward(self, frame: Frame, origin: Any):
+        if origin is ORIGIN_WORKER:
+            return  # the worker which received it forwards it
+        if isinstance(origin, FederatedOrigin):
+            if origin.hops >= self.max_hops:
+                return
+            origin_id, seq, hops = origin.origin, origin.seq, origin.hops + 1
+            skip = {origin.broker_id, origin.via}
+        else:
+            with self._lock:
+                self._seq += 1
+                seq = self._seq
+            origin_id, hops, skip = self.origin, 1, ()
+        links = [link for link in self.links if link.peer_id not in skip and link.topics.fullmatch(frame.topic)]
+        if not links:
+            return
+        payload = frame.payload
+        header = frame.topic.encode('ascii') + b'\0' + origin_id.encode('ascii') + b'\0' + \
+            _SEQ_HOPS.pack(seq, hops)
+        buffers = [FORWARD_COMMAND + (len(header) + len(payload)).to_bytes(8, NETWORK_BYTEORDER), header, payload]
+        for link in links:
+            link.offer(buffers)
+
+    def receive(self, body: bytes, via: str):
+        """
+        Publish the body of a `FWD` frame received from broker `via`, unless it is a duplicate.
+        """
+        topic, origin, payload = decode_forward(body, via)
+        if origin.broker_id == self.broker_id or not self._remember(origin.origin, origin.seq):
+            self.logger.debug(f'Drop duplicate {origin.origin}#{origin.seq} from {via}.')
+            return
+        self.dispatcher.publish(payload, topic, origin=origin)
@@ -0,0 +1,100 @@
+import re
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+
+class FlowRule:
+    """
+    Water marks of the backlog of topics matching `pattern`, that is the bytes pending in the inbox
+    of the slowest subscriber of a topic. A publisher of the topic is no longer read from once the backlog
+    is over `high_water`, until it falls to `low_water` (half of `high_water` if negative).
+    """
+
+    def __init__(self, pattern: str, high_water: int, low_water: int = -1):
+        self.pattern = re.compile(pattern)
+        self.high_water = high_water
+        self.low_water = low_water if low_water >= 0 else high_water // 2
+        if self.low_water > self.high_water:
+            raise ValueError(f'Low-water mark {low_water} is over the high-water mark {high_water}')
+
+
+class FlowControl:
+    """
+    Pauses publishers while subscribers of their topic are behind. The connection handlers stop reading
+    from a paused publisher, so it is pushed back by TCP; those which enabled the option are also told
+    with a `WIN` frame. Topics without a rule are never paused.
+    """
+
+    def __init__(self, backlog: Callable[[str], int], rules: Sequence[FlowRule] = ()):
+        self.backlog = backlog  # topic -> bytes pending for its slowest subscriber
+        self.rules = list(rules)
+        self._rule_cache: Dict[str, Optional[FlowRule]] = {}
+        # paused publishers: (topic, rule, resume)
+        self._waiters: List[Tuple[str, FlowRule, Callable[[], None]]] = []
+        self._lock = threading.Lock()
+
+    def rule(self, topic: str) -> Optional[FlowRule]:
+        """
+        The first rule matching a topic, if any.
+        """
+        try:
+            return self._rule_cache[topic]
+        except KeyError:
+            pass
+        rule = next((rule for rule in self.rules if rule.pattern.fullmatch(topic)), None)
+        self._rule_cache[topic] = rule
+        return rule
+
+    def over_high_water(self, topic: str, rule: FlowRule) -> bool:
+        return self.backlog(topic) > rule.high_water
+
+    def pause(self, topic: str, rule: FlowRule, resume: Callable[[], None]):
+        """
+        Register a publisher to be resumed once the backlog of `topic` is down to the low-water mark.
+        `resume` is called exactly once, possibly right away and possibly from another thread.
+        """
+        with self._lock:
+            # checked under the lock, so that a drain racing with this is not missed
+            if self.backlog(topic) <= rule.low_water:
+                resume()
+                return
+            self._waiters.append((topic, rule, resume))
+
+    def cancel(self, resume: Callable[[], None]):
+        """
+        Forget a paused publisher which stopped waiting for `resume` before it was called, because its client
+        is gone.
+        """
+        with self._lock:
+            self._waiters = [waiter for waiter in self._waiters if waiter[2] is not resume]
+
+    def released(self):
+        """
+        Called when inboxes get smaller, resumes the publishers whose backlog is low enough.
+        """
+        if not self._waiters:
+            return
+        with self._lock:
+            waiting = []
+            for waiter in self._waiters:
+                topic, rule, resume = waiter
+                if self.backlog(topic) <= rule.low_water:
+                    resume()
+                else:
+                    waiting.append(waiter)
+            self._waiters = waiting
+
+    def resume_all(self):
+        """
+        Resume every paused publisher whatever the backlog, when the broker hands over its connections.
+        """
+        with self._lock:
+            for _, _, resume in self._waiters:
+                resume()
+            self._waiters = []
+
+    def window(self, topic: str, rule: FlowRule) -> int:
+        """
+        Bytes a publisher of `topic` may send before it reaches the high-water mark.
+        """
+        return max(rule.high_water - self.backlog(topic), 0)
@@ -0,0 +1,43 @@
+import time
+from typing import Dict, Literal, Optional, Union
+
+from ..util.compression import Codec
+
+NETWORK_BYTEORDER: Literal['big'] = 'big'
+MSG_HEADER_SIZE = 11  # "MSG" + uint64 message length
+
+
+class Frame:
+    """
+    A published message, serialized once into its `MSG` wire frame.
+    The same instance is shared by the inboxes of all matching subscribers and written to their sockets as is.
+    """
+    __slots__ = ('topic', 'data', 'offset', 'published_at', 'compressed', 'retained')
+
+    def __init__(self, message: Union[bytes, memoryview], topic: str, offset: Optional[int] = None,
+                 retained: bool = False):
+        self.topic = topic
+        self.data = b'MSG' + len(message).to_bytes(8, NETWORK_BYTEORDER, signed=False) + message
+        self.offset = offset  # offset in the message log of the topic, if it is enabled
+        self.published_at = time.monotonic()
+        # codec name -> `CMP` frame, or None if the message is sent uncompressed
+        self.compressed: Optional[Dict[str, Optional[bytes]]] = None
+        self.retained = retained  # published with `RET`, kept for later subscribers
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def payload(self) -> memoryview:
+        return memoryview(self.data)[MSG_HEADER_SIZE:]
+
+    def compress(self, codec: Codec) -> Optional[bytes]:
+        """
+        The `CMP` frame of this message, compressed on the first call for each codec.
+        """
+        if self.compressed is None:
+            self.compressed = {}
+        elif codec.name in self.compressed:
+            return self.compressed[codec.name]
+        data = self.compressed[codec.name] = codec.encode(self.payload)
+        return data
@@ -0,0 +1,364 @@
+import array
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, List, Optional, Set, Tuple
+
+from .frame import Frame
+from .message_dispatcher import MessageDispatcher
+from ..util import read_exactly
+from ..util.framing import FrameDecoder
+from ..util.wakeup import Wakeup
+
+DEFAULT_HANDOVER_TIMEOUT = 10
+HANDOVER_SIGNAL = signal.SIGUSR2
+
+# sent by the new process on the channel
+_READY = b'R'  # started and read its config, may be sent the connections
+_DONE = b'D'  # got everything, serving now
+_HEADER_LENGTH = 4
+
+
+class ConnectionState:
+    """
+    A connection in PUBLISH, SUBSCRIBE or FEDERATION mode (`mode` is `PUB`, `SUB` or `FED`), as handed over
+    to a new broker process, which carries on serving it from where the previous one stopped.
+    """
+
+    def __init__(self, mode: str, addr, protocol: int = 2, batch: bool = False, window: bool = False,
+                 codec: Optional[str] = None, topic: Optional[str] = None, pattern: Optional[str] = None,
+                 subscriber_id: Optional[int] = None, peer_id: Optional[str] = None, paused: bool = False,
+                 retain: bool = False):
+        self.mode = mode
+        self.addr = tuple(addr[:2])
+        self.protocol = protocol
+        self.batch = batch
+        self.window = window
+        self.codec = codec  # name of the negotiated codec
+        self.topic = topic
+        self.pattern = pattern
+        self.subscriber_id = subscriber_id
+        self.peer_id = peer_id
+        self.paused = paused  # the publisher was sent `WIN` 0 and not resumed yet
+        self.retain = retain  # the publisher may send `RET`
+        self.fd = -1
+        self.buffered = b''  # received from the client but not consumed yet
+        self.frames: List[Frame] = []  # pending for a subscriber
+        self.writer: Optional[asyncio.StreamWriter] = None  # of the asyncio engine, flushed before handing over
+
+    def header(self) -> dict:
+        return dict(mode=self.mode, addr=self.addr, protocol=self.protocol, batch=self.batch, window=self.window,
+                    codec=self.codec, topic=self.topic, pattern=self.pattern, subscriber_id=self.subscriber_id,
+                    peer_id=self.peer_id, paused=self.paused, retain=self.retain)
+
+    def encode_frames(self) -> bytes:
+        return _encode_frames(self.frames)
+
+    @staticmethod
+    def decode_frames(data: bytes) -> List[Frame]:
+        return _decode_frames(data)
+
+
+def _encode_frames(frames: List[Frame]) -> bytes:
+    # like between workers, every message is its topic as a cstring followed by its `MSG` frame
+    return b''.join(frame.topic.encode('ascii') + b'\0' + frame.data for frame in frames)
+
+
+def _decode_frames(data: bytes, retained: bool = False) -> List[Frame]:
+    decoder = FrameDecoder(len(data), len(data))
+    decoder.feed(data)
+    frames = []
+    while len(decoder):
+        topic = decoder.take_cstring().decode('ascii')
+        _, message = decoder.take_command()
+        frames.append(Frame(message, topic, retained=retained))
+    return frames
+
+
+def _send_header(channel: socket.socket, header: dict, fd: int):
+    data = json.dumps(header).encode('utf-8')
+    data = len(data).to_bytes(_HEADER_LENGTH, 'big') + data
+    # like socket.send_fds, which is new in Python 3.9
+    sent = channel.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [fd]))])
+    channel.sendall(data[sent:])
+
+
+def _receive_header(channel: socket.socket) -> Tuple[dict, int]:
+    # the descriptor comes with the first byte, so read it apart from the rest, like socket.recv_fds
+    fds = array.array('i')
+    data, ancdata, _, _ = channel.recvmsg(_HEADER_LENGTH, socket.CMSG_SPACE(fds.itemsize))
+    for level, kind, cdata in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[:len(cdata) - len(cdata) % fds.itemsize])
+    if not fds:
+        raise RuntimeError('No descriptor received from the previous broker process')
+    data += read_exactly(channel, _HEADER_LENGTH - len(data))
+    return json.loads(read_exactly(channel, int.from_bytes(data, 'big'))), fds[0]
+
+
+class Handover:
+    """
+    Hands the listening sockets and the connections of this broker over to a new process when HANDOVER_SIGNAL
+    is received, so that it can be restarted, for example with a new version or config, without any client
+    reconnecting. The new process is started with the same config and sent the descriptors with SCM_RIGHTS
+    over a Unix socket, together with what is needed to carry on: the mode and options of every connection,
+    the bytes received but not consumed yet, the pending messages of the subscribers and the retained messages.
+
+    While the new process starts, this one keeps serving. Then it stops accepting, publishers are stopped first,
+    so that no message is published afterwards, then subscribers, each between two frames. Connections not
+    stopped within `timeout` seconds, in TLS (its state lives in the TLS library) or in the handshake are closed
+    and their clients reconnect, as are links to federation peers.
+    """
+
+    def __init__(self, config_filename: str, timeout: float = DEFAULT_HANDOVER_TIMEOUT):
+        self.config_filename = config_filename
+        self.timeout = timeout
+        self.requested = False
+        # set once and never cleared, for the handlers to select on
+        self.stop_publishers = Wakeup()
+        self.stop_subscribers = Wakeup()
+        self.states: List[ConnectionState] = []  # of the connections stopped so far
+        self._publishers: Set[Any] = set()  # threads or tasks serving a connection which may be handed over
+        self._subscribers: Set[Any] = set()
+        self._lock = threading.Lock()
+        self._left = threading.Condition(self._lock)
+        self._signal_r, self._signal_w = os.pipe()
+        os.set_blocking(self._signal_w, False)
+        self.task: Optional[asyncio.Task] = None  # of `run_async`
+        # its listening socket is handed over as well, the port would be in use for the new process
+        self.metrics_server: Optional[socketserver.BaseServer] = None
+        self.logger = logging.getLogger(type(self).__name__)
+
+    def enter(self, handler: Any, subscriber: bool = False) -> bool:
+        """
+        Called by the handler of a connection, the current thread or task, when it switches to PUBLISH,
+        SUBSCRIBE or FEDERATION mode. Returns False if it is too late, then the client should be disconnected.
+        """
+        with self._lock:
+            if self.requested:
+                return False
+            (self._subscribers if subscriber else self._publishers).add(handler)
+            return True
+
+    def leave(self, handler: Any, state: Optional[ConnectionState] = None):
+        """
+        Called when the handler is done with the connection, with its `state` if it stopped for the handover.
+        A subscriber must have unsubscribed already.
+        """
+        with self._lock:
+            if state is not None:
+                self.states.append(state)
+            self._publishers.discard(handler)
+            self._subscribers.discard(handler)
+            self._left.notify_all()
+
+    def detach(self, state: ConnectionState, fd: int, buffered: Optional[bytes]) -> Optional[ConnectionState]:
+        """
+        Fill in the socket and the unconsumed bytes of a connection stopping for the handover.
+        Returns None if the unconsumed bytes are unknown, then the connection is closed instead.
+        """
+        if buffered is None:
+            self.logger.warning('Unconsumed bytes of %s:%d cannot be taken, it is closed.' % state.addr)
+            return None
+        state.fd = os.dup(fd)
+        state.buffered = buffered
+        return state
+
+    def _on_signal(self, signum, frame):
+        try:
+            os.write(self._signal_w, b'\0')
+        except BlockingIOError:
+            pass  # signalled already
+
+    def listen_signal(self):
+        """
+        Handle HANDOVER_SIGNAL, then `signalled` is readable. Must be called from the main thread.
+        """
+        signal.signal(HANDOVER_SIGNAL, self._on_signal)
+
+    @property
+    def signalled(self) -> int:
+        return self._signal_r
+
+    def _spawn(self) -> Optional[Tuple[subprocess.Popen, socket.socket]]:
+        """
+        Start the new process and wait until it is ready. Returns None if it is not.
+        """
+        channel, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        command = [sys.executable, '-m', 'pypsmb', '-c', self.config_filename,
+                   '--handover-fd', str(child_end.fileno())]
+        try:
+            process = subprocess.Popen(command, pass_fds=(child_end.fileno(),))
+        except OSError:
+            self.logger.exception('Cannot start the new process.')
+            channel.close()
+            return None
+        finally:
+            child_end.close()
+        self.logger.info(f'Started the new process (pid {process.pid}), waiting for it to be ready...')
+        channel.settimeout(self.timeout if self.timeout > 0 else None)
+        try:
+            ready = channel.recv(1)
+        except socket.timeout:
+            ready = None
+        if ready != _READY:
+            self.logger.error('The new process did not get ready. Keep serving.')
+            process.kill()
+            channel.close()
+            return None
+        channel.settimeout(None)
+        return process, channel
+
+    def _wait_left(self, handlers: Set[Any], deadline: float):
+        with self._lock:
+            if not self._left.wait_for(lambda: not handlers, max(deadline - time.monotonic(), 0)):
+                self.logger.warning(f'{len(handlers)} connection(s) did not stop in time, they are closed.')
+
+    def run(self, listeners: List[socket.socket], dispatcher: MessageDispatcher):
+        """
+        Hand over to a new process, for the threaded engine. Called from the accept loop once `signalled`
+        is readable; exits the process when done, returns if the new process could not be started.
+        """
+        os.read(self._signal_r, 1)
+        spawned = self._spawn()
+        if spawned is None:
+            return
+        process, channel = spawned
+        with self._lock:
+            self.requested = True
+        self.stop_publishers.set()
+        # paused publishers are stopped as well
+        dispatcher.flow_control.resume_all()
+        deadline = time.monotonic() + self.timeout
+        self._wait_left(self._publishers, deadline)
+        self.stop_subscribers.set()
+        self._wait_left(self._subscribers, deadline + self.timeout)
+        self._transfer(channel, [listener.fileno() for listener in listeners], dispatcher, process.pid)
+
+    async def _cancel(self, handlers: Set[Any]):
+        tasks = list(handlers)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=self.timeout)
+            if pending:
+                self.logger.warning(f'{len(pending)} connection(s) did not stop in time, they are closed.')
+
+    def start_async(self, servers: List[asyncio.AbstractServer], listeners: List[socket.socket],
+                    dispatcher: MessageDispatcher):
+        """
+        Start `run_async` on the running event loop, unless it is running already.
+        """
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run_async(servers, listeners, dispatcher))
+
+    async def run_async(self, servers: List[asyncio.AbstractServer], listeners: List[socket.socket],
+                        dispatcher: MessageDispatcher):
+        """
+        Hand over to a new process, for the asyncio engine, where handlers are stopped by cancelling them.
+        Closes `servers`, which stops their `serve_forever`.
+        """
+        loop = asyncio.get_running_loop()
+        spawned = await loop.run_in_executor(None, self._spawn)
+        if spawned is None:
+            return
+        process, channel = spawned
+        self.requested = True
+        # a server closes its socket when it stops
+        listeners = [listener.dup() for listener in listeners]
+        for server in servers:
+            server.close()
+        await self._cancel(self._publishers)
+        await self._cancel(self._subscribers)
+        for state in list(self.states):
+            # what the handler wrote must reach the client before the new process writes anything
+            try:
+                await asyncio.wait_for(state.writer.wait_closed(), self.timeout)
+            except (asyncio.TimeoutError, OSError):
+                self.logger.warning('Connection of %s:%d is not flushed in time, it is closed.' % state.addr)
+                state.writer.transport.abort()
+                self.states.remove(state)
+                os.close(state.fd)
+        self._transfer(channel, [listener.fileno() for listener in listeners], dispatcher, process.pid)
+
+    def _transfer(self, channel: socket.socket, listener_fds: List[int], dispatcher: MessageDispatcher, pid: int):
+        if dispatcher.log is not None:
+            # the new process opens it once this is done
+            dispatcher.log.close()
+        retained = _encode_frames(dispatcher.retained.frames()) if dispatcher.retained is not None else b''
+        if self.metrics_server is not None:
+            # stop accepting, the new process serves the metrics from now on
+            self.metrics_server.shutdown()
+        try:
+            _send_header(channel, dict(listeners=len(listener_fds), connections=len(self.states),
+                                       retained=len(retained), metrics=self.metrics_server is not None),
+                         listener_fds[0])
+            for listener_fd in listener_fds[1:]:
+                _send_header(channel, {}, listener_fd)
+            if self.metrics_server is not None:
+                _send_header(channel, {}, self.metrics_server.fileno())
+            if retained:
+                channel.sendall(retained)
+            for state in self.states:
+                frames = state.encode_frames()
+                _send_header(channel, dict(state.header(), buffered=len(state.buffered), frames=len(frames)),
+                             state.fd)
+                if state.buffered or frames:
+                    # an empty send fails once the new process has got everything and closed the channel
+                    channel.sendall(state.buffered + frames)
+            channel.settimeout(self.timeout if self.timeout > 0 else None)
+            if channel.recv(1) != _DONE:
+                raise ConnectionError('The new process quit')
+        except (OSError, ConnectionError):
+            self.logger.exception('Handover failed.')
+            code = 1
+        else:
+            self.logger.info(f'Handed {len(self.states)} connection(s) over to pid {pid}. Bye.')
+            code = 0
+        logging.shutdown()
+        os._exit(code)
+
+
+def receive_handover(fd: int) -> Tuple[List[socket.socket], List[ConnectionState], List[Frame],
+                                      Optional[socket.socket]]:
+    """
+    Take over from the previous broker process, on the channel it passed to this one.
+    Returns the listening sockets, TCP first, the connections to resume, the retained messages
+    and the listening socket of the metrics server, if it served metrics.
+    """
+    channel = socket.socket(fileno=fd)
+    try:
+        channel.sendall(_READY)
+        header, listener_fd = _receive_header(channel)
+        listeners = [socket.socket(fileno=listener_fd)]
+        for _ in range(header.get('listeners', 1) - 1):
+            _, listener_fd = _receive_header(channel)
+            listeners.append(socket.socket(fileno=listener_fd))
+        metrics_sock = None
+        if header.get('metrics'):
+            _, metrics_fd = _receive_header(channel)
+            metrics_sock = socket.socket(fileno=metrics_fd)
+        retained = _decode_frames(read_exactly(channel, header.get('retained', 0)), retained=True)
+        states = []
+        for _ in range(header['connections']):
+            header, connection_fd = _receive_header(channel)
+            state = ConnectionState(header['mode'], header['addr'], header['protocol'], header['batch'],
+                                    header['window'], header['codec'], header['topic'], header['pattern'],
+                                    header['subscriber_id'], header['peer_id'], header['paused'],
+                                    header.get('retain', False))
+            state.fd = connection_fd
+            state.buffered = read_exactly(channel, header['buffered'])
+            state.frames = ConnectionState.decode_frames(read_exactly(channel, header['frames']))
+            states.append(state)
+        channel.sendall(_DONE)
+    finally:
+        channel.close()
+    return listeners, states, retained, metrics_sock
@@ -0,0 +1,141 @@
+import collections
+import enum
+import threading
+from typing import Deque, Iterator, Optional
+
+from .frame import Frame
+
+
+class OverflowPolicy(enum.Enum):
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+    DISCONNECT = 'disconnect'
+
+
+class InboxOverflowError(Exception):
+    def __init__(self, subscriber_id: bytes):
+        super().__init__(f'Inbox of subscriber {subscriber_id!r} overflowed')
+
+
+class MemoryBudget:
+    """
+    Byte budget shared by all inboxes of a broker. A negative limit means unlimited.
+    """
+
+    def __init__(self, max_bytes: int = -1):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, n: int) -> bool:
+        with self._lock:
+            if 0 <= self.max_bytes < self.used + n:
+                return False
+            self.used += n
+            return True
+
+    def release(self, n: int):
+        with self._lock:
+            self.used -= n
+
+
+class Inbox:
+    """
+    Pending messages of one subscriber, bounded by message count and bytes.
+    Negative limits mean unlimited.
+
+    Any number of publisher threads put frames while the subscriber thread drains them, without the subscriber
+    ever waiting for a publisher: publishers take a lock among themselves, the subscriber only pops
+    from the deque, which is thread-safe for appending at one end and popping at the other.
+    Each counter of bytes is written by one side only, so `nbytes` is never torn.
+    """
+
+    def __init__(self, subscriber_id: bytes, max_messages: int = -1, max_bytes: int = -1,
+                 policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST, budget: Optional[MemoryBudget] = None):
+        self.subscriber_id = subscriber_id
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.budget = budget or MemoryBudget()
+        self.frames: Deque[Frame] = collections.deque()
+        self._put_lock = threading.Lock()  # taken by publishers only
+        self._bytes_in = 0  # put, by publishers
+        self._bytes_dropped = 0  # dropped from the head, by publishers
+        self._bytes_out = 0  # drained, by the subscriber
+        self.dropped = 0  # how many messages are discarded because of the limits
+        self.overflowed = False  # set instead of dropping if the policy is DISCONNECT
+        self.closed = False  # cleared for good, frames put later are discarded
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def nbytes(self) -> int:
+        # read what is drained first, so that the result is never below the actual size
+        out = self._bytes_out
+        return self._bytes_in - self._bytes_dropped - out
+
+    def _fits(self, size: int) -> bool:
+        return not (0 <= self.max_messages <= len(self.frames)) and \
+            not (0 <= self.max_bytes < self.nbytes + size)
+
+    def put(self, frame: Frame) -> bool:
+        """
+        Append a frame. Returns False if some message was dropped or the inbox overflowed.
+        """
+        size = len(frame)
+        accepted = True
+        with self._put_lock:
+            if self.overflowed or self.closed:
+                return False
+            while not (self._fits(size) and self.budget.reserve(size)):
+                if self.policy == OverflowPolicy.DISCONNECT:
+                    self.overflowed = True
+                    return False
+                accepted = False
+                if self.policy == OverflowPolicy.DROP_NEWEST or not self.frames:
+                    self.dropped += 1
+                    return False
+                try:
+                    oldest = self.frames.popleft()
+                except IndexError:
+                    continue  # taken by the subscriber meanwhile, there may be room now
+                self._bytes_dropped += len(oldest)
+                self.budget.release(len(oldest))
+                self.dropped += 1
+            # counted before it can be drained
+            self._bytes_in += size
+            self.frames.append(frame)
+        return accepted
+
+    def drain(self) -> Iterator[Frame]:
+        """
+        Pop the pending frames. Called by the subscriber only.
+        """
+        if self.overflowed:
+            raise InboxOverflowError(self.subscriber_id)
+        while True:
+            try:
+                frame = self.frames.popleft()
+            except IndexError:
+                return
+            self._bytes_out += len(frame)
+            self.budget.release(len(frame))
+            yield frame
+
+    def oldest_published_at(self) -> Optional[float]:
+        try:
+            return self.frames[0].published_at
+        except IndexError:
+            return None
+
+    def clear(self):
+        """
+        Drop the pending frames and any put later, when the subscriber is gone.
+        """
+        with self._put_lock:
+            self.closed = True
+            nbytes = self.nbytes
+            self.frames.clear()
+            self._bytes_dropped += nbytes
+            self.budget.release(nbytes)
@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+from .metrics import Metrics
+
+DEFAULT_MAX_PENDING = 3
+DEFAULT_TICK = 1.0
+
+
+class Timer:
+    __slots__ = ('expires', 'item', 'cancelled')
+
+    def __init__(self, expires: int, item: Any):
+        self.expires = expires  # in ticks of the wheel
+        self.item = item
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Hierarchical timing wheel. Level 0 has one slot per tick, and every slot of level n spans `slots` slots
+    of level n - 1; a timer waits in the lowest level its deadline fits in, and moves down a level when the slot
+    holding it comes up. Scheduling, cancelling and expiring are O(1) however many timers there are.
+    Deadlines further than `slots ** levels` ticks are cut down to that. Not thread-safe.
+    """
+
+    def __init__(self, tick: float = DEFAULT_TICK, slots: int = 64, levels: int = 4):
+        self.tick = tick
+        self.slots = slots
+        self._spans = [slots ** level for level in range(levels)]  # ticks per slot of each level
+        self._max_ticks = slots ** levels - 1
+        self._levels: List[List[List[Timer]]] = [[[] for _ in range(slots)] for _ in range(levels)]
+        self._start = time.monotonic()
+        self._current = 0  # ticks expired so far
+
+    def _ticks(self, when: float) -> int:
+        return int((when - self._start) / self.tick)
+
+    def _place(self, timer: Timer):
+        delta = timer.expires - self._current
+        level = 0
+        while level + 1 < len(self._spans) and delta >= self._spans[level + 1]:
+            level += 1
+        self._levels[level][(timer.expires // self._spans[level]) % self.slots].append(timer)
+
+    def schedule(self, when: float, item: Any) -> Timer:
+        """
+        Add a timer expiring once the monotonic clock is past `when`, give or take a tick.
+        """
+        expires = min(max(self._ticks(when), self._current + 1), self._current + self._max_ticks)
+        timer = Timer(expires, item)
+        self._place(timer)
+        return timer
+
+    def advance(self, now: Optional[float] = None) -> List[Timer]:
+        """
+        Move the wheel to `now`, returning the timers which expired, not cancelled, in deadline order.
+        """
+        target = self._ticks(time.monotonic() if now is None else now)
+        expired = []
+        while self._current < target:
+            self._current += 1
+            # bring down the timers of the higher levels whose slot comes up, the highest first
+            level = 1
+            while level < len(self._spans) and self._current % self._spans[level] == 0:
+                level += 1
+            for cascading in range(level - 1, 0, -1):
+                slot = self._levels[cascading][(self._current // self._spans[cascading]) % self.slots]
+                timers = slot[:]
+                slot.clear()
+                for timer in timers:
+                    if not timer.cancelled:
+                        self._place(timer)
+            slot = self._levels[0][self._current % self.slots]
+            expired.extend(timer for timer in slot if not timer.cancelled)
+            slot.clear()
+        return expired
+
+
+class KeepAliveEntry:
+    """
+    Keepalive state of one connection. The handler calls `touch` whenever it receives something.
+    """
+    __slots__ = ('send_nop', 'kick', 'logger', 'last_seen', 'pending', 'timer', 'suspended')
+
+    def __init__(self, send_nop: Callable[[], None], kick: Callable[[], None], logger: logging.Logger):
+        self.send_nop = send_nop
+        self.kick = kick
+        self.logger = logger
+        self.last_seen = time.monotonic()
+        self.pending = 0  # how many continuous NOP did we sent, which is not responded by the client
+        self.timer: Optional[Timer] = None
+        self.suspended = False  # the handler does not read from the peer for now
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+        self.pending = 0
+
+
+class KeepAlive:
+    """
+    Keepalive of all connections of a broker on one timer wheel, instead of a timeout per connection.
+    Receiving anything from a peer only updates its entry; when a peer has been silent for `interval` seconds
+    it is sent a `NOP`, and after `max_pending` unanswered ones it is kicked. The NOPs due in one tick
+    are sent together. Driven by a thread (`start_thread`) or a task on the event loop (`start_async`),
+    which is where `send_nop` and `kick` of the entries are called from.
+    """
+
+    def __init__(self, interval: float, max_pending: int = DEFAULT_MAX_PENDING,
+                 metrics: Optional[Metrics] = None, tick: float = DEFAULT_TICK):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.metrics = metrics
+        self.wheel = TimerWheel(tick)
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.logger = logging.getLogger(type(self).__name__)
+
+    def register(self, send_nop: Callable[[], None], kick: Callable[[], None],
+                 logger: logging.Logger) -> KeepAliveEntry:
+        entry = KeepAliveEntry(send_nop, kick, logger)
+        with self._lock:
+            self._schedule(entry, entry.last_seen + self.interval)
+        return entry
+
+    def unregister(self, entry: KeepAliveEntry):
+        with self._lock:
+            entry.timer.cancel()
+
+    def suspend(self, entry: KeepAliveEntry, suspended: bool = True):
+        """
+        Stop waiting for replies from the peer of an entry while its handler does not read, as with a paused
+        publisher, or wait again. It is still sent NOPs meanwhile, which find out if the connection is gone.
+        """
+        with self._lock:
+            entry.suspended = suspended
+            entry.pending = 0
+            entry.last_seen = time.monotonic()
+
+    def _schedule(self, entry: KeepAliveEntry, when: float):
+        entry.timer = self.wheel.schedule(when, entry)
+
+    def _check(self, entry: KeepAliveEntry) -> bool:
+        """
+        Called with the lock held when the timer of an entry expires. Returns True if a NOP is due.
+        """
+        now = time.monotonic()
+        if now - entry.last_seen < self.interval:
+            # heard from the peer since the timer was set
+            self._schedule(entry, entry.last_seen + self.interval)
+            return False
+        if entry.suspended:
+            self._schedule(entry, now + self.interval)
+            return True
+        if entry.pending >= self.max_pending:
+            # the client is not sensible
+            # kick it
+            entry.logger.error('Insensible client (too many pending keepalive responses). Kick it.')
+            if self.metrics is not None:
+                self.metrics.keepalive_kicks.inc()
+            entry.kick()
+            return False
+        entry.pending += 1
+        self._schedule(entry, now + self.interval)
+        return True
+
+    def expire(self):
+        with self._lock:
+            due = [timer.item for timer in self.wheel.advance() if self._check(timer.item)]
+        for entry in due:
+            entry.logger.info('Send NOP. (keepalive)')
+            try:
+                entry.send_nop()
+            except OSError:
+                entry.logger.exception('Cannot send NOP.')
+        if due:
+            self.logger.debug(f'Sent {len(due)} NOP(s).')
+
+    def _run(self):
+        while True:
+            time.sleep(self.wheel.tick)
+            try:
+                self.expire()
+            except Exception:
+                self.logger.exception('Unexpected exception.')
+
+    def start_thread(self):
+        threading.Thread(target=self._run, name='KeepAlive', daemon=True).start()
+
+    async def _run_async(self):
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            try:
+                self.expire()
+            except Exception:
+                self.logger.exception('Unexpected exception.')
+
+    def start_async(self):
+        self._task = asyncio.ensure_future(self._run_async())
@@ -1,7 +1,18 @@
+import itertools
 import logging
 import re
-import socket
-from typing import List, Tuple, Dict, Iterator, Union
+import threading
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple, Dict, Iterator, Union
+
+from .flow_control import FlowControl, FlowRule
+from .frame import Frame
+from .inbox import Inbox, MemoryBudget, OverflowPolicy
+from .message_log import MessageLog
+from .metrics import Metrics
+from .retained import RetainedStore
+from .subscription_index import SubscriptionIndex
+from ..util.compression import Codec
+from ..util.wakeup import Wakeup
 
 
 class SubscriberAlreadyExistsError(Exception):
@@ -10,39 +21,266 @@ class SubscriberAlreadyExistsError(Exception):
 
 
 class MessageDispatcher:
-    # subscriber_id -> (pattern, lsock, inbox)
-    subscriptions: Dict[bytes, Tuple[re.Pattern, socket.socket, List[Tuple[bytes, str]]]]
+    """
+    Routes published messages to the inboxes of matching subscribers. Publishers of any number of threads
+    never take a lock to look subscribers up: `subscriptions` and the index are copy-on-write, replaced
+    by `subscribe` and `unsubscribe` under a lock of their own, so a publisher reads a consistent version,
+    possibly missing a subscriber being added or still seeing one being removed.
+    """
+    # subscriber_id -> (pattern, notify, inbox), replaced and never changed in place
+    subscriptions: Dict[bytes, Tuple[re.Pattern, Callable[[], None], Inbox]]
 
-    def __init__(self):
+    def __init__(self, max_inbox_messages: int = -1, max_inbox_bytes: int = -1,
+                 overflow_policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST, memory_budget: int = -1,
+                 log: Optional[MessageLog] = None, flow_rules: Sequence[FlowRule] = (),
+                 retained: Optional[RetainedStore] = None):
         self.subscriptions = {}
+        self.max_inbox_messages = max_inbox_messages
+        self.max_inbox_bytes = max_inbox_bytes
+        self.overflow_policy = overflow_policy
+        self.memory_budget = MemoryBudget(memory_budget)
+        self.log = log
+        self.retained = retained  # None if publishers may not retain messages
+        # held while a retained message is stored and matched, and while a subscriber is indexed and sent
+        # the retained messages, so that it gets every retained message either from the store or when published
+        self._retain_lock = threading.Lock()
+        self._subscribe_lock = threading.Lock()  # serializes subscribe and unsubscribe
+        # subscriber_id -> (topic -> next log offset to deliver), only for subscribers allowing history,
+        # advanced once frames are sent
+        self._cursors: Dict[bytes, Dict[str, int]] = {}
+        # subscriber_id -> (topic -> next log offset to read), ahead of the cursor by the frames being sent
+        self._positions: Dict[bytes, Dict[str, int]] = {}
+        # subscriber_id -> messages dropped from the inbox so far, which are read from the log instead
+        self._dropped: Dict[bytes, int] = {}
+        self._replays: Dict[bytes, Iterable[Frame]] = {}
+        # retained messages for new subscribers allowing history, sent first and not tracked by their cursor
+        self._initial: Dict[bytes, List[Frame]] = {}
+        # subscriber_id -> compression codec, only for subscribers which negotiated one
+        self._codecs: Dict[bytes, Codec] = {}
+        self.index = SubscriptionIndex()
+        # called with (frame, origin) after every publish, to pass messages on to other processes or brokers
+        self.forwarders: List[Callable[[Frame, Any], None]] = []
+        self._wakeups: Dict[bytes, Optional[Wakeup]] = {}
+        self.metrics = Metrics()
+        self.flow_control = FlowControl(self.backlog, flow_rules)
         self.logger = logging.getLogger(type(self).__name__)
 
-    def publish(self, message: bytes, topic: str):
-        for subscriber_id, (pattern, lsock, inbox) in self.subscriptions.items():
-            assert isinstance(pattern, re.Pattern)
-            assert isinstance(lsock, socket.socket)
+    def publish(self, message: bytes, topic: str, origin: Any = None, retain: bool = False):
+        """
+        Deliver a message to all matching subscribers. `origin` is None for messages from local publishers,
+        otherwise it tells the forwarders where the message came from.
+        With `retain`, the message is also kept as the retained message of the topic, which is sent to
+        subscribers as soon as they subscribe; an empty one clears it. Ignored if retaining is not enabled.
+        """
+        self.publish_batch((message,), topic, origin, retain)
+
+    def publish_batch(self, messages: Iterable[Union[bytes, memoryview]], topic: str, origin: Any = None,
+                      retain: bool = False):
+        """
+        Deliver messages of one topic in order, matching subscribers and notifying each of them only once.
+        """
+        retain = retain and self.retained is not None
+        frames = [Frame(message, topic, retained=retain) for message in messages]
+        if not frames:
+            return
+        for frame in frames:
+            if self.log is not None:
+                frame.offset = self.log.append(topic, frame.payload)
+            self.metrics.published(frame)
+        if retain:
+            with self._retain_lock:
+                for frame in frames:
+                    self.retained.retain(frame)
+                subscriber_ids = self.index.match(topic)
+        else:
+            subscriber_ids = self.index.match(topic)
+        subscriptions = self.subscriptions
+        if self._codecs:
+            # compress here once, rather than in the delivery of every subscriber
+            for codec in {self._codecs.get(subscriber_id) for subscriber_id in subscriber_ids} - {None}:
+                for frame in frames:
+                    frame.compress(codec)
+        for subscriber_id in subscriber_ids:
+            subscription = subscriptions.get(subscriber_id)
+            if subscription is None:
+                continue  # unsubscribed meanwhile
+            pattern, notify, inbox = subscription
+            self.logger.info(f'Dispatch {len(frames)} message(s) to subscriber with id {subscriber_id}.')
+            for frame in frames:
+                if not inbox.put(frame) and not inbox.overflowed:
+                    if inbox.dropped and inbox.dropped & (inbox.dropped - 1) == 0:
+                        # log when the count reaches a power of 2 to avoid flooding
+                        self.logger.warning(f'Subscriber {subscriber_id!r} is too slow, '
+                                            f'{inbox.dropped} message(s) dropped so far.')
+            try:
+                notify()
+            except IOError:
+                self.logger.exception(f'Cannot notify subscriber {subscriber_id} with pattern {pattern.pattern}')
+        for forward in self.forwarders:
+            for frame in frames:
+                forward(frame, origin)
+
+    def subscribe(self, subscriber_id: bytes, pattern: str,
+                  notify: Optional[Callable[[], None]] = None, history: bool = False,
+                  codec: Optional[Codec] = None) -> Optional[Wakeup]:
+        """
+        Register a subscriber. If `notify` is not given, a `Wakeup` is returned which is set
+        when the inbox has new messages, once for any number of them until it is cleared;
+        otherwise `notify` is called instead and nothing is returned.
+        If `history` is set and the message log is enabled, messages the subscriber missed
+        since its last connection are delivered first. Otherwise, as well as to a subscriber connecting
+        for the first time, the retained messages of the matching topics are delivered first.
+        Messages for a subscriber with a `codec` are compressed when published.
+        """
+        wakeup = None
+        if notify is None:
+            wakeup = Wakeup()
+            notify = wakeup.set
+        inbox = Inbox(subscriber_id, self.max_inbox_messages, self.max_inbox_bytes,
+                      self.overflow_policy, self.memory_budget)
+        retained = []
+        with self._subscribe_lock:
+            if subscriber_id in self.subscriptions:
+                if wakeup is not None:
+                    wakeup.close()
+                raise SubscriberAlreadyExistsError(subscriber_id)
+            self.subscriptions = {**self.subscriptions, subscriber_id: (re.compile(pattern), notify, inbox)}
+            self._wakeups[subscriber_id] = wakeup
+            if codec is not None:
+                self._codecs[subscriber_id] = codec
+            if self.retained is not None:
+                with self._retain_lock:
+                    self.index.add(subscriber_id, pattern)
+                    retained = self.retained.match(pattern)
+            else:
+                self.index.add(subscriber_id, pattern)
+        if history and self.log is not None:
+            # snapshot after registering, messages published later are in the inbox
+            ends = self.log.end_offsets()
+            cursor = self.log.load_cursor(subscriber_id)
+            if cursor is None:
+                # a new subscriber did not miss anything, but gets the retained messages
+                cursor = dict(ends)
+                self._initial[subscriber_id] = retained
+            self._cursors[subscriber_id] = cursor
+            self._positions[subscriber_id] = dict(cursor)
+            self._dropped[subscriber_id] = inbox.dropped
+            self._replays[subscriber_id] = self._replay(re.compile(pattern), dict(cursor), ends)
+            notify()
+        elif retained:
+            for frame in retained:
+                inbox.put(frame)
+            notify()
+        return wakeup
+
+    def _replay(self, pattern: re.Pattern, cursor: Dict[str, int],
+                ends: Dict[str, int]) -> Iterator[Frame]:
+        for topic, end in ends.items():
             if pattern.fullmatch(topic):
-                self.logger.info(f'Dispatch message to subscriber with id {subscriber_id}.')
-                inbox.append((message, topic))
-                try:
-                    lsock.send(b'\x00')  # notify rsock
-                except IOError:
-                    self.logger.exception(f'Cannot notify subscriber {subscriber_id} with pattern {pattern.pattern}')
-
-    def subscribe(self, subscriber_id: bytes, pattern: str) -> socket.socket:
-        lsock, rsock = socket.socketpair()
-        if subscriber_id in self.subscriptions:
-            raise SubscriberAlreadyExistsError(subscriber_id)
-        self.subscriptions[subscriber_id] = re.compile(pattern), lsock, []
-        return rsock
+                for offset, message in self.log.read(topic, cursor.get(topic, 0), end):
+                    yield Frame(message, topic, offset)
 
     def unsubscribe(self, subscriber_id: bytes):
-        if subscriber_id not in self.subscriptions:
-            raise ValueError(f'Subscriber with id `{subscriber_id!r}` does not exist')
-        _, lsock, _ = self.subscriptions.pop(subscriber_id)
-        lsock.close()
+        with self._subscribe_lock:
+            if subscriber_id not in self.subscriptions:
+                raise ValueError(f'Subscriber with id `{subscriber_id!r}` does not exist')
+            # done with the id before it can be subscribed again
+            self._replays.pop(subscriber_id, None)
+            self._initial.pop(subscriber_id, None)
+            self._positions.pop(subscriber_id, None)
+            self._dropped.pop(subscriber_id, None)
+            cursor = self._cursors.pop(subscriber_id, None)
+            if cursor is not None:
+                self.log.save_cursor(subscriber_id, cursor)
+            subscriptions = dict(self.subscriptions)
+            _, _, inbox = subscriptions.pop(subscriber_id)
+            self.subscriptions = subscriptions
+            self.index.remove(subscriber_id)
+            self._codecs.pop(subscriber_id, None)
+            wakeup = self._wakeups.pop(subscriber_id)
+        # a publisher which looked the subscriber up before may still put, the inbox discards it
+        inbox.clear()
+        if wakeup is not None:
+            wakeup.close()
+        # publishers may have been waiting for this subscriber
+        self.flow_control.released()
+
+    def read_inbox(self, subscriber_id: bytes) -> Iterator[Frame]:
+        """
+        Pop all pending frames of a subscriber, to be passed to `delivered` once sent.
+        Raises `InboxOverflowError` if the subscriber should be disconnected.
+        """
+        pattern, _, inbox = self.subscriptions[subscriber_id]
+        position = self._positions.get(subscriber_id)
+        if position is None:
+            return inbox.drain()
+        return self._read_history(subscriber_id, pattern, inbox, position)
+
+    def _read_history(self, subscriber_id: bytes, pattern: re.Pattern, inbox: Inbox,
+                      position: Dict[str, int]) -> Iterator[Frame]:
+        yield from self._initial.pop(subscriber_id, ())
+        replay = self._replays.pop(subscriber_id, ())
+        if inbox.dropped != self._dropped[subscriber_id]:
+            self._dropped[subscriber_id] = inbox.dropped
+            # the messages are still in the log, read them from where reading stopped, once replayed
+            replay = itertools.chain(replay, self._replay(pattern, position, self.log.end_offsets()))
+        for frame in itertools.chain(replay, inbox.drain()):
+            if frame.offset < position.get(frame.topic, 0):
+                continue  # already read
+            position[frame.topic] = frame.offset + 1
+            yield frame
 
-    def read_inbox(self, subscriber_id: bytes) -> Iterator[Tuple[bytes, str]]:
+    def delivered(self, subscriber_id: bytes, frames: List[Frame]):
+        """
+        Called with frames read from the inbox of a subscriber once they are sent.
+        Advances the cursor of a subscriber allowing history, saved with the next group commit.
+        """
+        self.metrics.delivered(frames)
+        cursor = self._cursors.get(subscriber_id)
+        if cursor is None:
+            return
+        for frame in frames:
+            # retained messages sent first may be older than the cursor
+            if frame.offset is not None and frame.offset >= cursor.get(frame.topic, 0):
+                cursor[frame.topic] = frame.offset + 1
+        self.log.save_cursor(subscriber_id, cursor)
+
+    def pending(self, subscriber_id: bytes) -> List[Frame]:
+        """
+        Frames pending for a subscriber, left in its inbox. Empty for a subscriber replaying from the message log,
+        which has them in the log.
+        """
+        if subscriber_id in self._cursors:
+            return []
         _, _, inbox = self.subscriptions[subscriber_id]
-        while inbox:
-            yield inbox.pop(0)
+        return list(inbox.frames)
+
+    def restore(self, subscriber_id: bytes, frames: Iterable[Frame]):
+        """
+        Put back frames which were pending for a subscriber, in another process for example.
+        """
+        _, notify, inbox = self.subscriptions[subscriber_id]
+        for frame in frames:
+            inbox.put(frame)
+        notify()
+
+    def backlog(self, topic: str) -> int:
+        """
+        Bytes pending in the fullest inbox of the subscribers of a topic.
+        """
+        backlog = 0
+        subscriptions = self.subscriptions
+        for subscriber_id in self.index.match(topic):
+            subscription = subscriptions.get(subscriber_id)
+            if subscription is not None and subscription[2].nbytes > backlog:
+                backlog = subscription[2].nbytes
+        return backlog
+
+    def inbox_stats(self) -> Dict[bytes, Tuple[int, int, int, Optional[float]]]:
+        """
+        Returns subscriber_id -> (pending messages, pending bytes, dropped messages,
+        publishing time of the oldest pending message or None).
+        """
+        return {subscriber_id: (len(inbox), inbox.nbytes, inbox.dropped, inbox.oldest_published_at())
+                for subscriber_id, (_, _, inbox) in self.subscriptions.items()}
+
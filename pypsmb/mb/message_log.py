@@ -0,0 +1,322 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# every record in a segment is a uint64 payload length followed by the payload
+RECORD_HEADER = struct.Struct('>Q')
+SEGMENT_SUFFIX = '.log'
+CURSOR_SUFFIX = '.json'
+RETENTION_CHECK_INTERVAL = 60  # seconds
+
+
+def _segment_name(base_offset: int) -> str:
+    return f'{base_offset:020d}{SEGMENT_SUFFIX}'
+
+
+def _scan(buf, limit: int, pos: int = 0) -> Iterator[Tuple[int, int, int]]:
+    """
+    Yields (record start, payload start, payload end) of complete records in `buf[pos:limit]`.
+    """
+    while pos + RECORD_HEADER.size <= limit:
+        length, = RECORD_HEADER.unpack_from(buf, pos)
+        end = pos + RECORD_HEADER.size + length
+        if end > limit:
+            return
+        yield pos, pos + RECORD_HEADER.size, end
+        pos = end
+
+
+class TopicLog:
+    """
+    Append-only log of one topic, stored as segment files named by the offset of their first record.
+    All attributes are guarded by the lock of the owning `MessageLog`.
+    """
+
+    def __init__(self, topic: str, directory: str):
+        self.topic = topic
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.segments: List[int] = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                                          if name.endswith(SEGMENT_SUFFIX))
+        self.next_offset = 0  # offset of the next appended message
+        self.committed_offset = 0  # messages below this offset are on disk
+        self.pending: List[Tuple[int, bytes]] = []  # appended, not picked up by the writer yet
+        self.inflight: List[Tuple[int, bytes]] = []  # being written by the writer
+        self._file = None
+        self._file_size = 0
+        if self.segments:
+            self._recover()
+
+    def _path(self, base_offset: int) -> str:
+        return os.path.join(self.directory, _segment_name(base_offset))
+
+    def _recover(self):
+        base = self.segments[-1]
+        path = self._path(base)
+        with open(path, 'rb') as f:
+            data = f.read()
+        count, valid = 0, 0
+        for _, _, end in _scan(data, len(data)):
+            count += 1
+            valid = end
+        if valid != len(data):
+            logging.getLogger(type(self).__name__).warning(
+                f'Truncate torn tail of {path} ({len(data) - valid} byte(s)).')
+            with open(path, 'r+b') as f:
+                f.truncate(valid)
+        self.next_offset = self.committed_offset = base + count
+        self._file_size = valid
+
+    def append(self, message: bytes) -> int:
+        offset = self.next_offset
+        self.next_offset += 1
+        self.pending.append((offset, message))
+        return offset
+
+    def write(self, records: List[Tuple[int, bytes]], segment_bytes: int, fsync: bool):
+        """
+        Write records to the active segment, rolling to a new one when it is full. Called by the writer thread.
+        """
+        if self._file is None and self.segments and self._file_size < segment_bytes:
+            # continue the segment found on startup
+            self._file = open(self._path(self.segments[-1]), 'ab')
+        for offset, message in records:
+            if self._file is None or self._file_size >= segment_bytes:
+                self._roll(offset, fsync)
+            self._file.write(RECORD_HEADER.pack(len(message)))
+            self._file.write(message)
+            self._file_size += RECORD_HEADER.size + len(message)
+        if self._file is not None:
+            self._file.flush()
+            if fsync:
+                os.fsync(self._file.fileno())
+
+    def _roll(self, base_offset: int, fsync: bool):
+        if self._file is not None:
+            self._file.flush()
+            if fsync:
+                os.fsync(self._file.fileno())
+            self._file.close()
+        self._file = open(self._path(base_offset), 'ab')
+        self._file_size = 0
+        self.segments = self.segments + [base_offset]
+
+    def read(self, start: int, end: int, committed: int, segments: List[int]) -> Iterator[Tuple[int, bytes]]:
+        """
+        Yields (offset, message) of on-disk records in [start, min(end, committed)).
+        """
+        end = min(end, committed)
+        for i, base in enumerate(segments):
+            next_base = segments[i + 1] if i + 1 < len(segments) else end
+            if next_base <= start or base >= end:
+                continue
+            try:
+                f = open(self._path(base), 'rb')
+            except FileNotFoundError:
+                continue  # removed by retention meanwhile
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                if not size:
+                    continue
+                with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as buf:
+                    offset = base
+                    for _, payload_start, payload_end in _scan(buf, size):
+                        if offset >= end:
+                            return
+                        if offset >= start:
+                            yield offset, buf[payload_start:payload_end]
+                        offset += 1
+
+    def enforce_retention(self, retention_seconds: float, retention_bytes: int) -> int:
+        """
+        Delete old segments, never the active one. Returns the number of deleted segments.
+        """
+        deleted = 0
+        now = time.time()
+        sizes = []
+        for base in self.segments:
+            try:
+                stat = os.stat(self._path(base))
+                sizes.append((stat.st_size, stat.st_mtime))
+            except FileNotFoundError:
+                sizes.append((0, 0))
+        total = sum(size for size, _ in sizes)
+        while len(self.segments) > 1:
+            size, mtime = sizes[deleted]
+            expired = retention_seconds >= 0 and now - mtime > retention_seconds
+            oversize = retention_bytes >= 0 and total > retention_bytes
+            if not (expired or oversize):
+                break
+            try:
+                os.remove(self._path(self.segments[0]))
+            except FileNotFoundError:
+                pass
+            self.segments = self.segments[1:]
+            total -= size
+            deleted += 1
+        return deleted
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class MessageLog:
+    """
+    Durable per-topic message log used to replay missed messages to subscribers with `ALLOW_HISTORY`.
+    Appends are assigned offsets immediately and written by a background thread in groups,
+    with one flush (and fsync) per group. Subscriber cursors (topic -> next offset to deliver)
+    are persisted by the same thread.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024,
+                 retention_seconds: float = -1, retention_bytes: int = -1,
+                 commit_interval: float = 0.05, fsync: bool = True):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention_seconds = retention_seconds
+        self.retention_bytes = retention_bytes
+        self.commit_interval = commit_interval
+        self.fsync = fsync
+        self._retention_enabled = retention_seconds >= 0 or retention_bytes >= 0
+        self.logger = logging.getLogger(type(self).__name__)
+        self._topics_dir = os.path.join(directory, 'topics')
+        self._cursors_dir = os.path.join(directory, 'cursors')
+        os.makedirs(self._topics_dir, exist_ok=True)
+        os.makedirs(self._cursors_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._committed = threading.Condition(self._lock)
+        self._closed = False
+        self._dirty_cursors: Dict[bytes, Dict[str, int]] = {}
+        self.topics: Dict[str, TopicLog] = {}
+        for name in os.listdir(self._topics_dir):
+            topic = bytes.fromhex(name).decode('ascii')
+            self.topics[topic] = TopicLog(topic, os.path.join(self._topics_dir, name))
+        self._writer = threading.Thread(target=self._run, name='MessageLogWriter', daemon=True)
+        self._writer.start()
+
+    def _topic_log(self, topic: str) -> TopicLog:
+        log = self.topics.get(topic)
+        if log is None:
+            log = self.topics[topic] = TopicLog(topic, os.path.join(self._topics_dir, topic.encode('ascii').hex()))
+        return log
+
+    def append(self, topic: str, message: bytes) -> int:
+        """
+        Append a message and return its offset in the topic. The message is written asynchronously.
+        """
+        with self._lock:
+            offset = self._topic_log(topic).append(message)
+            self._wakeup.notify()
+            return offset
+
+    def end_offsets(self) -> Dict[str, int]:
+        with self._lock:
+            return {topic: log.next_offset for topic, log in self.topics.items()}
+
+    def read(self, topic: str, start: int, end: int) -> Iterator[Tuple[int, bytes]]:
+        """
+        Yields (offset, message) in [start, end) of a topic, including messages not written yet.
+        Messages removed by retention are skipped.
+        """
+        with self._lock:
+            log = self.topics.get(topic)
+            if log is None:
+                return
+            committed = log.committed_offset
+            segments = log.segments
+            unwritten = list(log.inflight) + list(log.pending)
+        for offset, message in log.read(start, end, committed, segments):
+            yield offset, message
+        for offset, message in unwritten:
+            if start <= offset < end:
+                yield offset, message
+
+    def load_cursor(self, subscriber_id: bytes) -> Optional[Dict[str, int]]:
+        with self._lock:
+            cursor = self._dirty_cursors.get(subscriber_id)
+        if cursor is not None:
+            return dict(cursor)
+        try:
+            with open(self._cursor_path(subscriber_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_cursor(self, subscriber_id: bytes, cursor: Dict[str, int]):
+        """
+        Schedule a cursor to be persisted with the next group commit.
+        """
+        with self._lock:
+            self._dirty_cursors[subscriber_id] = dict(cursor)
+            self._wakeup.notify()
+
+    def _cursor_path(self, subscriber_id: bytes) -> str:
+        return os.path.join(self._cursors_dir, subscriber_id.hex() + CURSOR_SUFFIX)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until everything appended so far is on disk.
+        """
+        with self._lock:
+            targets = [(log, log.next_offset) for log in self.topics.values()]
+            self._wakeup.notify()
+            return self._committed.wait_for(
+                lambda: all(log.committed_offset >= target for log, target in targets), timeout)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify()
+        self._writer.join()
+
+    def _run(self):
+        last_retention = time.monotonic()
+        while True:
+            with self._lock:
+                self._wakeup.wait_for(
+                    lambda: self._closed or self._dirty_cursors or any(log.pending for log in self.topics.values()),
+                    timeout=RETENTION_CHECK_INTERVAL if self._retention_enabled else None)
+                batches = []
+                for log in self.topics.values():
+                    if log.pending:
+                        log.inflight, log.pending = log.pending, []
+                        batches.append(log)
+                cursors, self._dirty_cursors = self._dirty_cursors, {}
+                closed = self._closed
+            try:
+                for log in batches:
+                    log.write(log.inflight, self.segment_bytes, self.fsync)
+                for subscriber_id, cursor in cursors.items():
+                    path = self._cursor_path(subscriber_id)
+                    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                        json.dump(cursor, f)
+                    os.replace(path + '.tmp', path)
+            except OSError:
+                self.logger.exception('Cannot write message log.')
+            with self._lock:
+                for log in batches:
+                    if log.inflight:
+                        log.committed_offset = log.inflight[-1][0] + 1
+                        log.inflight = []
+                self._committed.notify_all()
+                if closed:
+                    for log in self.topics.values():
+                        log.close()
+                    return
+            now = time.monotonic()
+            if self._retention_enabled and now - last_retention >= RETENTION_CHECK_INTERVAL:
+                last_retention = now
+                with self._lock:
+                    for log in self.topics.values():
+                        if log.enforce_retention(self.retention_seconds, self.retention_bytes):
+                            self.logger.info(f'Removed expired segments of topic {log.topic}.')
+            # gather appends arriving meanwhile into the next group
+            time.sleep(self.commit_interval)
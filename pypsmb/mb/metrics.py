@@ -0,0 +1,230 @@
+import bisect
+import logging
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .frame import Frame
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + '}'
+
+
+class _Sharded:
+    """
+    Base of metrics whose samples are kept in one shard per thread, so that updating never takes a lock
+    and never races with other threads; shards are only summed up when collected.
+    """
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._shards: List[dict] = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def _snapshot(self) -> List[dict]:
+        with self._shards_lock:
+            shards = list(self._shards)
+        # copy, the owning threads keep updating them
+        return [dict(shard) for shard in shards]
+
+
+class Counter(_Sharded):
+    type = 'counter'
+
+    def inc(self, *label_values: str, amount: float = 1):
+        shard = self._shard()
+        shard[label_values] = shard.get(label_values, 0) + amount
+
+    def collect(self) -> Dict[Tuple[str, ...], float]:
+        total = {}
+        for shard in self._snapshot():
+            for key, value in shard.items():
+                total[key] = total.get(key, 0) + value
+        return total
+
+    def render(self) -> Iterable[str]:
+        for key, value in sorted(self.collect().items()):
+            yield f'{self.name}{_format_labels(self.labels, key)} {value}'
+
+
+class Gauge(Counter):
+    """
+    A counter which may go down. Sharded like `Counter`, so it is summed up over threads.
+    """
+    type = 'gauge'
+
+    def dec(self, *label_values: str, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(_Sharded):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float):
+        shard = self._shard()
+        counts = shard.get('counts')
+        if counts is None:
+            counts = shard['counts'] = [0] * (len(self.buckets) + 1)
+            shard['sum'] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        shard['sum'] += value
+
+    def render(self) -> Iterable[str]:
+        counts = [0] * (len(self.buckets) + 1)
+        total_sum = 0.0
+        for shard in self._snapshot():
+            for i, count in enumerate(shard.get('counts', ())):
+                counts[i] += count
+            total_sum += shard.get('sum', 0.0)
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{bound}"}} {cumulative}'
+        cumulative += counts[-1]
+        yield f'{self.name}_bucket{{le="+Inf"}} {cumulative}'
+        yield f'{self.name}_sum {total_sum}'
+        yield f'{self.name}_count {cumulative}'
+
+
+class Metrics:
+    """
+    Broker metrics, rendered in the Prometheus text format.
+    Updated from the hot path of every connection, so updates are sharded by thread.
+    """
+
+    def __init__(self):
+        self.publishers = Gauge('psmb_publishers', 'Connected publishers.')
+        self.subscribers = Gauge('psmb_subscribers', 'Connected subscribers.')
+        self.messages_in = Counter('psmb_messages_in_total', 'Messages published.', ('topic',))
+        self.bytes_in = Counter('psmb_bytes_in_total', 'Payload bytes published.', ('topic',))
+        self.messages_out = Counter('psmb_messages_out_total', 'Messages sent to subscribers.', ('topic',))
+        self.bytes_out = Counter('psmb_bytes_out_total', 'Frame bytes sent to subscribers.', ('topic',))
+        self.wakeups = Counter('psmb_subscriber_wakeups_total',
+                               'Times a subscriber was woken up to send what is in its inbox.')
+        self.keepalive_kicks = Counter('psmb_keepalive_kicks_total',
+                                       'Connections closed for not answering keepalive.')
+        self.publisher_pauses = Counter('psmb_publisher_pauses_total',
+                                        'Times a publisher was paused for subscribers of its topic to catch up.',
+                                        ('topic',))
+        self.tls_handshakes = Counter('psmb_tls_handshakes_total',
+                                      'TLS handshakes by result: full, resumed, failed or timeout.', ('result',))
+        self.tls_handshake_latency = Histogram('psmb_tls_handshake_seconds',
+                                               'Duration of successful TLS handshakes.')
+        self.delivery_latency = Histogram('psmb_delivery_latency_seconds',
+                                          'Time from publishing a message to sending it to a subscriber.')
+        self.metrics = [self.publishers, self.subscribers, self.messages_in, self.bytes_in,
+                        self.messages_out, self.bytes_out, self.wakeups, self.keepalive_kicks, self.publisher_pauses,
+                        self.tls_handshakes, self.tls_handshake_latency, self.delivery_latency]
+
+    def published(self, frame: Frame):
+        self.messages_in.inc(frame.topic)
+        self.bytes_in.inc(frame.topic, amount=len(frame.payload))
+
+    def delivered(self, frames: Iterable[Frame]):
+        now = time.monotonic()
+        for frame in frames:
+            self.messages_out.inc(frame.topic)
+            self.bytes_out.inc(frame.topic, amount=len(frame))
+            self.delivery_latency.observe(now - frame.published_at)
+
+    def render(self, dispatcher) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.render())
+        lines.extend(self._render_inboxes(dispatcher))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render_inboxes(dispatcher) -> Iterable[str]:
+        now = time.monotonic()
+        stats = dispatcher.inbox_stats()
+        labels = ('subscriber',)
+        for name, documentation, index in (
+                ('psmb_inbox_messages', 'Messages waiting in the inbox of a subscriber.', 0),
+                ('psmb_inbox_bytes', 'Bytes waiting in the inbox of a subscriber.', 1),
+                ('psmb_inbox_dropped_total', 'Messages dropped from the inbox of a subscriber.', 2)):
+            yield f'# HELP {name} {documentation}'
+            yield f'# TYPE {name} {"counter" if name.endswith("_total") else "gauge"}'
+            for subscriber_id, values in sorted(stats.items()):
+                yield f'{name}{_format_labels(labels, (subscriber_id.decode("ascii"),))} {values[index]}'
+        yield '# HELP psmb_inbox_age_seconds Age of the oldest message in the inbox of a subscriber.'
+        yield '# TYPE psmb_inbox_age_seconds gauge'
+        for subscriber_id, (_, _, _, oldest) in sorted(stats.items()):
+            age = now - oldest if oldest is not None else 0
+            yield f'psmb_inbox_age_seconds{_format_labels(labels, (subscriber_id.decode("ascii"),))} {age}'
+        yield '# HELP psmb_memory_budget_used_bytes Bytes held by all inboxes.'
+        yield '# TYPE psmb_memory_budget_used_bytes gauge'
+        yield f'psmb_memory_budget_used_bytes {dispatcher.memory_budget.used}'
+        if dispatcher.retained is not None:
+            yield '# HELP psmb_retained_messages Topics with a retained message.'
+            yield '# TYPE psmb_retained_messages gauge'
+            yield f'psmb_retained_messages {len(dispatcher.retained)}'
+            yield '# HELP psmb_retained_bytes Frame bytes of the retained messages.'
+            yield '# TYPE psmb_retained_bytes gauge'
+            yield f'psmb_retained_bytes {dispatcher.retained.nbytes}'
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    HTTP listener serving the metrics of a dispatcher at `/metrics`.
+    """
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], dispatcher, sock: Optional[socket.socket] = None):
+        self.dispatcher = dispatcher
+        super().__init__(address, _MetricsRequestHandler, bind_and_activate=sock is None)
+        if sock is not None:
+            # taken over from the previous broker process, bound and listening already
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='MetricsServer', daemon=True).start()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    server: MetricsServer
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.dispatcher.metrics.render(self.server.dispatcher).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger('metrics').debug(format % args)
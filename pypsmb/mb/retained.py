@@ -0,0 +1,97 @@
+import bisect
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import List
+
+from .frame import Frame
+from .subscription_index import PATTERN_LITERAL, PATTERN_PREFIX, analyze_pattern
+
+
+class RetainedStore:
+    """
+    The last retained message of every topic, delivered to subscribers as soon as they subscribe.
+    Frames are kept as published, so a retained message costs its `MSG` frame once whoever it is sent to.
+    Topics are also kept sorted, so that a literal pattern is a dict lookup and a `prefix.*` pattern
+    a range of the sorted list; only other patterns are matched against every topic.
+    When over `max_topics` or `max_bytes` (-1 means unlimited), the least recently updated topics are dropped,
+    as are messages older than `max_age` seconds.
+    """
+
+    def __init__(self, max_topics: int = -1, max_bytes: int = -1, max_age: float = -1):
+        self.max_topics = max_topics
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.nbytes = 0
+        self._frames: OrderedDict[str, Frame] = OrderedDict()  # topic -> frame, least recently updated first
+        self._topics: List[str] = []  # sorted
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(type(self).__name__)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def retain(self, frame: Frame):
+        """
+        Make a frame the retained message of its topic. An empty message clears it instead.
+        """
+        with self._lock:
+            self._discard(frame.topic)
+            if not len(frame.payload):
+                return
+            if 0 <= self.max_bytes < len(frame):
+                self.logger.warning(f'Message of {len(frame)} byte(s) is too large to retain, topic: {frame.topic}.')
+                return
+            self._frames[frame.topic] = frame
+            bisect.insort(self._topics, frame.topic)
+            self.nbytes += len(frame)
+            while (0 <= self.max_topics < len(self._frames)) or (0 <= self.max_bytes < self.nbytes):
+                self._discard(next(iter(self._frames)))
+
+    def _discard(self, topic: str):
+        frame = self._frames.pop(topic, None)
+        if frame is not None:
+            del self._topics[bisect.bisect_left(self._topics, topic)]
+            self.nbytes -= len(frame)
+
+    def _expire(self):
+        deadline = time.monotonic() - self.max_age
+        while self._frames:
+            topic, frame = next(iter(self._frames.items()))
+            if frame.published_at >= deadline:
+                break
+            self._discard(topic)
+
+    def match(self, pattern: str) -> List[Frame]:
+        """
+        Retained messages of the topics fullmatched by a subscription pattern, in topic order.
+        """
+        kind, key = analyze_pattern(pattern)
+        with self._lock:
+            if self.max_age >= 0:
+                self._expire()
+            if kind == PATTERN_LITERAL:
+                frame = self._frames.get(key)
+                return [frame] if frame is not None else []
+            if kind == PATTERN_PREFIX:
+                topics = []
+                for i in range(bisect.bisect_left(self._topics, key), len(self._topics)):
+                    topic = self._topics[i]
+                    if not topic.startswith(key):
+                        break
+                    # `.` does not match a newline
+                    if '\n' not in topic[len(key):]:
+                        topics.append(topic)
+            else:
+                compiled = re.compile(pattern)
+                topics = [topic for topic in self._topics if compiled.fullmatch(topic)]
+            return [self._frames[topic] for topic in topics]
+
+    def frames(self) -> List[Frame]:
+        """
+        All retained messages, least recently updated first.
+        """
+        with self._lock:
+            return list(self._frames.values())
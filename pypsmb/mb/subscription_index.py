@@ -0,0 +1,137 @@
+import re
+import threading
+from typing import Dict, FrozenSet, Tuple
+
+PATTERN_LITERAL = 'literal'
+PATTERN_PREFIX = 'prefix'
+PATTERN_REGEX = 'regex'
+
+_METACHARACTERS = frozenset('.^$*+?{}[]|()')
+
+
+def analyze_pattern(pattern: str) -> Tuple[str, str]:
+    """
+    Classify a subscription pattern. Returns `(PATTERN_LITERAL, topic)` if the pattern only
+    fullmatches `topic`, `(PATTERN_PREFIX, prefix)` if it is `prefix` followed by `.*`,
+    or `(PATTERN_REGEX, pattern)` for anything else.
+    """
+    literal = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            if i + 1 == len(pattern):
+                break
+            n = pattern[i + 1]
+            if n.isascii() and n.isalnum():
+                # character classes (\d, \w...), anchors (\A, \Z...) and back references
+                return PATTERN_REGEX, pattern
+            literal.append(n)
+            i += 2
+        elif c in _METACHARACTERS:
+            break
+        else:
+            literal.append(c)
+            i += 1
+    rest = pattern[i:]
+    if not rest:
+        return PATTERN_LITERAL, ''.join(literal)
+    if rest == '.*':
+        return PATTERN_PREFIX, ''.join(literal)
+    return PATTERN_REGEX, pattern
+
+
+class SubscriptionIndex:
+    """
+    Resolves a topic to the ids of all subscribers whose pattern fullmatches it.
+    Literal and `prefix.*` patterns are served with dict lookups, other patterns with regex,
+    and the resolved set of every topic is cached until the subscriptions change.
+
+    Safe for any number of threads matching while others add and remove, without taking a lock to match:
+    `add` and `remove` take a lock among themselves, and never change in place what `match` iterates.
+    The sets of subscribers are frozensets replaced on change, and the regexes, prefix lengths and the cache
+    are replaced by updated copies, so a match sees either the old or the new version of each.
+    A match caches its result in the cache it started with, which is dropped if the subscriptions
+    changed meanwhile, so a stale result is never cached.
+    """
+
+    def __init__(self, cache_size: int = 4096):
+        self._literals: Dict[str, FrozenSet[bytes]] = {}
+        self._prefixes: Dict[str, FrozenSet[bytes]] = {}
+        self._prefix_lengths: Dict[int, int] = {}  # prefix length -> number of prefixes of that length
+        self._regexes: Dict[bytes, re.Pattern] = {}
+        self._kinds: Dict[bytes, Tuple[str, str]] = {}
+        self._cache: Dict[str, Tuple[bytes, ...]] = {}
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._kinds)
+
+    def __contains__(self, subscriber_id: bytes):
+        return subscriber_id in self._kinds
+
+    def add(self, subscriber_id: bytes, pattern: str):
+        kind, key = analyze_pattern(pattern)
+        compiled = re.compile(pattern) if kind == PATTERN_REGEX else None
+        with self._lock:
+            if kind == PATTERN_LITERAL:
+                self._literals[key] = self._literals.get(key, frozenset()) | {subscriber_id}
+            elif kind == PATTERN_PREFIX:
+                subscribers = self._prefixes.get(key, frozenset())
+                if not subscribers:
+                    lengths = dict(self._prefix_lengths)
+                    lengths[len(key)] = lengths.get(len(key), 0) + 1
+                    self._prefix_lengths = lengths
+                self._prefixes[key] = subscribers | {subscriber_id}
+            else:
+                self._regexes = {**self._regexes, subscriber_id: compiled}
+            self._kinds[subscriber_id] = kind, key
+            self._cache = {}
+
+    def remove(self, subscriber_id: bytes):
+        with self._lock:
+            kind, key = self._kinds.pop(subscriber_id)
+            if kind == PATTERN_LITERAL:
+                subscribers = self._literals[key] - {subscriber_id}
+                if subscribers:
+                    self._literals[key] = subscribers
+                else:
+                    del self._literals[key]
+            elif kind == PATTERN_PREFIX:
+                subscribers = self._prefixes[key] - {subscriber_id}
+                if subscribers:
+                    self._prefixes[key] = subscribers
+                else:
+                    del self._prefixes[key]
+                    lengths = dict(self._prefix_lengths)
+                    lengths[len(key)] -= 1
+                    if not lengths[len(key)]:
+                        del lengths[len(key)]
+                    self._prefix_lengths = lengths
+            else:
+                regexes = dict(self._regexes)
+                del regexes[subscriber_id]
+                self._regexes = regexes
+            self._cache = {}
+
+    def match(self, topic: str) -> Tuple[bytes, ...]:
+        # taken first: if the subscriptions change while resolving, the result goes to a dropped cache
+        cache = self._cache
+        subscribers = cache.get(topic)
+        if subscribers is None:
+            subscribers = self._resolve(topic)
+            if len(cache) >= self._cache_size:
+                cache.clear()
+            cache[topic] = subscribers
+        return subscribers
+
+    def _resolve(self, topic: str) -> Tuple[bytes, ...]:
+        matched = set(self._literals.get(topic, ()))
+        for length in self._prefix_lengths:
+            # `.` does not match a newline
+            if length <= len(topic) and '\n' not in topic[length:]:
+                matched.update(self._prefixes.get(topic[:length], ()))
+        matched.update(subscriber_id for subscriber_id, pattern in self._regexes.items()
+                       if pattern.fullmatch(topic))
+        return tuple(matched)
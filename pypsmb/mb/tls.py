@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import selectors
+import socket
+import ssl
+import time
+from typing import Optional, Union
+
+from .metrics import Metrics
+from ..util import Selector
+
+DEFAULT_HANDSHAKE_TIMEOUT = 10
+DEFAULT_SESSION_TICKETS = 2
+
+
+def server_context(certchain: str, privatekey: Optional[str] = None,
+                   session_tickets: int = DEFAULT_SESSION_TICKETS) -> ssl.SSLContext:
+    """
+    TLS context of the listener. Reconnecting clients resume their session instead of doing a full handshake:
+    with `session_tickets` tickets issued after a TLS 1.3 handshake, or with a ticket or the server session cache
+    for TLS 1.2. Tickets are only valid on the process which issued them, so with multiple workers
+    a resumption succeeds if the kernel hands the connection to the same worker.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certchain, privatekey)
+    context.options &= ~ssl.OP_NO_TICKET
+    if hasattr(context, 'num_tickets'):  # OpenSSL 1.1.1
+        context.num_tickets = session_tickets
+    return context
+
+
+def _record(metrics: Metrics, ssl_object: Union[ssl.SSLSocket, ssl.SSLObject], start: float):
+    metrics.tls_handshake_latency.observe(time.monotonic() - start)
+    metrics.tls_handshakes.inc('resumed' if ssl_object.session_reused else 'full')
+
+
+def handshake(sock: socket.socket, addr, context: ssl.SSLContext, timeout: float,
+              metrics: Metrics) -> Optional[ssl.SSLSocket]:
+    """
+    Do the server side TLS handshake on an accepted socket, within `timeout` seconds (unlimited if negative).
+    Returns the TLS socket, or None if the handshake failed, in which case the socket is closed.
+    """
+    logger = logging.getLogger('tls,%s:%d' % addr)
+    start = time.monotonic()
+    # non-blocking, a timeout on the socket would bound every read rather than the whole handshake
+    sock.setblocking(False)
+    tls_sock = context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+    try:
+        _do_handshake(tls_sock, start + timeout if timeout > 0 else None)
+    except socket.timeout:
+        logger.info('TLS handshake timed out.')
+        metrics.tls_handshakes.inc('timeout')
+        tls_sock.close()
+        return None
+    except (ssl.SSLError, OSError) as e:
+        logger.info(f'TLS handshake failed: {e}')
+        metrics.tls_handshakes.inc('failed')
+        tls_sock.close()
+        return None
+    tls_sock.setblocking(True)
+    _record(metrics, tls_sock, start)
+    return tls_sock
+
+
+def _do_handshake(tls_sock: ssl.SSLSocket, deadline: Optional[float]):
+    with Selector() as selector:
+        selector.register(tls_sock, selectors.EVENT_READ)
+        while True:
+            try:
+                tls_sock.do_handshake()
+                return
+            except ssl.SSLWantReadError:
+                selector.modify(tls_sock, selectors.EVENT_READ)
+            except ssl.SSLWantWriteError:
+                selector.modify(tls_sock, selectors.EVENT_WRITE)
+            if not selector.select(max(deadline - time.monotonic(), 0) if deadline is not None else None):
+                raise socket.timeout('TLS handshake timed out')
+
+
+async def handshake_async(writer: asyncio.StreamWriter, context: ssl.SSLContext, timeout: float,
+                          metrics: Metrics) -> bool:
+    """
+    Upgrade an accepted stream to TLS, the counterpart of `handshake`. Must be awaited before anything
+    is read from the stream. Returns False if the handshake failed, in which case the stream is closed.
+    """
+    addr = writer.get_extra_info('peername')[:2]
+    logger = logging.getLogger('tls,%s:%d' % addr)
+    start = time.monotonic()
+    try:
+        await writer.start_tls(context, ssl_handshake_timeout=timeout if timeout > 0 else None)
+    except ConnectionAbortedError:
+        # raised by asyncio when the handshake timeout expires
+        logger.info('TLS handshake timed out.')
+        metrics.tls_handshakes.inc('timeout')
+        writer.close()
+        return False
+    except (ssl.SSLError, OSError) as e:
+        logger.info(f'TLS handshake failed: {e}')
+        metrics.tls_handshakes.inc('failed')
+        writer.close()
+        return False
+    _record(metrics, writer.get_extra_info('ssl_object'), start)
+    return True
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+from typing import Callable, Dict, List
+
+from .frame import Frame
+from .message_dispatcher import MessageDispatcher
+from ..util import send_buffers
+from ..util.framing import RETAIN_COMMAND, AsyncStreamReader, FrameDecoder, SocketReader
+
+# origin of messages received from another worker of the same broker
+ORIGIN_WORKER = 'worker'
+
+
+class WorkerFanout:
+    """
+    Connects the dispatcher of a worker process to the dispatchers of the other workers.
+    Every message published in this worker is forwarded to each other worker over a Unix stream socket,
+    which keeps the order of messages from one publisher. Messages from other workers are published locally.
+    On the wire a forwarded message is the topic as a cstring followed by its `MSG` frame,
+    or a `RET` frame if it is retained, so that every worker has the same retained messages.
+    """
+
+    def __init__(self, dispatcher: MessageDispatcher, worker_id: int, peers: Dict[int, socket.socket]):
+        self.dispatcher = dispatcher
+        self.worker_id = worker_id
+        self.peers = peers  # worker id -> socket connected to that worker
+        self.logger = logging.getLogger(f'{type(self).__name__},{worker_id}')
+        self._locks = {peer_id: threading.Lock() for peer_id in peers}
+        self._writers: Dict[int, asyncio.StreamWriter] = {}
+        dispatcher.forwarders.append(self.forward)
+
+    def forward(self, frame: Frame, origin):
+        if origin is ORIGIN_WORKER:
+            return  # the publishing worker sends it to everyone itself
+        buffers = [frame.topic.encode('ascii') + b'\0', frame.data]
+        if frame.retained:
+            buffers = [buffers[0] + RETAIN_COMMAND, memoryview(frame.data)[len(RETAIN_COMMAND):]]
+        if self._writers:
+            for writer in self._writers.values():
+                writer.writelines(buffers)
+            return
+        for peer_id, peer in self.peers.items():
+            try:
+                with self._locks[peer_id]:
+                    send_buffers(peer, buffers)
+            except OSError:
+                self.logger.exception(f'Cannot forward message to worker {peer_id}.')
+
+    def _dispatch(self, topic: bytes, command: bytes, message: bytes):
+        if command not in (b'MSG', RETAIN_COMMAND):
+            raise ValueError(f'Invalid command from worker: {command!r}')
+        self.dispatcher.publish(message, topic.decode('ascii'), origin=ORIGIN_WORKER,
+                                retain=command == RETAIN_COMMAND)
+
+    def _receive(self, peer_id: int, peer: socket.socket):
+        # the limits are for untrusted clients, messages from workers are checked already
+        reader = SocketReader(peer, FrameDecoder(sys.maxsize, sys.maxsize))
+        try:
+            while True:
+                topic = reader.read_cstring()
+                self._dispatch(topic, *reader.read_command())
+        except Exception:
+            self.logger.exception(f'Link to worker {peer_id} is broken.')
+
+    def start_threads(self):
+        """
+        Receive messages of other workers with one thread per worker, for the threaded engine.
+        """
+        for peer_id, peer in self.peers.items():
+            threading.Thread(target=self._receive, args=(peer_id, peer),
+                             name=f'WorkerFanout-{peer_id}', daemon=True).start()
+
+    async def start_async(self):
+        """
+        Receive messages of other workers on the running event loop, for the asyncio engine.
+        """
+        for peer_id, peer in self.peers.items():
+            reader, writer = await asyncio.open_unix_connection(sock=peer)
+            self._writers[peer_id] = writer
+            asyncio.ensure_future(self._receive_async(peer_id, reader))
+
+    async def drain(self):
+        """
+        Wait until the messages forwarded so far fit in the buffers of the links, for the asyncio engine.
+        Awaited by publishers, which are slowed down to the pace of the slowest worker, as the blocking sends
+        of the threaded engine do.
+        """
+        for writer in self._writers.values():
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass  # reported by _receive_async
+
+    async def _receive_async(self, peer_id: int, stream: asyncio.StreamReader):
+        reader = AsyncStreamReader(stream, FrameDecoder(sys.maxsize, sys.maxsize))
+        try:
+            while True:
+                topic = await reader.read_cstring()
+                self._dispatch(topic, *await reader.read_command())
+        except Exception:
+            self.logger.exception(f'Link to worker {peer_id} is broken.')
+
+
+def run_workers(num_workers: int, serve: Callable[[int, Dict[int, socket.socket]], None]):
+    """
+    Fork `num_workers` processes, each running `serve(worker_id, peers)` where `peers` maps the id of every
+    other worker to a connected Unix socket. Returns when all workers exit; SIGINT/SIGTERM are passed on.
+    """
+    logger = logging.getLogger('workers')
+    links: Dict[int, Dict[int, socket.socket]] = {i: {} for i in range(num_workers)}
+    for i in range(num_workers):
+        for j in range(i + 1, num_workers):
+            links[i][j], links[j][i] = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    pids: List[int] = []
+    for worker_id in range(num_workers):
+        pid = os.fork()
+        if pid == 0:
+            for other_id, other_links in links.items():
+                if other_id != worker_id:
+                    for sock in other_links.values():
+                        sock.close()
+            code = 0
+            try:
+                serve(worker_id, links[worker_id])
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                logger.exception(f'Worker {worker_id} crashed.')
+                code = 1
+            finally:
+                os._exit(code)
+        pids.append(pid)
+        logger.info(f'Started worker {worker_id} (pid {pid}).')
+
+    for worker_links in links.values():
+        for sock in worker_links.values():
+            sock.close()
+
+    def stop(signum, _):
+        for child in pids:
+            try:
+                os.kill(child, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for pid in pids:
+        while True:
+            try:
+                os.waitpid(pid, 0)
+                break
+            except InterruptedError:
+                continue
@@ -1 +1,4 @@
-from .sockutil import read_exactly, read_cstring
+from .sockutil import Selector, create_unix_server, hung_up, peer_address, read_exactly, send_buffers, set_nodelay, \
+    wait_hangup, writable
+from .framing import AsyncStreamReader, FrameDecoder, FrameTooLargeError, MalformedFrameError, SocketReader
+from .wakeup import Wakeup
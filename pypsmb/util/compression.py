@@ -0,0 +1,82 @@
+import abc
+import zlib
+from typing import Dict, Optional, Sequence, Type, Union
+
+from .framing import COMPRESSED_COMMAND, LENGTH_FIELD, FrameTooLargeError, MalformedFrameError
+
+DEFAULT_MIN_BYTES = 256
+
+
+class Codec(abc.ABC):
+    """
+    Compression of message payloads, enabled on a connection by one bit of the handshake options.
+    A compressed message is sent as a `CMP` frame; payloads under `min_bytes`,
+    or which do not get smaller, are sent in plain `MSG` frames.
+    """
+    name: str
+    option: int
+
+    def __init__(self, min_bytes: int = DEFAULT_MIN_BYTES, level: Optional[int] = None):
+        self.min_bytes = min_bytes
+        self.level = level  # None means the default of the codec
+
+    @abc.abstractmethod
+    def compress(self, data: Union[bytes, memoryview]) -> bytes:
+        """
+        The compressed body of a `CMP` frame.
+        """
+
+    @abc.abstractmethod
+    def decompress(self, data: Union[bytes, memoryview], max_bytes: int = -1) -> bytes:
+        """
+        Raises `FrameTooLargeError` if the result would be larger than `max_bytes` (unless it is negative)
+        and `MalformedFrameError` if the data is corrupt.
+        """
+
+    def encode(self, payload: Union[bytes, memoryview]) -> Optional[bytes]:
+        """
+        Returns the `CMP` frame of a payload, or None if it should be sent as is.
+        """
+        if len(payload) < self.min_bytes:
+            return None
+        body = self.compress(payload)
+        if len(body) >= len(payload):
+            return None
+        return COMPRESSED_COMMAND + len(body).to_bytes(LENGTH_FIELD, 'big', signed=False) + body
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+    option = 2
+
+    def compress(self, data: Union[bytes, memoryview]) -> bytes:
+        return zlib.compress(data, -1 if self.level is None else self.level)
+
+    def decompress(self, data: Union[bytes, memoryview], max_bytes: int = -1) -> bytes:
+        decompressor = zlib.decompressobj()
+        try:
+            result = decompressor.decompress(data, max(max_bytes, 0))
+        except zlib.error as e:
+            raise MalformedFrameError(f'Cannot decompress message: {e}')
+        if decompressor.unconsumed_tail:
+            raise FrameTooLargeError(f'Decompressed message is larger than {max_bytes} byte(s)')
+        if not decompressor.eof:
+            raise MalformedFrameError('Compressed message is truncated')
+        return result
+
+
+# codec classes by name, used in the configuration
+CODECS: Dict[str, Type[Codec]] = {codec.name: codec for codec in (ZlibCodec,)}
+CODEC_OPTIONS = 0
+for _codec in CODECS.values():
+    CODEC_OPTIONS |= _codec.option
+
+
+def negotiate_codec(options: int, codecs: Sequence[Codec]) -> Optional[Codec]:
+    """
+    The first of `codecs` requested in the handshake `options`, if any.
+    """
+    for codec in codecs:
+        if options & codec.option:
+            return codec
+    return None
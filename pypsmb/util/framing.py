@@ -0,0 +1,244 @@
+import asyncio
+import socket
+import struct
+from asyncio import IncompleteReadError
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+DEFAULT_MAX_CSTRING = 4096
+DEFAULT_MAX_MESSAGE = 64 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+COMMAND_LENGTH = 3
+LENGTH_FIELD = 8
+# commands followed by a uint64 length and that many bytes
+PAYLOAD_COMMANDS = frozenset({b'MSG', b'FWD', b'BAT', b'CMP', b'RET'})
+
+# bits of the handshake options, see also compression.CODECS
+OPTION_BATCH = 1  # `BAT` frames may be exchanged
+OPTION_FLOW_CONTROL = 4  # publishers are sent `WIN` frames
+OPTION_RETAIN = 8  # publishers may send `RET` frames
+
+BATCH_COMMAND = b'BAT'
+COMPRESSED_COMMAND = b'CMP'  # one message compressed with the negotiated codec
+WINDOW_COMMAND = b'WIN'  # followed by a uint64, how many bytes a publisher may send before it is paused
+RETAIN_COMMAND = b'RET'  # one message to publish and retain as the last message of the topic
+# in the body of a `BAT` frame, every message is prefixed with its length
+_BATCH_LENGTH = struct.Struct('>I')
+
+
+class FrameTooLargeError(ValueError):
+    """
+    A length received from the peer is over the configured limit.
+    """
+    pass
+
+
+class MalformedFrameError(ValueError):
+    """
+    A frame received from the peer is not well-formed.
+    """
+    pass
+
+
+def encode_batch(messages: Iterable[Union[bytes, memoryview]]) -> bytes:
+    """
+    Encode messages into one `BAT` frame.
+    """
+    parts = [b'']
+    size = 0
+    for message in messages:
+        parts.append(_BATCH_LENGTH.pack(len(message)))
+        parts.append(message)
+        size += _BATCH_LENGTH.size + len(message)
+    parts[0] = BATCH_COMMAND + size.to_bytes(LENGTH_FIELD, 'big', signed=False)
+    return b''.join(parts)
+
+
+def decode_batch(body: Union[bytes, memoryview]) -> List[memoryview]:
+    """
+    Split the body of a `BAT` frame into its messages, which are views of the body.
+    """
+    view = memoryview(body)
+    messages = []
+    pos = 0
+    while pos < len(view):
+        if pos + _BATCH_LENGTH.size > len(view):
+            raise MalformedFrameError('Batch ends inside a message length')
+        (length,) = _BATCH_LENGTH.unpack_from(view, pos)
+        pos += _BATCH_LENGTH.size
+        if pos + length > len(view):
+            raise MalformedFrameError('Batch ends inside a message')
+        messages.append(view[pos:pos + length])
+        pos += length
+    return messages
+
+
+class FrameDecoder:
+    """
+    Incremental PSMB decoder. Bytes received from the peer are `feed`-ed in chunks of any size,
+    and complete fields are taken out; a `take_*` method returns None and consumes nothing
+    if the field is not complete yet. The decoder does no I/O, so it can be driven by blocking sockets,
+    asyncio streams or protocols alike.
+    """
+
+    def __init__(self, max_cstring: int = DEFAULT_MAX_CSTRING, max_message: int = DEFAULT_MAX_MESSAGE):
+        self.max_cstring = max_cstring
+        self.max_message = max_message
+        self._buffer = bytearray()
+        self._pos = 0  # bytes before it are consumed
+
+    def __len__(self):
+        return len(self._buffer) - self._pos
+
+    def feed(self, data: Union[bytes, bytearray, memoryview]):
+        if self._pos and self._pos >= len(self._buffer) // 2:
+            # compact lazily so that consuming is O(1)
+            del self._buffer[:self._pos]
+            self._pos = 0
+        self._buffer += data
+
+    def take(self, num_bytes: int) -> Optional[bytes]:
+        end = self._pos + num_bytes
+        if end > len(self._buffer):
+            return None
+        data = bytes(self._buffer[self._pos:end])
+        self._pos = end
+        return data
+
+    def take_cstring(self) -> Optional[bytes]:
+        """
+        Take a string terminated with '\\0', without the terminator.
+        """
+        end = self._buffer.find(b'\0', self._pos, self._pos + self.max_cstring + 1)
+        if end < 0:
+            if len(self) > self.max_cstring:
+                raise FrameTooLargeError(f'String is longer than {self.max_cstring} byte(s)')
+            return None
+        data = bytes(self._buffer[self._pos:end])
+        self._pos = end + 1
+        return data
+
+    def take_command(self) -> Optional[Tuple[bytes, Optional[bytes]]]:
+        """
+        Take a message exchanging command. Returns (command, payload), payload is None for commands
+        without one. Unknown commands are returned as is, validating them is up to the caller.
+        """
+        if len(self) < COMMAND_LENGTH:
+            return None
+        command = bytes(self._buffer[self._pos:self._pos + COMMAND_LENGTH])
+        if command not in PAYLOAD_COMMANDS:
+            self._pos += COMMAND_LENGTH
+            return command, None
+        header_end = self._pos + COMMAND_LENGTH + LENGTH_FIELD
+        if header_end > len(self._buffer):
+            return None
+        length = int.from_bytes(self._buffer[self._pos + COMMAND_LENGTH:header_end], 'big', signed=False)
+        if length > self.max_message:
+            raise FrameTooLargeError(f'Message of {length} byte(s) is larger than {self.max_message} byte(s)')
+        end = header_end + length
+        if end > len(self._buffer):
+            return None
+        payload = bytes(self._buffer[header_end:end])
+        self._pos = end
+        return command, payload
+
+    def commands(self) -> Iterator[Tuple[bytes, Optional[bytes]]]:
+        """
+        Take all complete commands in the buffer.
+        """
+        while (command := self.take_command()) is not None:
+            yield command
+
+
+class SocketReader:
+    """
+    Reads PSMB fields from a blocking socket through a `FrameDecoder`, receiving in large chunks.
+    """
+
+    def __init__(self, sock: socket.socket, decoder: Optional[FrameDecoder] = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.sock = sock
+        self.decoder = decoder or FrameDecoder()
+        self._chunk = bytearray(chunk_size)
+
+    @property
+    def buffered(self) -> bool:
+        """
+        Whether some received bytes are not consumed yet. If so, `select` on the socket may not report them.
+        """
+        return len(self.decoder) > 0
+
+    def _fill(self, expected: int):
+        n = self.sock.recv_into(self._chunk)
+        if n == 0:
+            raise IncompleteReadError(b'', expected)
+        self.decoder.feed(memoryview(self._chunk)[:n])
+
+    def read_exactly(self, num_bytes: int) -> bytes:
+        while (data := self.decoder.take(num_bytes)) is None:
+            self._fill(num_bytes)
+        return data
+
+    def read_cstring(self) -> bytes:
+        while (data := self.decoder.take_cstring()) is None:
+            self._fill(1)
+        return data
+
+    def read_command(self) -> Tuple[bytes, Optional[bytes]]:
+        while (command := self.decoder.take_command()) is None:
+            self._fill(COMMAND_LENGTH)
+        return command
+
+    def take_buffered(self) -> bytes:
+        """
+        Take the bytes received but not consumed yet, when the socket is to be read by someone else.
+        """
+        return self.decoder.take(len(self.decoder))
+
+
+class AsyncStreamReader:
+    """
+    Reads PSMB fields from an asyncio stream through a `FrameDecoder`.
+    All methods are safe to cancel, no partially received field is lost.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, decoder: Optional[FrameDecoder] = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.reader = reader
+        self.decoder = decoder or FrameDecoder()
+        self.chunk_size = chunk_size
+
+    async def _fill(self, expected: int):
+        data = await self.reader.read(self.chunk_size)
+        if not data:
+            raise IncompleteReadError(b'', expected)
+        self.decoder.feed(data)
+
+    async def read_exactly(self, num_bytes: int) -> bytes:
+        while (data := self.decoder.take(num_bytes)) is None:
+            await self._fill(num_bytes)
+        return data
+
+    async def read_cstring(self) -> bytes:
+        while (data := self.decoder.take_cstring()) is None:
+            await self._fill(1)
+        return data
+
+    async def read_command(self) -> Tuple[bytes, Optional[bytes]]:
+        while (command := self.decoder.take_command()) is None:
+            await self._fill(COMMAND_LENGTH)
+        return command
+
+    def take_buffered(self) -> Optional[bytes]:
+        """
+        Take the bytes received but not consumed yet, including those still buffered by the stream,
+        when the socket is to be read by someone else. Returns None if the stream does not let them be taken.
+        """
+        # StreamReader has no public way to take its buffer without waiting. Its private `_buffer` is a bytearray
+        # in CPython (and PyPy, which shares asyncio); elsewhere the connection is not handed over
+        buffer = getattr(self.reader, '_buffer', None)
+        if not isinstance(buffer, bytearray):
+            return None
+        data = self.decoder.take(len(self.decoder)) + bytes(buffer)
+        buffer.clear()
+        return data
@@ -1,5 +1,13 @@
+import os
+import select
+import selectors
+import shutil
 import socket
+import ssl
+import stat
+import struct
 from asyncio import IncompleteReadError
+from typing import List, Optional, Tuple, Union
 
 
 def read_exactly(sock: socket.socket, num_bytes: int) -> bytes:
@@ -13,12 +21,138 @@ def read_exactly(sock: socket.socket, num_bytes: int) -> bytes:
     return bytes(buf)
 
 
-def read_cstring(sock: socket.socket, max_bytes: int = -1) -> bytes:
-    buffer = b''
-    size = 0
-    while (c := sock.recv(1)) != b'\0':
-        buffer += c
-        size += 1
-        if size >= max_bytes > 0:
-            break
-    return buffer
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+# poll() has no limit on descriptor numbers unlike select(), and takes no descriptor itself unlike epoll
+Selector = getattr(selectors, 'PollSelector', selectors.SelectSelector)
+
+
+def writable(sock: socket.socket) -> bool:
+    """
+    Whether sending to a socket would not block, checked without waiting.
+    """
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT)
+        return bool(poller.poll(0))
+    return bool(select.select([], [sock], [], 0)[1])
+
+
+def _hangup_events() -> int:
+    return select.POLLHUP | select.POLLERR | getattr(select, 'POLLRDHUP', 0)
+
+
+def wait_hangup(sock: socket.socket, wakeup: int) -> bool:
+    """
+    Wait until the descriptor `wakeup` is readable or the connection of `sock` is gone, without reading from it.
+    Returns True if the connection is gone: reset by the peer or shut down by this side, or closed by the peer
+    where poll() has POLLRDHUP (Linux). A peer which closes while unable to send is only seen once it resets.
+    """
+    if not hasattr(select, 'poll'):
+        _, _, failed = select.select([wakeup], [], [sock])
+        return bool(failed)
+    poller = select.poll()
+    poller.register(wakeup, select.POLLIN)
+    poller.register(sock, _hangup_events())
+    return all(fd != wakeup for fd, _ in poller.poll())
+
+
+def hung_up(sock: socket.socket) -> bool:
+    """
+    Whether the connection of `sock` is gone, see `wait_hangup`, checked without waiting.
+    """
+    if not hasattr(select, 'poll'):
+        return bool(select.select([], [], [sock], 0)[2])
+    poller = select.poll()
+    poller.register(sock, _hangup_events())
+    return bool(poller.poll(0))
+
+
+def set_nodelay(sock: socket.socket, nodelay: bool = True):
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+
+
+def create_unix_server(path: str, mode: Optional[int] = None, group: Optional[str] = None,
+                       backlog: Optional[int] = None) -> socket.socket:
+    """
+    Listen on a Unix domain socket at `path`, with the permissions `mode` and the group `group` if given,
+    both set before it starts listening. A socket file left by a broker which is gone is replaced;
+    raises `OSError` if another process is listening on it, or the path is something else.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        pass
+    else:
+        if not stat.S_ISSOCK(st.st_mode):
+            raise FileExistsError(f'{path} exists and is not a socket')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(path)
+            except ConnectionRefusedError:
+                os.unlink(path)  # stale
+            else:
+                raise OSError(f'Another process is listening on {path}')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.bind(path)
+        # connections are refused until listen(), so nobody gets in with the default permissions
+        if mode is not None:
+            os.chmod(path, mode)
+        if group is not None:
+            shutil.chown(path, group=group)
+        if backlog is None:
+            sock.listen()
+        else:
+            sock.listen(backlog)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def peer_address(sock: socket.socket) -> Tuple[str, int]:
+    """
+    (host, port) of the peer of a TCP socket. For a Unix domain socket, ('unix', pid of the peer),
+    where the pid is 0 if the platform does not tell it.
+    """
+    if sock.family != getattr(socket, 'AF_UNIX', None):
+        return tuple(sock.getpeername()[:2])
+    pid = 0
+    if hasattr(socket, 'SO_PEERCRED'):  # Linux
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        pid, _, _ = struct.unpack('3i', creds)
+    return 'unix', pid
+
+
+def send_buffers(sock: socket.socket, buffers: List[Union[bytes, memoryview]], cork: bool = False):
+    """
+    Send all buffers with as few syscalls as possible, using scatter/gather I/O when the socket supports it.
+    If `cork` is set, TCP_CORK (Linux only) is held during the send so the data leaves in full-sized segments.
+    """
+    corked = cork and hasattr(socket, 'TCP_CORK') and sock.family in (socket.AF_INET, socket.AF_INET6)
+    if corked:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+    try:
+        if isinstance(sock, ssl.SSLSocket) or not hasattr(sock, 'sendmsg'):
+            # TLS records are built from a single buffer anyway
+            sock.sendall(b''.join(buffers))
+            return
+        views = [memoryview(b) for b in buffers]
+        i = 0
+        while i < len(views):
+            n = sock.sendmsg(views[i:i + IOV_MAX])
+            # skip fully sent buffers, keep the rest of a partially sent one
+            while i < len(views) and n >= len(views[i]):
+                n -= len(views[i])
+                i += 1
+            if n:
+                views[i] = views[i][n:]
+    finally:
+        if corked:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
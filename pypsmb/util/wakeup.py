@@ -0,0 +1,61 @@
+import os
+import socket
+import threading
+
+
+class Wakeup:
+    """
+    Waitable flag with a file descriptor, readable while the flag is set, for selecting on along with sockets.
+    Setting it when it is set already costs no syscall, so a burst of `set` from producers makes one wakeup;
+    the consumer calls `clear` before taking what it was woken up for.
+    Uses an eventfd where available (one descriptor), otherwise a socket pair.
+    """
+
+    def __init__(self):
+        self._is_set = False
+        self._closed = False
+        self._lock = threading.Lock()
+        if hasattr(os, 'eventfd'):  # Linux, Python 3.10
+            self._fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            self._rsock = self._wsock = None
+        else:
+            self._rsock, self._wsock = socket.socketpair()
+            self._rsock.setblocking(False)
+            self._fd = None
+
+    def fileno(self) -> int:
+        return self._fd if self._fd is not None else self._rsock.fileno()
+
+    def set(self):
+        if self._is_set:
+            return
+        with self._lock:
+            if self._is_set or self._closed:
+                # a raw descriptor may be reused once closed, so never write to it
+                return
+            self._is_set = True
+            if self._fd is not None:
+                os.eventfd_write(self._fd, 1)
+            else:
+                self._wsock.send(b'\x00')
+
+    def clear(self):
+        with self._lock:
+            if not self._is_set:
+                return
+            self._is_set = False
+            if self._fd is not None:
+                os.eventfd_read(self._fd)
+            else:
+                self._rsock.recv(1)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._fd is not None:
+                os.close(self._fd)
+            else:
+                self._rsock.close()
+                self._wsock.close()
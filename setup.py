@@ -41,6 +41,7 @@ setup(
     entry_points={
         'console_scripts': [
             'pypsmb=pypsmb:main',
+            'pypsmb-bench=pypsmb.bench:main',
         ],
     },
     project_urls={
@@ -0,0 +1,18 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize('engine', ['threaded', 'asyncio'])
+def test_in_process_bench_exits(engine):
+    # the handler threads of the threaded engine keep the process alive until the connections are closed
+    result = subprocess.run([sys.executable, '-m', 'pypsmb.bench', '--broker', 'in-process', '--engine', engine,
+                             '--duration', '1'], cwd=ROOT, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    report = json.loads(result.stdout)
+    assert report['result']['delivered'] == report['result']['expected_deliveries'] > 0
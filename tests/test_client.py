@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+from pypsmb.client import PublishProtocol, SubscribeProtocol
+from pypsmb.util.framing import OPTION_BATCH
+
+
+class Transport(asyncio.Transport):
+    def __init__(self, protocol: asyncio.Protocol):
+        super().__init__()
+        self.protocol = protocol
+        self.written = b''
+        self.closed = False
+
+    def write(self, data):
+        self.written += data
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.protocol.connection_lost(None)
+
+
+def _connect(protocol: asyncio.Protocol) -> Transport:
+    transport = Transport(protocol)
+    protocol.connection_made(transport)
+    return transport
+
+
+def _subscriber(loop: asyncio.AbstractEventLoop, received: list, **kwargs) -> SubscribeProtocol:
+    return SubscribeProtocol('t', received.append, on_con_lost=loop.create_future(), exchange_ready=asyncio.Event(),
+                             **kwargs)
+
+
+async def _accepted(protocol, options: int = 0) -> Transport:
+    transport = _connect(protocol)
+    protocol.data_received(b'OK\0' + options.to_bytes(4, 'big') + b'OK\0')
+    return transport
+
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_options_not_requested_are_refused(batch):
+    async def run():
+        protocol = _subscriber(asyncio.get_running_loop(), [], batch=batch)
+        transport = await _accepted(protocol, OPTION_BATCH | 0x80)
+        assert transport.closed
+        assert not protocol.exchange_ready.is_set()
+        assert 'not requested' in str(protocol.error)
+
+    asyncio.run(run())
+
+
+def test_requested_options_are_accepted():
+    async def run():
+        received = []
+        protocol = _subscriber(asyncio.get_running_loop(), received, batch=True)
+        transport = await _accepted(protocol, OPTION_BATCH)
+        protocol.data_received(b'MSG' + (2).to_bytes(8, 'big') + b'hi')
+        assert not transport.closed
+        assert protocol.error is None
+        assert [bytes(message) for message in received] == [b'hi']
+
+    asyncio.run(run())
+
+
+def test_compressed_message_without_codec_is_refused():
+    async def run():
+        received = []
+        protocol = _subscriber(asyncio.get_running_loop(), received)
+        transport = await _accepted(protocol)
+        protocol.data_received(b'CMP' + (2).to_bytes(8, 'big') + b'hi' + b'MSG' + (2).to_bytes(8, 'big') + b'hi')
+        assert transport.closed
+        assert 'codec' in str(protocol.error)
+        assert received == []
+
+    asyncio.run(run())
+
+
+def test_unknown_command_is_refused():
+    async def run():
+        received = []
+        subscriber = _subscriber(asyncio.get_running_loop(), received)
+        transport = await _accepted(subscriber)
+        subscriber.data_received(b'XYZ' + b'MSG' + (2).to_bytes(8, 'big') + b'hi')
+        assert transport.closed
+        assert 'XYZ' in str(subscriber.error)
+        assert received == []
+
+        publisher = PublishProtocol('t', asyncio.get_running_loop().create_future(), asyncio.Event())
+        transport = await _accepted(publisher)
+        publisher.data_received(b'NIL' + b'XYZ')
+        assert transport.closed
+        assert 'XYZ' in str(publisher.error)
+
+    asyncio.run(run())
@@ -0,0 +1,170 @@
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+from pypsmb import mb
+from pypsmb.mb.frame import Frame
+from pypsmb.mb.inbox import Inbox, MemoryBudget
+
+PUBLISHERS = 100
+CHURNERS = 100
+MESSAGES = 500
+TIMEOUT = 60
+
+# (pattern, topic of a publisher it matches, topic of one it does not) of the churning subscribers:
+# literals, prefixes and regexes overlapping one another and the steady subscribers
+CHURN_PATTERNS = [
+    ('room7', 'room7', 'room8'),
+    ('room.*', 'room12', 'lobby'),
+    ('room1.*', 'room15', 'room2'),
+    (r'room\d*[02468]', 'room4', 'room5'),
+    (r'room(1|2)\d', 'room21', 'room3'),
+    ('.*', 'room99', None),
+]
+
+
+class Threads:
+    """
+    Threads started together, which record what they raise instead of losing it.
+    """
+
+    def __init__(self):
+        self.threads: List[threading.Thread] = []
+        self.errors: List[BaseException] = []
+        self._targets = []
+
+    def add(self, target: Callable, *args):
+        self._targets.append((target, args))
+
+    def _run(self, start: threading.Barrier, target: Callable, args):
+        try:
+            start.wait()
+            target(*args)
+        except BaseException as e:
+            self.errors.append(e)
+
+    def start(self):
+        start = threading.Barrier(len(self._targets))
+        self.threads = [threading.Thread(target=self._run, args=(start, target, args))
+                        for target, args in self._targets]
+        for thread in self.threads:
+            thread.start()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join(TIMEOUT)
+        assert not any(thread.is_alive() for thread in self.threads)
+        assert not self.errors, self.errors
+
+
+def _message(producer: int, seq: int) -> bytes:
+    return b'%d:%d' % (producer, seq)
+
+
+def _check(received: List[bytes], producers: List[int]):
+    """
+    Every message of the given producers, each once and in the order it was published.
+    """
+    by_producer: Dict[int, List[int]] = {producer: [] for producer in producers}
+    for message in received:
+        producer, seq = message.split(b':')
+        by_producer[int(producer)].append(int(seq))
+    assert len(received) == len(producers) * MESSAGES
+    for producer, seqs in by_producer.items():
+        assert seqs == list(range(MESSAGES)), f'producer {producer}'
+
+
+def _drain(drains: Dict[Any, Callable[[], List[bytes]]], expected: Dict[Any, int],
+           received: Dict[Any, List[bytes]]):
+    """
+    Drain every subscriber concurrently with the threads until all expected messages are received, or timeout.
+    """
+    deadline = time.monotonic() + TIMEOUT
+    while any(len(received[name]) < expected[name] for name in drains) and time.monotonic() < deadline:
+        idle = True
+        for name, drain in drains.items():
+            frames = drain()
+            idle = idle and not frames
+            received[name].extend(frames)
+        if idle:
+            time.sleep(0.001)
+
+
+def test_inbox_keeps_order_of_concurrent_publishers():
+    budget = MemoryBudget()
+    inbox = Inbox(b'test', budget=budget)
+    threads = Threads()
+
+    def publish(producer: int):
+        for seq in range(MESSAGES):
+            inbox.put(Frame(_message(producer, seq), 't'))
+
+    for producer in range(PUBLISHERS):
+        threads.add(publish, producer)
+    threads.start()
+    received = []
+    drain = lambda: [bytes(frame.payload) for frame in inbox.drain()]
+    _drain({'test': drain}, {'test': PUBLISHERS * MESSAGES}, {'test': received})
+    threads.join()
+    received.extend(drain())
+    _check(received, list(range(PUBLISHERS)))
+    assert len(inbox) == 0
+    assert inbox.nbytes == 0
+    assert inbox.dropped == 0
+    assert budget.used == 0
+
+
+def test_dispatcher_keeps_order_of_concurrent_publishers_while_subscribers_change():
+    dispatcher = mb.MessageDispatcher()
+    # steady subscribers of every shape, each must get all messages of the publishers it matches
+    steady = {b'prefix': 'room.*', b'regex': r'room\d*[02468]', b'literal': 'room3'}
+    for subscriber_id, pattern in steady.items():
+        dispatcher.subscribe(subscriber_id, pattern, notify=lambda: None)
+    matched = {b'prefix': list(range(PUBLISHERS)),
+               b'regex': [producer for producer in range(PUBLISHERS) if producer % 2 == 0],
+               b'literal': [3]}
+    stop = threading.Event()
+    threads = Threads()
+    cycles = [0] * CHURNERS
+
+    def churn(churner: int):
+        # replaces the subscriptions and the index while the publishers look them up
+        subscriber_id = b'churn%d' % churner
+        pattern, match, mismatch = CHURN_PATTERNS[churner % len(CHURN_PATTERNS)]
+        while not stop.is_set():
+            dispatcher.subscribe(subscriber_id, pattern, notify=lambda: None)
+            assert subscriber_id in dispatcher.index.match(match)
+            assert mismatch is None or subscriber_id not in dispatcher.index.match(mismatch)
+            dispatcher.unsubscribe(subscriber_id)
+            assert subscriber_id not in dispatcher.index.match(match)
+            cycles[churner] += 1
+
+    def publish(producer: int):
+        for seq in range(MESSAGES):
+            dispatcher.publish(_message(producer, seq), f'room{producer}')
+
+    for producer in range(PUBLISHERS):
+        threads.add(publish, producer)
+    for churner in range(CHURNERS):
+        threads.add(churn, churner)
+    threads.start()
+    drains = {subscriber_id: (lambda subscriber_id=subscriber_id: [
+        bytes(frame.payload) for frame in dispatcher.read_inbox(subscriber_id)]) for subscriber_id in steady}
+    expected = {subscriber_id: len(producers) * MESSAGES for subscriber_id, producers in matched.items()}
+    received = {subscriber_id: [] for subscriber_id in steady}
+    try:
+        _drain(drains, expected, received)
+    finally:
+        # the churners run until the steady subscribers got everything
+        stop.set()
+    threads.join()
+    for subscriber_id, drain in drains.items():
+        received[subscriber_id].extend(drain())
+    for subscriber_id, producers in matched.items():
+        _check(received[subscriber_id], producers)
+    assert all(cycles)
+    assert set(dispatcher.subscriptions) == set(steady)
+    for subscriber_id in steady:
+        dispatcher.unsubscribe(subscriber_id)
+    assert dispatcher.memory_budget.used == 0
+
@@ -0,0 +1,88 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from pypsmb import mb
+from pypsmb.mb import federation
+
+MESSAGES = 200
+TIMEOUT = 10
+
+
+class Broker:
+    """
+    A broker serving on an ephemeral port of the loopback interface, in this process.
+    """
+
+    def __init__(self, broker_id: str, max_hops: int):
+        self.dispatcher = mb.MessageDispatcher()
+        self.federation = mb.Federation(self.dispatcher, broker_id, max_hops=max_hops)
+        self.sock = socket.create_server(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.received = []
+        self._lock = threading.Lock()
+        self.dispatcher.subscribe(b'test', 'room.*', notify=self._on_message)
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, addr = self.sock.accept()
+            except OSError:
+                return  # closed
+            threading.Thread(target=mb.handle_client, args=(client, addr, self.dispatcher),
+                             kwargs=dict(federation=self.federation), daemon=True).start()
+
+    def _on_message(self):
+        # called by the publishing threads, the local one and those of the links from the other brokers
+        with self._lock:
+            self.received.extend(bytes(frame.payload) for frame in self.dispatcher.read_inbox(b'test'))
+
+    def close(self):
+        self.sock.close()
+
+
+def _wait_for(condition) -> bool:
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_ring_delivers_every_message_exactly_once():
+    # every broker is linked to both others, so with 2 hops each message also comes the long way round
+    brokers = [Broker(f'b{i}', max_hops=2) for i in range(3)]
+    try:
+        for i, broker in enumerate(brokers):
+            for other in brokers[i + 1:] + brokers[:i]:
+                broker.federation.add_peer('127.0.0.1', other.port)
+        for broker in brokers:
+            broker.federation.start()
+        assert _wait_for(lambda: all(link.peer_id for broker in brokers for link in broker.federation.links))
+
+        for i, broker in enumerate(brokers):
+            for k in range(MESSAGES):
+                broker.dispatcher.publish(b'%d:%d' % (i, k), f'room{i}')
+        expected = sorted(b'%d:%d' % (i, k) for i in range(len(brokers)) for k in range(MESSAGES))
+        assert _wait_for(lambda: all(len(broker.received) >= len(expected) for broker in brokers))
+        # copies taking the long way arrive after the first ones
+        time.sleep(0.5)
+        for broker in brokers:
+            assert sorted(broker.received) == expected
+    finally:
+        for broker in brokers:
+            broker.close()
+
+
+def test_link_gives_up_on_a_silent_peer(monkeypatch):
+    # the peer accepts the connection but never answers the handshake
+    monkeypatch.setattr(federation, 'CONNECT_TIMEOUT', 0.2)
+    with socket.create_server(('127.0.0.1', 0)) as server:
+        broker = mb.Federation(mb.MessageDispatcher(), 'b0')
+        broker.add_peer('127.0.0.1', server.getsockname()[1])
+        with pytest.raises(socket.timeout):
+            broker.links[0]._connect()